@@ -1,4 +1,4 @@
-import inspect, os, time, timeit
+import gc, inspect, os, sys, time, timeit
 
 import psycopg2, psycopg2.pool
 
@@ -29,6 +29,44 @@ def test(f, n=1000):
 def dqo_gen_sql():
   Something.ALL.where(col1=1)._sql()
 test(dqo_gen_sql)
+print(' ^^^', dqo.SQL_CACHE)
+
+def dqo_gen_sql_uncached():
+  dqo.SQL_CACHE.clear()
+  Something.ALL.where(col1=1)._sql()
+test(dqo_gen_sql_uncached)
+
+def dqo_builder_chain():
+  return Something.ALL.where(col1=1).where(id=2).select(Something.id, Something.col1).order_by(Something.col1).limit(10).bind(db)
+test(dqo_builder_chain, n=10000)
+
+def allocations(f, n=1000):
+  keep = []
+  gc.collect()
+  before = sys.getallocatedblocks()
+  for i in range(n):
+    keep.append(f())
+  print(' ^^^ %.1f allocated blocks retained per call' % ((sys.getallocatedblocks() - before) / n))
+allocations(dqo_builder_chain)
+
+# 60 columns
+Wide = dqo.Table(db=db)(type('Wide', (), dict(
+  id = dqo.Column(int, primary_key=True),
+  **{'col%i' % i: dqo.Column(int) for i in range(59)}
+)))
+
+def dqo_gen_sql_wide_uncached():
+  dqo.SQL_CACHE.clear()
+  Wide.ALL.where(col1=1)._sql()
+test(dqo_gen_sql_wide_uncached)
+
+wide_query = Wide.ALL.select(*Wide._dqoi_columns)
+wide_keys = [c._name for c in Wide._dqoi_columns]
+wide_row = tuple(range(60))
+def dqo_hydrate_wide():
+  wide_query._build(wide_keys, wide_row)
+test(dqo_hydrate_wide, n=100000)
+allocations(dqo_hydrate_wide)
 
 def dqo_simple_query():
   list(Something.ALL.where(col1=1))
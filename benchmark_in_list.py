@@ -0,0 +1,42 @@
+import os, random, sqlite3, tempfile, timeit
+
+import dqo
+
+# compares the in_() strategies on sqlite across list sizes
+
+fn = os.path.join(tempfile.mkdtemp(), 'dqo_benchmark_in_list.db')
+db = dqo.Database(sync_src=lambda: sqlite3.connect(fn))
+
+@dqo.Table(db=db)
+class Something:
+  id = dqo.Column(int, primary_key=True)
+  col1 = dqo.Column(int)
+
+db.evolve()
+
+with sqlite3.connect(fn) as conn:
+  conn.executemany('insert into something (id, col1) values (?,?)', [(i, i % 100) for i in range(200000)])
+
+def test(strategy, ids, n):
+  def f():
+    return len(list(Something.ALL.where(Something.id.in_(ids, strategy=strategy))))
+  assert f() == len(set(ids))
+  seconds = timeit.timeit(f, number=n)
+  return seconds / n * 1000
+
+STRATEGIES = ['bind', 'expand', 'values', 'temp', 'chunked']
+print('%8s' % 'size', ''.join(['%10s' % s for s in STRATEGIES]), '  (ms per query)')
+for size in [10, 100, 1000, 10000, 100000]:
+  ids = random.sample(range(200000), size)
+  n = max(3, 10000 // size)
+  times = []
+  with db.connection():
+    for strategy in STRATEGIES:
+      # expand and values bind one argument per value, so are limited by SQLITE_MAX_VARIABLE_NUMBER
+      if strategy in ('expand', 'values') and size > 30000:
+        times.append('-')
+        continue
+      times.append('%.3f' % test(strategy, ids, n))
+  print('%8i' % size, ''.join(['%10s' % t for t in times]))
+
+os.remove(fn)
@@ -3,7 +3,9 @@ import asyncio
 from .table import TableDecorator as Table
 from .column import Column, PrimaryKey, ForeignKey, Index
 from .database import Database, Dialect, EchoDatabase
-from .function import sql
+from .function import sql, param
+from .query import SQL_CACHE
+from .shared_cache import SharedCache
 
 DB = None
 
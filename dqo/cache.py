@@ -0,0 +1,186 @@
+import itertools, operator, time
+
+from .util import LRU
+
+
+class RowCache(object):
+  '''
+    A table's primary key cache (``@dqo.Table(cache='pk')``), used by ``Table.get()`` and ``Table.get_many()``.  It
+    keeps the column values of up to ``maxsize`` rows for ``ttl`` seconds, and hands out a new row object on every hit,
+    so changes to one never show up in another.  Writes through dqo to the table drop the rows they touch (see
+    :py:func:`written`).
+  '''
+
+  def __init__(self, maxsize=1024, ttl=60):
+    self.ttl = ttl
+    self.expired = 0
+    self._lru = LRU(maxsize)
+
+  def get(self, pk):
+    entry = self._lru.get(pk)
+    if entry is None: return None
+    expires, values = entry
+    if expires < time.monotonic():
+      self._lru.pop(pk)
+      self._lru.hits -= 1
+      self._lru.misses += 1
+      self.expired += 1
+      return None
+    return values
+
+  def put(self, pk, values, ttl=None):
+    self._lru.put(pk, (time.monotonic() + (self.ttl if ttl is None else ttl), values))
+
+  def written(self, pks):
+    if pks != (): self.invalidate(pks)
+
+  def invalidate(self, pks=None):
+    '''
+      Drops the given primary keys, or everything if ``None``.
+    '''
+    if pks is None:
+      self._lru.clear()
+      return
+    for pk in pks:
+      self._lru.pop(pk)
+
+  @property
+  def stats(self):
+    '''
+      The :py:class:`dqo.util.LRU` stats, plus ``expired``.
+    '''
+    stats = self._lru.stats
+    stats['expired'] = self.expired
+    return stats
+
+
+class Replica(object):
+  '''
+    A whole table kept in memory (``@dqo.Table(cache='full')``), for small reference tables.  It's loaded by the first
+    query it can answer, and again after ``ttl`` seconds or any write through dqo to the table.  Rows are kept as
+    tuples, with a hash index on the primary key and on each declared ``Index`` (and ``index=True`` or ``unique=True``
+    column).
+  '''
+
+  def __init__(self, tbl, ttl=60):
+    self.ttl = ttl
+    self.loads = 0
+    self.hits = 0
+    self._positions = {id(c):i for i, c in enumerate(tbl._dqoi_columns)}
+    indexed = [tbl._dqoi_pk.columns] if tbl._dqoi_pk else []
+    indexed += [index.columns for index in tbl._dqoi_indexes]
+    self._indexed = list(dict.fromkeys([tuple([self._positions[id(c)] for c in columns]) for columns in indexed]))
+    self._pk = self._indexed[0] if tbl._dqoi_pk else None
+    self._rows = None
+    self._indexes = None
+    self._expires = 0
+
+  @property
+  def stale(self):
+    return self._rows is None or self._expires < time.monotonic()
+
+  def load(self, rows):
+    '''
+      Replaces the table's rows (every column, in order).
+    '''
+    rows = [tuple(row) for row in rows]
+    indexes = {}
+    for positions in self._indexed:
+      index = indexes[positions] = {}
+      get = operator.itemgetter(*positions)
+      for row in rows:
+        index.setdefault(get(row), []).append(row)
+    self._rows, self._indexes = rows, indexes
+    self._expires = time.monotonic() + self.ttl
+    self.loads += 1
+
+  def position(self, column):
+    '''
+      The position of ``column`` in a row, or ``None`` if it's not one of the table's.
+    '''
+    return self._positions.get(id(column))
+
+  def select(self, matches, positions, limit=None):
+    '''
+      :param matches: ``{position: values}`` - rows must have one of the values at each position.
+      :param positions: The positions of the columns to return.
+      
+      Returns the matching rows as tuples, looked up with an index if ``matches`` pins down all its columns.
+    '''
+    self.hits += 1
+    rows = self._rows
+    for indexed, index in self._indexes.items():
+      if all([p in matches for p in indexed]):
+        keys = matches[indexed[0]] if len(indexed)==1 else itertools.product(*[matches[p] for p in indexed])
+        rows = [row for k in keys for row in index.get(k, ())]
+        break
+    if matches:
+      rows = [row for row in rows if all([row[p] in values for p, values in matches.items()])]
+    if limit is not None:
+      rows = rows[:limit]
+    get = operator.itemgetter(*positions)
+    if len(positions)==1: return [(get(row),) for row in rows]
+    return [get(row) for row in rows]
+
+  def get(self, pk):
+    if self._pk is None or self.stale: return None
+    rows = self._indexes[self._pk].get(pk)
+    if rows:
+      self.hits += 1
+      return rows[0]
+
+  def put(self, pk, values):
+    pass
+
+  def written(self, pks):
+    self.invalidate()
+
+  def invalidate(self, pks=None):
+    '''
+      Reloads the table on its next use.
+    '''
+    self._rows = None
+
+  @property
+  def stats(self):
+    '''
+      ``loads``, ``hits`` and ``size`` (rows).
+    '''
+    return {'loads':self.loads, 'hits':self.hits, 'size':len(self._rows or ())}
+
+
+class MemoryCache(RowCache):
+  '''
+    The default backend for :py:meth:`dqo.query.Query.cached` results (``Database(result_cache=...)``): an in process
+    LRU of up to ``maxsize`` results.  Any object with the same four methods can be used instead:
+
+    - ``get(key)`` returns what was ``put()``, or ``None`` if it's missing or expired.
+    - ``put(key, value, ttl)`` stores a value for ``ttl`` seconds.
+    - ``generation(table)`` returns a number changed by every ``bump(table)``.
+    - ``bump(table)`` is called on every write through dqo to the table (named as in the database).
+
+    A result is only used while the generations of the tables it read are those it was stored with.
+  '''
+
+  def __init__(self, maxsize=1024, ttl=60):
+    super().__init__(maxsize, ttl)
+    self._generations = {}
+
+  def generation(self, table):
+    return self._generations.get(table, 0)
+
+  def bump(self, table):
+    self._generations[table] = self._generations.get(table, 0) + 1
+
+
+def written(tbl, pks=None, db=None):
+  '''
+    Called for every write through dqo (to ``db``) - ``pks`` are the primary keys of the rows changed, or ``None`` if
+    they aren't known (every row may have changed).  Inserts pass ``()``.
+  '''
+  cache = getattr(tbl, '_dqoi_cache', None)
+  if cache is not None:
+    cache.written(pks)
+  results = getattr(db, 'result_cache', None)
+  if results is not None:
+    results.bump(tbl._dqoi_db_name)
@@ -1,5 +1,6 @@
 import copy, datetime
 
+from .util import shape, get_running_loop
 
 
 class BaseColumn:
@@ -60,17 +61,32 @@ class BaseColumn:
     '''
     return Condition('is not', [self, sql.null])
 
-  def in_(self, something):
+  def in_(self, something, strategy=None):
     '''
       Returns a condition where this column is in a list or inner query.
+      
+      A list is bound as a single argument (``= any(?)`` on PostgreSQL, a ``json_each()`` on SQLite), so the generated
+      SQL doesn't change with the length of the list.  Lists longer than ``InList.THRESHOLD`` can instead be matched
+      with a different ``strategy``:
+      
+      - ``'values'``: ``in (values (?),(?),...)``
+      - ``'temp'``: bulk loaded into a temp table the query joins against
+      - ``'chunked'``: the query is run once per ``InList.THRESHOLD`` values and the results concatenated
+      
+      ``'temp'`` and ``'chunked'`` only apply to top level ``where()`` conditions.  ``InList.LARGE_STRATEGY`` sets 
+      the default for long lists.
     '''
-    return Condition('in', [self, prepare_something(something)])
+    if hasattr(something, '_sql_'):
+      return Condition('in', [self, prepare_something(something)])
+    return InList(self, something, strategy=strategy)
 
-  def not_in(self, something):
+  def not_in(self, something, strategy=None):
     '''
-      Returns a condition where this column is in a list or inner query.
+      Returns a condition where this column is not in a list or inner query.  See :py:meth:`in_` for ``strategy``.
     '''
-    return Condition('not in', [self, prepare_something(something)])
+    if hasattr(something, '_sql_'):
+      return Condition('not in', [self, prepare_something(something)])
+    return InList(self, something, negate=True, strategy=strategy)
   
   def frm(self, s):
     '''
@@ -98,6 +114,8 @@ class InnerQuery:
     sql.write('(')
     self.query._sql_(d, sql, args)
     sql.write(')')
+  def _shape_(self, args):
+    return (InnerQuery, self.query._shape_(args))
 
 
 def allow_tz(kind):
@@ -108,6 +126,9 @@ class ForeignKey:
   :param to_columns: The columns this foreign key refers to.
   :param fake: A "fake" foreign key will give you the syntax sugar without actually creating the restriction in the database.  This is sometimes important for performance reasons.
   :param null: If nulls are allowed.
+  :param related_name: The attribute rows of the referenced table get their list of referencing rows as, when loaded
+    with :py:meth:`Query.plus`.  Defaults to this table's name plus ``_set`` (``b_set`` below).
+  :param lazy: If rows not loaded with ``plus()`` should load the referenced row the first time it's read (see below).
 
   Defines a foreign key relationship from this table to another.  For example:
 
@@ -138,13 +159,29 @@ class ForeignKey:
 
       alter table b add foreign key (my_a_part1,my_a_part2)
       references a (part1,part2)
+
+  With ``lazy=True``, reading ``b.a`` on a row that wasn't loaded with ``.plus(B.a)`` loads it - and the ``A`` of every
+  other row from the same query, with one ``in (...)`` query, so looping over the rows doesn't query once per row.
+  In async code the first read must be awaited:
+
+  .. code-block:: python
+
+    for b in B.ALL.where(...):
+      print(b.a)
+    
+    async for b in B.ALL.where(...):
+      print(await b.a)
+  
+  :py:meth:`load` does the same for any foreign key, lazy or not.
     '''
 
-  def __init__(self, *to_columns, fake=False, null=True):
+  def __init__(self, *to_columns, fake=False, null=True, related_name=None, lazy=False):
     self.to = to_columns
     self._name = None
     self.fake = fake
     self.null = null
+    self.related_name = related_name
+    self.lazy = lazy
 
   def _gen_columns(self):
     self.frm = []
@@ -159,6 +196,25 @@ class ForeignKey:
       setattr(self.tbl, c2._name, c2)
     return self.frm
   
+  def load(self, row):
+    '''
+    Returns the row ``row`` refers to, loading it (along with those of the rest of its result set if this key is lazy)
+    if need be.  Returns a ``coroutine`` in async code, whether loaded or not.  Example:
+
+    .. code-block:: python
+
+      a = B.a.load(b)
+      a = await B.a.load(b)
+    '''
+    if self._name in row.__dict__:
+      a = row.__dict__[self._name]
+      if get_running_loop():
+        async def f(): return a
+        return f()
+      return a
+    from .table import LazyRelation
+    return LazyRelation(self).load(row)
+
   def __repr__(self):
     from_cols = self.frm[0].name if len(self.frm)==1 else '[%s]' % (','.join([c.name for c in self.frm]))
     to_cols = self.to[0].name if len(self.to)==1 else '[%s]' % (','.join([c.name for c in self.to]))
@@ -300,6 +356,9 @@ class Column(BaseColumn):
     else:
       sql.write(d.reference(self))
 
+  def _shape_(self, args):
+    return (Column, self.tbl, self.name, self._alias)
+
   @property
   def asc(self):
     '''
@@ -321,6 +380,8 @@ class PosColumn:
   def _sql_(self, d, sql, args):
     self.column._sql_(d, sql, args)
     sql.write(' asc')
+  def _shape_(self, args):
+    return (PosColumn, shape(self.column, args))
     
 class NegColumn:
   def __init__(self, column):
@@ -328,6 +389,8 @@ class NegColumn:
   def _sql_(self, d, sql, args):
     self.column._sql_(d, sql, args)
     sql.write(' desc')
+  def _shape_(self, args):
+    return (NegColumn, shape(self.column, args))
 
 
 class Condition:
@@ -356,6 +419,9 @@ class Condition:
       else:
         args.append(component)
         sql.write(d.arg)
+
+  def _shape_(self, args):
+    return (Condition, self._join, self._sep) + tuple([shape(c, args) for c in self._components])
       
   def __and__(self, other):
     return Condition('and', [self, other])
@@ -364,5 +430,92 @@ class Condition:
     return Condition('or', [self, other])
 
 
-from .function import sql
+class InList(Condition):
+  '''
+  A column tested against a list of values.  Lists of plain values (numbers, strings) are bound as one argument in a
+  dialect specific way (``'bind'``).  Anything else gets one argument per value (``'expand'``), or once longer than
+  ``THRESHOLD`` is loaded into a temp table (``'temp'``).
+  '''
+
+  SCALARS = (int, float, str, bool, type(None))
+  STRATEGIES = ('bind', 'expand', 'values', 'temp', 'chunked')
+  # these need more than one statement, so are run by the query (see Query._script())
+  SCRIPTED = ('temp', 'chunked')
+  THRESHOLD = 1000
+  LARGE_STRATEGY = None
+
+  def __init__(self, column, values, negate=False, strategy=None):
+    self._join = 'not in' if negate else 'in'
+    self._sep = ' '
+    self.column = column
+    self.negate = negate
+    if isinstance(values, Param):
+      self.values = values
+      strategy = 'bind'
+    else:
+      self.values = list(values)
+      scalars = all([isinstance(v, self.SCALARS) for v in self.values])
+      if strategy is None and len(self.values) > self.THRESHOLD:
+        strategy = self.LARGE_STRATEGY or ('bind' if scalars else 'temp')
+      if strategy is None or strategy=='bind':
+        strategy = 'bind' if scalars else 'expand'
+      if strategy not in self.STRATEGIES:
+        raise ValueError('unknown in_() strategy %r (expected one of %s)' % (strategy, ', '.join(self.STRATEGIES)))
+      # splitting a "not in" across queries would match values in the other chunks
+      if strategy=='chunked' and negate:
+        strategy = 'temp'
+      if strategy=='temp' and not isinstance(column, Column):
+        strategy = 'expand'
+    self.strategy = strategy
+    self.bind_as_one = strategy=='bind'
+    self._components = [column, self.values]
+
+  def _sql_(self, d, sql, args):
+    self.column._sql_(d, sql, args)
+    if self.strategy=='bind':
+      d.in_list(sql, args, self.values, self.negate)
+    elif self.strategy=='values':
+      sql.write(' not in (values ' if self.negate else ' in (values ')
+      sql.write(','.join(['(%s)' % d.arg for v in self.values]))
+      sql.write(')')
+      args.extend(self.values)
+    else:
+      sql.write(' not in (' if self.negate else ' in (')
+      sql.write(','.join([d.arg for v in self.values]))
+      sql.write(')')
+      args.extend(self.values)
+
+  def _shape_(self, args):
+    column = shape(self.column, args)
+    if self.strategy=='bind':
+      args.append(self.values)
+      return (InList, column, self.negate, None)
+    args.extend(self.values)
+    return (InList, column, self.negate, self.strategy=='values', len(self.values))
+
+
+class InTable(Condition):
+  '''
+  A column tested against the ``value`` column of a (temp) table.
+  '''
+
+  def __init__(self, column, table, negate=False):
+    self._join = 'not in' if negate else 'in'
+    self._sep = ' '
+    self.column = column
+    self.table = table
+    self.negate = negate
+    self._components = [column]
+
+  def _sql_(self, d, sql, args):
+    self.column._sql_(d, sql, args)
+    sql.write(' not in (select value from ' if self.negate else ' in (select value from ')
+    sql.write(self.table)
+    sql.write(')')
+
+  def _shape_(self, args):
+    return (InTable, shape(self.column, args), self.table, self.negate)
+
+
+from .function import sql, Param
 
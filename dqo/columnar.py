@@ -0,0 +1,125 @@
+import datetime, itertools
+
+
+def import_numpy():
+  try:
+    import numpy
+  except ImportError:
+    raise ImportError('to_columns() and to_numpy() require numpy (pip install numpy)')
+  return numpy
+
+
+def dtype_for(kind, tz=False):
+  # anything numpy has no native type for (strings, arrays, timezone aware datetimes) is an object array
+  if kind is bool: return 'bool'
+  if kind is int: return 'int64'
+  if kind is float: return 'float64'
+  if kind is datetime.datetime and not tz: return 'datetime64[us]'
+  if kind is datetime.date: return 'datetime64[D]'
+  return 'O'
+
+
+def common_dtype(np, dtypes):
+  # one that holds values of all of dtypes - numbers widen to int64 or float64, anything else mixed is an object array
+  dtypes = set([np.dtype(dtype) for dtype in dtypes])
+  if len(dtypes)==1: return dtypes.pop()
+  kinds = set([dtype.kind for dtype in dtypes])
+  if kinds <= set('bif'): return np.dtype('float64' if 'f' in kinds else 'int64')
+  return np.dtype('O')
+
+
+# written to null positions of non-object arrays, under the mask
+FILL = {'b':False, 'i':0, 'f':0.0, 'M':'NaT'}
+
+
+class Columns:
+  '''
+  Fills one array per selected column from batches of driver rows, transposing each batch with ``zip()`` rather than
+  building an object per row.  Arrays start at ``capacity`` and double as needed.  Columns that had nulls come back as
+  masked arrays.
+  '''
+
+  def __init__(self, np, names, dtypes, capacity):
+    self.np = np
+    self.names = names
+    self.dtypes = dtypes
+    self.capacity = capacity
+    self.size = 0
+    self.arrays = [None] * len(names)
+    self.masks = [None] * len(names)
+
+  def add(self, batch):
+    n = len(batch)
+    if not n: return
+    i, j = self.size, self.size + n
+    if j > self.capacity:
+      while j > self.capacity:
+        self.capacity *= 2
+      self.arrays = [None if a is None else self._grow(a) for a in self.arrays]
+      self.masks = [None if m is None else self._grow(m) for m in self.masks]
+    for k, values in enumerate(zip(*batch)):
+      self._set(k, i, j, values)
+    self.size = j
+
+  def _grow(self, a):
+    ret = self.np.zeros(self.capacity, dtype=a.dtype) if a.dtype.kind=='b' else self.np.empty(self.capacity, dtype=a.dtype)
+    ret[:len(a)] = a
+    return ret
+
+  def _set(self, k, i, j, values):
+    np = self.np
+    a = self.arrays[k]
+    dtype = self.dtypes[k]
+    if dtype is None:
+      # not a column (a function) - go by the values, widening the array for any that don't fit it
+      kinds = set([v.__class__ for v in values if v is not None])
+      dtype = common_dtype(np, [dtype_for(c) for c in kinds] or ['O'])
+      if a is not None and kinds and a.dtype!=dtype:
+        a = self.arrays[k] = a.astype(common_dtype(np, [a.dtype, dtype]))
+    if a is None:
+      a = self.arrays[k] = np.empty(self.capacity, dtype=dtype)
+    if a.dtype.kind!='O' and None in values:
+      if self.masks[k] is None:
+        self.masks[k] = np.zeros(self.capacity, dtype='bool')
+      self.masks[k][i:j] = np.fromiter([v is None for v in values], dtype='bool', count=j-i)
+      fill = FILL.get(a.dtype.kind)
+      values = [fill if v is None else v for v in values]
+    try:
+      a[i:j] = values
+    except ValueError:
+      # sequences (array columns) in an object array
+      for x, v in enumerate(values, i):
+        a[x] = v
+
+  def arrays_by_name(self):
+    np = self.np
+    ret = {}
+    for name, a, mask in zip(self.names, self.arrays, self.masks):
+      if a is None: a = np.empty(0, dtype='O')
+      a = a[:self.size].copy() if len(a) > self.size else a
+      if mask is not None:
+        a = np.ma.MaskedArray(a, mask=mask[:self.size])
+      ret[name] = a
+    return ret
+
+  def structured(self):
+    np = self.np
+    columns = self.arrays_by_name()
+    dtype = [(name, a.dtype) for name, a in columns.items()]
+    data = np.empty(self.size, dtype=dtype)
+    for name, a in columns.items():
+      data[name] = np.ma.getdata(a)
+    if not any([isinstance(a, np.ma.MaskedArray) for a in columns.values()]):
+      return data
+    mask = np.zeros(self.size, dtype=[(name, 'bool') for name in columns])
+    for name, a in columns.items():
+      mask[name] = np.ma.getmaskarray(a)
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def batches(rows, batch_size):
+  rows = iter(rows)
+  while True:
+    batch = list(itertools.islice(rows, batch_size))
+    if not batch: return
+    yield batch
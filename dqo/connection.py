@@ -1,11 +1,206 @@
-import threading
+import asyncio, collections, itertools, re, sys, threading, weakref
+
+from .util import LRU
 
 TLS = threading.local()
 TLS.conn = None
 
+
+class StatementCache(object):
+  '''
+    Server side prepared statements (``asyncpg``), kept in a bounded LRU per physical connection and keyed by SQL text.
+    Counters are totals across all connections.
+  '''
+
+  def __init__(self, maxsize=256):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._by_conn = weakref.WeakKeyDictionary()
+
+  async def prepare(self, raw_conn, sql):
+    # pooled asyncpg connections are proxies around the physical connection
+    conn = getattr(raw_conn, '_con', None) or raw_conn
+    try:
+      lru = self._by_conn.get(conn)
+      if lru is None:
+        lru = self._by_conn[conn] = LRU(self.maxsize)
+    except TypeError:
+      # can't be weakly referenced, so can't be cached
+      return None
+    stmt = lru.get(sql)
+    if stmt is not None:
+      self.hits += 1
+      return stmt
+    self.misses += 1
+    stmt = await raw_conn.prepare(sql)
+    evictions = lru.evictions
+    lru.put(sql, stmt)
+    self.evictions += lru.evictions - evictions
+    return stmt
+
+  def discard(self, raw_conn, sql):
+    conn = getattr(raw_conn, '_con', None) or raw_conn
+    lru = self._by_conn.get(conn)
+    if lru is not None: lru.pop(sql)
+
+  def clear(self):
+    '''
+      Forgets every prepared statement.  Called by :py:meth:`Database.evolve` as schema changes invalidate them.
+    '''
+    self._by_conn.clear()
+
+  @property
+  def stats(self):
+    '''
+      A ``dict`` of ``hits``, ``misses``, ``evictions``, ``size`` (statements currently prepared) and ``connections``.
+    '''
+    lrus = list(self._by_conn.values())
+    return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions, 'size':sum([len(lru) for lru in lrus]), 'connections':len(lrus)}
+
+
+class PreparedStatements(object):
+  '''
+    Turns hot ``psycopg2`` statements into named server side prepared statements.  Once a statement has run ``threshold``
+    times on a physical connection it's ``PREPARE``d there and from then on sent as ``EXECUTE name(...)``.  Each connection
+    keeps up to ``maxsize`` of them (least recently used are deallocated).  State is tracked per physical connection, so
+    pooled connections keep their statements across checkouts.
+  '''
+
+  PREPARABLE = ('select ', 'insert ', 'update ', 'delete ')
+
+  def __init__(self, threshold, maxsize=256):
+    self.threshold = threshold
+    self.maxsize = maxsize
+    self.generation = 0
+    self.prepares = 0
+    self.executions = 0
+    self.deallocations = 0
+    self._by_conn = weakref.WeakKeyDictionary()
+    self._names = itertools.count(1)
+
+  class State:
+    def __init__(self, generation, maxsize):
+      self.generation = generation
+      self.counts = LRU(maxsize * 4)
+      self.prepared = collections.OrderedDict()
+  
+  def rewrite(self, raw_conn, cur, sql, args):
+    '''
+      Returns the ``(sql, args)`` to run in place of the given ones.
+    '''
+    if not sql.startswith(self.PREPARABLE): return sql, args
+    try:
+      state = self._by_conn.get(raw_conn)
+    except TypeError:
+      return sql, args
+    if state is None or state.generation != self.generation:
+      if state is not None:
+        cur.execute('deallocate all')
+      state = self._by_conn[raw_conn] = PreparedStatements.State(self.generation, self.maxsize)
+    name = state.prepared.get(sql)
+    if name is None:
+      count = state.counts.get(sql, 0) + 1
+      if count < self.threshold:
+        state.counts.put(sql, count)
+        return sql, args
+      state.counts.pop(sql)
+      name = 'dqo_%i' % next(self._names)
+      if not self._prepare(raw_conn, cur, name, sql):
+        name = False
+      state.prepared[sql] = name
+      while len(state.prepared) > self.maxsize:
+        old_sql, old_name = state.prepared.popitem(last=False)
+        if old_name:
+          cur.execute('deallocate %s' % old_name)
+          self.deallocations += 1
+    else:
+      state.prepared.move_to_end(sql)
+    if not name: return sql, args
+    self.executions += 1
+    if not args: return 'execute %s' % name, args
+    return 'execute %s (%s)' % (name, ','.join(['%s'] * len(args))), args
+
+  def _prepare(self, raw_conn, cur, name, sql):
+    n = itertools.count(1)
+    server_sql = re.sub('%[%s]', lambda m: '%' if m.group(0)=='%%' else '$%i' % next(n), sql)
+    # a failed prepare mustn't poison an open transaction
+    in_tx = not raw_conn.autocommit and raw_conn.get_transaction_status() != 0
+    if in_tx: cur.execute('savepoint dqo_prepare')
+    try:
+      cur.execute('prepare %s as %s' % (name, server_sql))
+    except Exception:
+      if in_tx: cur.execute('rollback to savepoint dqo_prepare')
+      elif not raw_conn.autocommit: raw_conn.rollback()
+      return False
+    if in_tx: cur.execute('release savepoint dqo_prepare')
+    self.prepares += 1
+    return True
+
+  def clear(self):
+    '''
+      Deallocates every prepared statement (lazily, the next time each connection is used).  Called by 
+      :py:meth:`Database.evolve` as schema changes invalidate them.
+    '''
+    self.generation += 1
+
+  @property
+  def stats(self):
+    '''
+      A ``dict`` of ``prepares``, ``executions``, ``deallocations`` and ``connections``.
+    '''
+    return {'prepares':self.prepares, 'executions':self.executions, 'deallocations':self.deallocations, 'connections':len(self._by_conn)}
+
+
+class BatchSize(object):
+  '''
+    How many rows to fetch at a time while streaming.  Either fixed, or if ``size`` is ``None`` tuned from the rows seen
+    so far so each batch is about ``TARGET`` bytes (starting with ``FIRST`` rows).
+  '''
+
+  TARGET = 1 << 20
+  FIRST = 100
+  MIN = 10
+  MAX = 100000
+
+  def __init__(self, size=None):
+    self.auto = size is None
+    self.size = self.FIRST if self.auto else size
+
+  def observe(self, rows):
+    if not self.auto or not rows: return
+    sample = rows[:10]
+    width = sum([sys.getsizeof(row) + sum([sys.getsizeof(v) for v in row]) for row in sample]) / len(sample)
+    self.size = max(self.MIN, min(self.MAX, int(self.TARGET / width)))
+
+
+class Script(object):
+  '''
+    A query needing more than one statement.  ``setup`` statements run first and ``teardown`` statements last, on the
+    same connection, around ``steps`` (``(sql, args)`` pairs) whose results are concatenated.  Each setup statement is
+    ``(sql, rows, table)``: ``sql`` is run once, or once per row if there are ``rows`` - which ``asyncpg`` instead
+    copies into ``table``'s ``value`` column (``COPY``), and ``psycopg2`` inserts a page of rows at a time.
+  '''
+
+  def __init__(self, steps, setup=(), teardown=()):
+    self.steps = steps
+    self.setup = setup
+    self.teardown = teardown
+
+  def __str__(self):
+    return ';\n'.join([sql for sql, rows, table in self.setup] + [str(sql) for sql, args in self.steps] + list(self.teardown))
+
+  def __repr__(self):
+    return '<Script %i steps>' % len(self.steps)
+
+
 class Connection(object):
+
+  _cursor_names = itertools.count(1)
   
   def __init__(self, db, get_raw_conn):
+    self._db = db
     self._get_raw_conn = get_raw_conn
     self._raw_conn = None
 
@@ -17,47 +212,231 @@ class Connection(object):
     if self._raw_conn:
       await self._raw_conn.close()
 
-  def async_execute(self, sql, args):
-    return self._raw_conn.execute(sql, *args)
+  async def async_execute(self, sql, args):
+    if sql.__class__ is Script:
+      return await self._async_script(sql, self.async_execute)
+    if self._aiosqlite():
+      return (await self._raw_conn.execute(sql, args)).rowcount
+    stmt = await self._prepare(sql)
+    if stmt is None:
+      return await self._raw_conn.execute(sql, *args)
+    await self._run(stmt, sql, args)
+    return stmt.get_statusmsg()
       
-  def async_fetch(self, sql, args):
-    #return self._raw_conn.cursor(sql, *args) # for streaming
-    return self._raw_conn.fetch(sql, *args)
+  async def async_fetch(self, sql, args):
+    if sql.__class__ is Script:
+      return await self._async_script(sql, self.async_fetch)
+    if self._aiosqlite():
+      return await self._raw_conn.execute_fetchall(sql, args)
+    stmt = await self._prepare(sql)
+    if stmt is None:
+      return await self._raw_conn.fetch(sql, *args)
+    return await self._run(stmt, sql, args)
+
+  async def async_lastrowid(self, sql, args):
+    '''
+      Runs an insert, returning the ``rowid`` of the row inserted (SQLite).
+    '''
+    return (await self._raw_conn.execute(sql, args)).lastrowid
+
+  def _aiosqlite(self):
+    # aiosqlite takes arguments as a sequence, like sqlite3 - asyncpg takes them as *args
+    return self._raw_conn.__class__.__module__.startswith('aiosqlite')
+
+  async def async_execute_many(self, sql, rows):
+    await self._raw_conn.executemany(sql, rows)
+
+  async def async_stream(self, sql, args, batch_size=None):
+    '''
+      Yields rows ``batch_size`` at a time (tuned to the row width if ``None``, see :py:class:`BatchSize`) from an
+      ``asyncpg`` cursor (in a transaction, as cursors need one), fetching the next batch while the current one is
+      consumed.  Other drivers fetch everything up front.
+    '''
+    raw_conn = self._raw_conn
+    if sql.__class__ is Script or not raw_conn.__class__.__module__.startswith('asyncpg'):
+      for row in await self.async_fetch(sql, args):
+        yield row
+      return
+    batch_size = BatchSize(batch_size)
+    tx = None if raw_conn.is_in_transaction() else raw_conn.transaction()
+    if tx: await tx.start()
+    batch = None
+    try:
+      stmt = await self._prepare(sql)
+      cursor = await (stmt.cursor(*args) if stmt else raw_conn.cursor(sql, *args))
+      n = batch_size.size
+      batch = asyncio.ensure_future(cursor.fetch(n))
+      while batch:
+        rows = await batch
+        batch_size.observe(rows)
+        batch = asyncio.ensure_future(cursor.fetch(batch_size.size)) if len(rows)==n else None
+        n = batch_size.size
+        for row in rows:
+          yield row
+    except BaseException:
+      if batch:
+        batch.cancel()
+        try:
+          await batch
+        except BaseException:
+          pass
+      if tx: await tx.rollback()
+      raise
+    if tx: await tx.commit()
+
+  async def _prepare(self, sql):
+    cache = self._db.statement_cache if self._db else None
+    if cache and cache.maxsize and self._raw_conn.__class__.__module__.startswith('asyncpg'):
+      return await cache.prepare(self._raw_conn, sql)
+
+  async def _run(self, stmt, sql, args):
+    try:
+      return await stmt.fetch(*args)
+    except Exception as e:
+      # the statement was prepared against a schema that has since changed
+      if e.__class__.__name__ != 'InvalidCachedStatementError': raise
+      self._db.statement_cache.discard(self._raw_conn, sql)
+      stmt = await self._prepare(sql)
+      return await stmt.fetch(*args)
+
+  async def _async_script(self, script, f):
+    raw_conn = self._raw_conn
+    for sql, rows, table in script.setup:
+      if rows is None: await raw_conn.execute(sql)
+      elif hasattr(raw_conn, 'copy_records_to_table'): await raw_conn.copy_records_to_table(table, records=rows, columns=['value'])
+      else: await raw_conn.executemany(sql, rows)
+    try:
+      ret = []
+      for sql, args in script.steps:
+        result = await f(sql, args)
+        if f==self.async_fetch: ret.extend(result)
+        else: ret = result
+      return ret
+    finally:
+      for sql in script.teardown:
+        await raw_conn.execute(sql)
 
   def __enter__(self):
-    if self._raw_conn: return OpenConnection(self._raw_conn)
-    if TLS.conn: return OpenConnection(TLS.conn)
+    if self._raw_conn: return OpenConnection(self._raw_conn, self._db)
+    if TLS.conn: return OpenConnection(TLS.conn, self._db)
     self._raw_conn = self._get_raw_conn()
     if hasattr(self._raw_conn, 'autocommit'): self._raw_conn.autocommit = True
     TLS.conn = self._raw_conn
     return self
 
   def __exit__(self, exc_type, exc, tb):
+    # a nested block got an OpenConnection, and leaves the outer one open
     if self._raw_conn:
       self._raw_conn.close()
-    TLS.conn = None
+      TLS.conn = None
     
+  def _execute(self, cur, sql, args):
+    prepared = self._db.prepared_statements if self._db else None
+    if prepared:
+      # unwrap connections from a psycopg2 pool
+      raw_conn = getattr(self._raw_conn, 'conn', self._raw_conn)
+      if raw_conn.__class__.__module__.startswith('psycopg2'):
+        sql, args = prepared.rewrite(raw_conn, cur, sql, args)
+    cur.execute(sql, args)
+
   def sync_execute(self, sql, args, f_cur=None):
+    if sql.__class__ is Script:
+      for _ in self._sync_script(sql, fetch=False): pass
+      return
     cur = self._raw_conn.cursor()
-    cur.execute(sql, args)
+    self._execute(cur, sql, args)
     if f_cur: f_cur(cur)
     return
     
+  def sync_execute_many(self, sql, rows):
+    '''
+      Runs ``sql`` once for each list of args in ``rows``.  ``psycopg2`` is sent them a page at a time 
+      (``execute_batch()``) rather than in a round trip each.
+    '''
+    cur = self._raw_conn.cursor()
+    raw_conn = getattr(self._raw_conn, 'conn', self._raw_conn)
+    if raw_conn.__class__.__module__.startswith('psycopg2'):
+      import psycopg2.extras
+      psycopg2.extras.execute_batch(cur, sql, rows)
+    else:
+      cur.executemany(sql, rows)
+
   def execute_all(self, cmds):
     for sql, args in cmds:
       self.sync_execute(sql, args)
       
   def sync_fetch(self, sql, args):
+    if sql.__class__ is Script:
+      yield from self._sync_script(sql)
+      return
     cur = self._raw_conn.cursor()
-    cur.execute(sql, args)
+    self._execute(cur, sql, args)
     while True:
       rows = cur.fetchmany()
       if not rows: break
       yield from rows
+
+  def sync_stream(self, sql, args, batch_size=None):
+    '''
+      Yields rows ``batch_size`` at a time (tuned to the row width if ``None``, see :py:class:`BatchSize`).  With 
+      ``psycopg2`` they come from a named (server side) cursor, in a transaction that's committed when the rows run out
+      (or rolled back if iteration stops early) unless one was already open.  Other drivers use ``fetchmany()``.
+    '''
+    if sql.__class__ is Script:
+      yield from self.sync_fetch(sql, args)
+      return
+    batch_size = BatchSize(batch_size)
+    raw_conn = getattr(self._raw_conn, 'conn', self._raw_conn)
+    if not raw_conn.__class__.__module__.startswith('psycopg2'):
+      cur = self._raw_conn.cursor()
+      self._execute(cur, sql, args)
+      yield from self._fetch_batches(cur, batch_size)
+      return
+    # named cursors only live inside a transaction
+    autocommit = raw_conn.autocommit
+    if autocommit: raw_conn.autocommit = False
+    cur = raw_conn.cursor(name='dqo_cursor_%i' % next(Connection._cursor_names))
+    done = False
+    try:
+      cur.execute(sql, args)
+      yield from self._fetch_batches(cur, batch_size)
+      done = True
+    finally:
+      if autocommit:
+        raw_conn.commit() if done else raw_conn.rollback()
+        raw_conn.autocommit = True
+      elif not cur.closed:
+        cur.close()
+
+  def _fetch_batches(self, cur, batch_size):
+    while True:
+      rows = cur.fetchmany(batch_size.size)
+      if not rows: break
+      batch_size.observe(rows)
+      yield from rows
+
+  def _sync_script(self, script, fetch=True):
+    cur = self._raw_conn.cursor()
+    raw_conn = getattr(self._raw_conn, 'conn', self._raw_conn)
+    for sql, rows, table in script.setup:
+      if rows is None: cur.execute(sql, [])
+      elif raw_conn.__class__.__module__.startswith('psycopg2'):
+        # multi-row inserts of a page of values at a time, not a round trip each
+        import psycopg2.extras
+        psycopg2.extras.execute_values(cur, 'insert into %s (value) values %%s' % table, rows, page_size=1000)
+      else: cur.executemany(sql, rows)
+    try:
+      for sql, args in script.steps:
+        if fetch: yield from self.sync_fetch(sql, args)
+        else: self.sync_execute(sql, args)
+    finally:
+      for sql in script.teardown:
+        cur.execute(sql, [])
       
 
 class OpenConnection(Connection):
-  def __init__(self, _raw_conn):
+  def __init__(self, _raw_conn, db=None):
+    self._db = db
     self._raw_conn = _raw_conn
   async def __aenter__(self):
     pass
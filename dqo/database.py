@@ -1,13 +1,24 @@
-import asyncio, copy, enum, inspect, io, types
+import asyncio, copy, enum, inspect, io, json, types
 
-from .connection import Connection
-from .util import get_running_loop
+from .connection import Connection, StatementCache, PreparedStatements
+from .util import get_running_loop, SingleFlight, LRU
+from .cache import MemoryCache
+
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
 
     
 class Database(object):
   '''
     :param src: A function returning a database connection, or a connection pool.
     :param dialect: The database :py:class:`Dilect` to speak (optional).
+    :param statement_cache_size: How many server side prepared statements to keep per ``asyncpg`` connection (``0`` to disable).
+    :param prepare_threshold: Executions of a statement on a ``psycopg2`` connection before it's ``PREPARE``d on the server (optional, off by default).
+    :param prefetch: How many rows ``async for`` fetches at a time from an ``asyncpg`` cursor (``None`` to size batches from the row width).
+    :param result_cache: Where :py:meth:`Query.cached` results are kept (optional, an in process :py:class:`dqo.cache.MemoryCache` by default).
+    :param coalesce: If concurrent identical selects in async code should share one query (see below).
 
     The :py:class:`Database` controls connections to your database.  The `src` parameter is required.  For example:
     
@@ -57,13 +68,23 @@ class Database(object):
     .. code-block:: python
     
       User.ALL.bind(sync_db=db).first()
+
+  With ``coalesce=True``, async selects with the same SQL and arguments running at the same time share one query: the
+  first runs it, and the rest await its rows (each still builds its own row objects).  Under bursts of identical
+  reads this saves round trips, at the cost of ``async for`` fetching whole results rather than streaming them.
+  Counts are in ``db.single_flight.stats``.
   '''
   
-  def __init__(self, sync_src=None, async_src=None, sync_dialect=None, async_dialect=None):
+  def __init__(self, sync_src=None, async_src=None, sync_dialect=None, async_dialect=None, statement_cache_size=256, prepare_threshold=None, prefetch=1000, result_cache=None, coalesce=False):
     self.sync_src = sync_src
     self.async_src = async_src
     self.sync_dialect = sync_dialect
     self.async_dialect = async_dialect
+    self.statement_cache = StatementCache(statement_cache_size)
+    self.prepared_statements = PreparedStatements(prepare_threshold) if prepare_threshold else None
+    self.prefetch = prefetch
+    self.result_cache = MemoryCache() if result_cache is None else result_cache
+    self.single_flight = SingleFlight() if coalesce else None
 
     self._known_tables = []
     self._async_init = None
@@ -148,7 +169,6 @@ class Database(object):
         if conn_or_pool2.__class__.__module__.startswith('asyncpg'):
           self.async_dialect = Dialect.POSTGRES(lib='asyncpg')
         await conn_or_pool2.close()
-      coro = asyncio.coroutine(f)
       event_loop.run_until_complete(f())
       event_loop.close()
 
@@ -170,11 +190,30 @@ class Database(object):
     
   def transaction(self):
     pass
+
+  def session(self):
+    '''
+    Returns a new :py:class:`dqo.session.Session` (an identity map and unit of work) to use in a ``with`` or
+    ``async with`` block:
+
+    .. code-block:: python
+
+      with db.session():
+        user = User.ALL.where(id=1).first()
+        user.name = 'John'
+        User(name='Paul').save()
+      # one update and one insert ran here
+    '''
+    from .session import Session
+    return Session(self)
   
   def evolve(self):
     changes = self.diff()
     with self.connection() as conn:
       conn.execute_all(changes)
+    if changes:
+      self.statement_cache.clear()
+      if self.prepared_statements: self.prepared_statements.clear()
     
   def diff(self):
     diff = Diff(self)
@@ -191,6 +230,11 @@ class EchoDatabase(Database):
     self.sync_src = self.conn
     self.history = []
     self._async_init = None
+    self.statement_cache = StatementCache(0)
+    self.prepared_statements = None
+    self.prefetch = 1000
+    self.result_cache = MemoryCache()
+    self.single_flight = None
   
   class Connection:
     def __init__(self, db):
@@ -199,6 +243,8 @@ class EchoDatabase(Database):
     def close(self): pass
     def execute(self, sql, args):
       self.db.history.append((sql, args))
+    def executemany(self, sql, rows):
+      self.db.history.append((sql, rows))
     def fetchmany(self):
       return []
   
@@ -215,6 +261,12 @@ class GenericDialect(object):
     FOREIGN KEY FROM FULL OUTER JOIN GROUP BY HAVING IN INDEX INNER JOIN INSERT INTO INSERT INTO SELECT IS NULL IS NOT NULL JOIN LEFT JOIN LIKE LIMIT NOT NOT NULL OR ORDER BY OUTER JOIN 
     PRIMARY KEY PROCEDURE RIGHT JOIN ROWNUM SELECT SELECT DISTINCT SELECT INTO SELECT TOP SET TABLE TOP TRUNCATE TABLE UNION UNION ALL UNIQUE UPDATE VALUES VIEW WHERE
   '''.lower().split())
+  # bounded, as their keys (names, tables) can keep dynamically created tables alive
+  TERMS = LRU(4096)
+  FRAGMENTS = LRU(4096)
+  # if "insert ... returning" works, and "default" can be written in a multi-row "values" list
+  RETURNING = True
+  DEFAULT_IN_VALUES = True
 
   def __init__(self):
     self.version = None
@@ -233,9 +285,23 @@ class GenericDialect(object):
     return same_class
   
   def term(self, s):
-    s = s.lower().replace('"','')
-    if s not in self.KEYWORDS: return s
-    else: return '"%s"' % s
+    t = self.TERMS.get(s)
+    if t is None:
+      t = s.lower().replace('"','')
+      if t in self.KEYWORDS: t = '"%s"' % t
+      self.TERMS.put(s, t)
+    return t
+  
+  def fragment(self, key, f):
+    '''
+      Returns SQL that depends only on ``key`` (tables, columns and aliases) and this dialect, computing it with ``f()``
+      the first time (or once it's been evicted, after ``FRAGMENTS.maxsize`` others).
+    '''
+    sql = self.FRAGMENTS.get(key)
+    if sql is None:
+      sql = f()
+      self.FRAGMENTS.put(key, sql)
+    return sql
 
   @property
   def arg(self):
@@ -244,6 +310,21 @@ class GenericDialect(object):
     elif self.lib=='asyncpg': return '$%i' % self.arg_counter
     else: return '?'
 
+  def in_list(self, sql, args, values, negate):
+    '''
+      Writes a test against a list of values bound as a single argument, so the SQL is the same for any length of list.
+    '''
+    sql.write(' <> all(' if negate else ' = any(')
+    sql.write(self.arg)
+    sql.write(')')
+    args.append(values)
+
+  def adapt(self, args):
+    '''
+      Converts bound values the database library can't handle natively.
+    '''
+    return args
+
   def register(self, tbl):
     if tbl in self.registered: raise ValueError('already registered')
     self.registered[tbl] = self.gen_name(tbl._dqoi_db_name)
@@ -277,6 +358,7 @@ class InnerDialect:
     self.d = d
     self.seen = set()
     self.registered = {}
+    self.FRAGMENTS = d.FRAGMENTS
 
   def for_inner_query(self):
     return InnerDialect(self)
@@ -288,9 +370,13 @@ class InnerDialect:
   def arg(self):
     return self.d.arg
 
+  def in_list(self, sql, args, values, negate):
+    return self.d.in_list(sql, args, values, negate)
+
   register = GenericDialect.register
   reference = GenericDialect.reference
   gen_name = GenericDialect.gen_name
+  fragment = GenericDialect.fragment
   
 
 class PostgresDialect(GenericDialect):
@@ -332,6 +418,8 @@ class PostgresDialect(GenericDialect):
     VIEW VIEWS VOLATILE WHEN WHENEVER WHERE WHITESPACE WIDTH_BUCKET WINDOW WITH WITHIN WITHOUT WORK WRAPPER WRITE XML XMLAGG XMLATTRIBUTES XMLBINARY XMLCAST XMLCOMMENT XMLCONCAT XMLDECLARATION 
     XMLDOCUMENT XMLELEMENT XMLEXISTS XMLFOREST XMLITERATE XMLNAMESPACES XMLPARSE XMLPI XMLQUERY XMLROOT XMLSCHEMA XMLSERIALIZE XMLTABLE XMLTEXT XMLVALIDATE YEAR YES ZONE
   '''.lower().split())
+  TERMS = LRU(4096)
+  FRAGMENTS = LRU(4096)
     
     
     
@@ -344,6 +432,20 @@ class SQLiteDialect(GenericDialect):
     RELEASE RENAME REPLACE RESTRICT RIGHT ROLLBACK ROW ROWS SAVEPOINT SELECT SET TABLE TEMP TEMPORARY THEN TIES TO TRANSACTION TRIGGER UNBOUNDED UNION UNIQUE UPDATE USING VACUUM VALUES VIEW 
     VIRTUAL WHEN WHERE WINDOW WITH WITHOUT
   '''.lower().split())
+  TERMS = LRU(4096)
+  FRAGMENTS = LRU(4096)
+  RETURNING = sqlite3 is not None and sqlite3.sqlite_version_info >= (3, 35, 0)
+  DEFAULT_IN_VALUES = False
+
+  def in_list(self, sql, args, values, negate):
+    # sqlite can't bind arrays, so the list is bound as json (see adapt())
+    sql.write(' not in (select value from json_each(' if negate else ' in (select value from json_each(')
+    sql.write(self.arg)
+    sql.write('))')
+    args.append(values)
+
+  def adapt(self, args):
+    return [json.dumps(a) if a.__class__ is list else a for a in args]
     
     
     
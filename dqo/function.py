@@ -1,6 +1,7 @@
 import copy
 
 from .column import PosColumn, NegColumn
+from .util import shape
 
 
 class Function:
@@ -26,6 +27,9 @@ class Function:
           args.append(component)
           sql.write(d.arg)
       sql.write(')')
+
+  def _shape_(self, args):
+    return (Function, self.name, None if self.args is None else tuple([shape(c, args) for c in self.args]))
     
   def __pos__(self):
     return PosColumn(self)
@@ -88,6 +92,33 @@ class CountFunction(Function):
     self.args = args
 
 
+class Param:
+  '''
+  A named placeholder for a value supplied later, when a prepared query is run.  See :py:func:`param`.
+  '''
+
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return 'param(%s)' % repr(self.name)
+
+
+def param(name):
+  '''
+  :param name: The keyword argument that will supply this value.
+
+  Returns a placeholder usable anywhere a value is accepted - ``where()``, ``set()``, ``limit()`` and function
+  arguments - for use with :py:meth:`Query.prepare`.  For example:
+
+  .. code-block:: python
+
+    by_email = User.ALL.where(email=dqo.param('email')).prepare()
+    user = by_email.first(email='me@here.com')
+  '''
+  return Param(name)
+
+
 class FunctionGenerator:
 
   def __getattr__(self, fn_name):
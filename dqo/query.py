@@ -1,12 +1,21 @@
-import asyncio, copy, enum, io
+import asyncio, copy, enum, functools, io, itertools, operator
 
-from .column import Column, PosColumn, NegColumn, Condition, InnerQuery
+from .column import Column, PosColumn, NegColumn, Condition, InnerQuery, InList, InTable
 from .database import Dialect
-from .connection import TLS
-from .function import sql, Function
-from .util import get_running_loop
+from .connection import TLS, Script
+from .function import sql, Function, Param
+from .util import get_running_loop, shape, LRU, Uncacheable, Chain, current_session
+from . import cache, columnar
 
 
+SQL_CACHE = LRU(maxsize=1024)
+'''
+  Compiled SQL keyed by the structural shape of a query (tables, selected columns, joins, condition operators, order, group,
+  limit and plus graph), but not its literal values.  A hit skips SQL generation entirely - only the values are re-collected
+  in the order their placeholders appear.  Inspect ``dqo.SQL_CACHE.stats`` for hit rates, or set ``dqo.SQL_CACHE.maxsize = 0``
+  to disable it.
+'''
+
 class CMD(enum.Enum):
   SELECT = 1
   INSERT = 2
@@ -16,34 +25,66 @@ class CMD(enum.Enum):
 
 class Query(object):
   
+  # every field is immutable (tuples, chains, an immutable plus tree) and shared between a query and the queries built
+  # from it, so copying a query never copies its contents
+  __slots__ = ('_tbl', '_db_', '_cmd', '_select', '_set_values', '_joins', '_conditions', '_limit', '_order_by', 
+               '_group_by', '_alias', '_plus', '_insert', '_mode', '_layout', '_cache')
+  
   def __init__(self, tbl):
     self._tbl = tbl
     self._db_ = None
     self._cmd = CMD.SELECT
     self._select = None
-    self._set_values = {}
-    self._joins = []
-    self._conditions = []
+    self._set_values = Chain.EMPTY
+    self._joins = Chain.EMPTY
+    self._conditions = Chain.EMPTY
     self._limit = None
     self._order_by = None
     self._group_by = None
     self._alias = None
-    self._plus = Plus()
+    self._plus = Plus.EMPTY
+    self._insert = None
+    self._mode = None
+    self._layout = None
+    self._cache = None
   
   def __copy__(self):
-    new = Query(self._tbl)
+    new = Query.__new__(Query)
+    new._tbl = self._tbl
     new._db_ = self._db_
     new._cmd = self._cmd
-    new._select = copy.copy(self._select)
-    new._set_values = copy.copy(self._set_values)
-    new._joins = copy.copy(self._joins)
-    new._conditions = copy.copy(self._conditions)
+    new._select = self._select
+    new._set_values = self._set_values
+    new._joins = self._joins
+    new._conditions = self._conditions
     new._limit = self._limit
-    new._order_by = copy.copy(self._order_by)
-    new._group_by = copy.copy(self._group_by)
+    new._order_by = self._order_by
+    new._group_by = self._group_by
     new._alias = self._alias
-    new._plus = copy.copy(self._plus)
+    new._plus = self._plus
+    new._insert = self._insert
+    new._mode = self._mode
+    new._layout = None
+    new._cache = self._cache
     return new
+
+  def __eq__(self, other):
+    if self is other: return True
+    if not isinstance(other, Query): return NotImplemented
+    try:
+      return self._db_ is other._db_ and self._alias == other._alias and self._mode == other._mode and self._key() == other._key()
+    except Uncacheable:
+      return False
+
+  def __hash__(self):
+    try:
+      return hash(self._key()[0])
+    except Uncacheable:
+      return id(self)
+  
+  def _key(self):
+    args = []
+    return self._shape_(args), args
     
   def __iter__(self):
     '''
@@ -56,7 +97,8 @@ class Query(object):
     
     If in a transaction or a with block defining the scope of the connection, the results will stream.  If a query
     has to open its own connection it will load all records before streaming.  This is because there is no 
-    guarantee an iterator will complete, and waiting for the garbage collector is a fool's game.
+    guarantee an iterator will complete, and waiting for the garbage collector is a fool's game.  Use 
+    :py:meth:`stream` to stream with a connection scoped to a with block instead.
     '''
     if self._select is None:
       self = copy. copy(self)
@@ -71,12 +113,124 @@ class Query(object):
     
       async for user in User.ALL:
         # do something asynchronously
+        
+    With ``asyncpg`` the results stream from a server side cursor, ``Database(prefetch=...)`` rows at a time (the next
+    batch is fetched while the current one is processed), so memory use doesn't grow with the size of the result.
+    The connection is held until iteration finishes - to stop early, use :py:meth:`stream`, or ``aclose()`` the
+    iterator:
+    
+    .. code-block:: python
+    
+      users = User.ALL.__aiter__()
+      async for user in users:
+        if done: break
+      await users.aclose()
     '''
     if self._select is None:
       self = copy. copy(self)
       self._select = self._tbl._dqoi_columns
     return AsyncIterable(self)
   
+  def stream(self, batch_size=None):
+    '''
+    Returns a context manager iterating over the query's results ``batch_size`` rows at a time, keeping its connection
+    until the block exits (even if iteration stops early).  With ``psycopg2`` and ``asyncpg`` this is a server side
+    cursor, otherwise ``fetchmany(batch_size)``, so large results are read in constant memory:
+    
+    .. code-block:: python
+    
+      with User.ALL.stream(batch_size=5000) as users:
+        for user in users:
+          # do something
+    
+    In async code:
+    
+    .. code-block:: python
+    
+      async with User.ALL.stream() as users:
+        async for user in users:
+          # do something
+          
+    If ``batch_size`` is ``None``, it's picked from the size of the rows fetched so far (about 1MB per batch).
+    '''
+    if self._select is None:
+      self = copy. copy(self)
+      self._select = self._tbl._dqoi_columns
+    return Stream(self, batch_size)
+  
+  def tuples(self):
+    '''
+    Returns a query whose results are the database library's rows as tuples, rather than row objects.  The cheapest way
+    to read a lot of rows:
+
+    .. code-block:: python
+
+      for id, name in User.ALL.select(User.id, User.name).tuples():
+        # do something
+    '''
+    return self._with_mode('tuples')
+
+  def dicts(self):
+    '''
+    Returns a query whose results are ``dicts`` of the selected columns, rather than row objects.
+
+    .. code-block:: python
+
+      >>> User.ALL.select(User.id, User.name).dicts().first()
+      {'id': 42, 'name': 'John'}
+    '''
+    return self._with_mode('dicts')
+
+  def scalars(self):
+    '''
+    Returns a query whose results are the values of the first selected column.
+
+    .. code-block:: python
+
+      >>> list(User.ALL.select(User.id).scalars())
+      [42, 43]
+    '''
+    return self._with_mode('scalars')
+
+  def lazy(self):
+    '''
+    Returns a query whose row objects keep the database library's row, and only copy each value out of it when it's 
+    first accessed.  For wide tables where only a few columns are read:
+
+    .. code-block:: python
+
+      for user in User.ALL.lazy():
+        print(user.email)
+    
+    Lazy rows otherwise behave like any other (they can be modified and saved).
+    '''
+    return self._with_mode('lazy')
+
+  def cached(self, ttl=60, key=None):
+    '''
+    Returns a query whose results are kept in the database's result cache for ``ttl`` seconds.  Anything reading rows
+    works, including :py:meth:`first`, :py:meth:`count` and :py:meth:`count_by`:
+
+    .. code-block:: python
+
+      >>> Order.ALL.where(status='open').cached(ttl=30).count()
+      12
+
+    Results are keyed by their SQL and arguments (under ``key`` too, if given - a namespace, so :py:meth:`count` and the
+    rows of the same query still get their own entries), and store the driver's rows, so every hit builds new row
+    objects.  Every insert, update or delete through dqo to a table the query read (its own, those it joins, those
+    followed by :py:meth:`plus` and those in subqueries of its conditions) stops the results being used.  Writes made
+    any other way aren't seen until ``ttl`` expires.
+    '''
+    self = copy.copy(self)
+    self._cache = (ttl, key)
+    return self
+
+  def _with_mode(self, mode):
+    self = copy.copy(self)
+    self._mode = mode
+    return self
+
   def select(self, *columns):
     '''
     :param columns: One or more columns to select.
@@ -124,11 +278,11 @@ class Query(object):
     if select and (unselect or alsoselect):
       raise ValueError('You must either select a set of columns (MyTable.col) or a set of selection modifiers (+MyTable.col / -MyTable.col), you cannot mix the two.')
     if unselect:
-      self._select = [c for c in self._select if c.name not in unselect]
+      self._select = tuple([c for c in self._select if c.name not in unselect])
     elif alsoselect:
-      self._select += [c for c in alsoselect if c.name not in existing]
+      self._select = tuple(self._select) + tuple([c for c in alsoselect if c.name not in existing])
     else:
-      self._select = select
+      self._select = tuple(select)
     return self
 
   def group_by(self, *columns):
@@ -154,11 +308,11 @@ class Query(object):
     if select and (unselect or alsoselect):
       raise ValueError('You must either select a set of columns (MyTable.col) or a set of selection modifiers (+MyTable.col / -MyTable.col), you cannot mix the two.')
     if unselect:
-      self._group_by = [c for c in self._select if c.name not in unselect]
+      self._group_by = tuple([c for c in self._select if c.name not in unselect])
     elif alsoselect:
-      self._group_by += [c for c in alsoselect if c.name not in existing]
+      self._group_by = tuple(self._group_by or ()) + tuple([c for c in alsoselect if c.name not in existing])
     else:
-      self._group_by = select
+      self._group_by = tuple(select)
     return self
     
   
@@ -210,11 +364,10 @@ class Query(object):
     When using the ``&`` and ``|`` operators, make sure you wrap the condition in parentheses as they have
     lower precedence than others like ``==``.
     '''
-    conditions = list(conditions)
     self = copy. copy(self)
+    self._conditions = self._conditions.extend(conditions)
     for name, value in kwargs.items():
-      conditions.append(getattr(self._tbl, name)==value)
-    self._conditions += conditions
+      self._conditions = self._conditions.append(getattr(self._tbl, name)==value)
     return self
     
   def plus(self, *foreign_keys):
@@ -229,6 +382,9 @@ class Query(object):
         "Person" -> "Company";
         "Company" -> "Industry";
       }
+    
+    (Where ``Person.employer = dqo.ForeignKey(Company.id, related_name='employees')``, and ``Company.industry`` is
+    likewise named ``companies``.)
        
     If I want to query all people with their employer:
     
@@ -274,26 +430,37 @@ class Query(object):
       for industry in q:
         print(industry)
         for company in industry.companies:
-          print('\\t', industry.company)
+          print('\\t', company)
           for person in company.employees:
             print('\\t\\t', person)
             
     Every call to this method represents a path in the object graph to be queried, and they can be as long as you wish.
     If some paths overlap, the individual legs will not be duplicated in the resulting query.
     
-    **None of these calls will generate O(n) database lookups.**
+    Joined rows are hydrated once per result set: every person working for the same company shares one ``Company``
+    object (``p1.employer is p2.employer``).  A foreign key that's null (or matches nothing) gives ``None``.
+    
+    Following a foreign key backwards (one-to-many, like ``company.employees``) doesn't join, which would repeat every
+    company once per employee.  Instead, once the companies are loaded, one more query fetches the employees of all of 
+    them (``where employer_id in (...)``) and each company gets a list of its own.  Each employee's ``employer`` is set
+    to its company.
+    
+    **None of these calls will generate O(n) database lookups.**  Each one-to-many leg costs one query, however many
+    rows are returned (or one per 1000 rows when streamed).
     '''
     self = copy.copy(self)
-    plus = self._plus
     tbl = self._tbl
+    path = []
     for fk in foreign_keys:
       if fk.frm[0].tbl == tbl:
         tbl = fk.to[0].tbl
-        plus = plus[fk]
+        path.append((fk, False))
       elif fk.to[0].tbl == tbl:
-        raise Exception('not implemented yet')
+        tbl = fk.frm[0].tbl
+        path.append((fk, True))
       else:
-        raise Esception('This foreign key has no relation to %s' % tbl)
+        raise Exception('This foreign key has no relation to %s' % tbl)
+    self._plus = self._plus.add(path)
     return self
     
   def left_join(self, other, on=None):
@@ -301,7 +468,7 @@ class Query(object):
     Performs a left join.
     '''
     self = copy.copy(self)
-    self._joins.append(Join('left', other, on))
+    self._joins = self._joins.append(Join('left', other, on))
     return self
     
   def right_join(self, other, on=None):
@@ -309,7 +476,7 @@ class Query(object):
     Performs a right join.
     '''
     self = copy.copy(self)
-    self._joins.append(Join('right', other, on))
+    self._joins = self._joins.append(Join('right', other, on))
     return self
     
   def inner_join(self, other, on=None):
@@ -317,7 +484,7 @@ class Query(object):
     Performs an inner join.
     '''
     self = copy.copy(self)
-    self._joins.append(Join('inner', other, on))
+    self._joins = self._joins.append(Join('inner', other, on))
     return self
     
   def full_outer_join(self, other, on=None):
@@ -325,7 +492,7 @@ class Query(object):
     Performs a full outer join.
     '''
     self = copy.copy(self)
-    self._joins.append(Join('full outer', other, on))
+    self._joins = self._joins.append(Join('full outer', other, on))
     return self
   
   def as_(self, s):
@@ -360,7 +527,7 @@ class Query(object):
       to_delete.delete()
     '''
     self = copy. copy(self)
-    self._order_by = columns
+    self._order_by = tuple(columns)
     return self
     
   def bind(self, db_or_tx):
@@ -380,6 +547,35 @@ class Query(object):
     self._db_ = db_or_tx
     return self
   
+  def prepare(self):
+    '''
+    :returns: A :py:class:`PreparedQuery`.
+    
+    Compiles a query once so it can be run many times with different values, skipping all query building work at call
+    time.  Values to be supplied later are marked with :py:func:`dqo.param`.  For example:
+    
+    .. code-block:: python
+    
+      by_name = User.ALL.where(name=dqo.param('name')).limit(dqo.param('n')).prepare()
+      for user in by_name(name='John', n=10):
+        # do something
+      user = by_name.first(name='Paul', n=1)
+
+    In async code:
+    
+    .. code-block:: python
+    
+      users = await by_name(name='John', n=10)
+      
+    Updates and deletes work the same way:
+    
+    .. code-block:: python
+    
+      rename = User.ALL.where(id=dqo.param('id')).set(name=dqo.param('name')).prepare()
+      rename.update(id=1, name='John')
+    '''
+    return PreparedQuery(self)
+  
   def first(self):
     '''
     :returns: An instance of the selected type or ``None`` if not found.
@@ -404,15 +600,13 @@ class Query(object):
       sql, args = self._sql()
       keys = [c._name for c in self._select]
       async def f():
-        async with self._db.connection() as conn:
-          data = await conn.async_fetch(sql, args)
-          if data:
-            row = data[0]
-            o = self._tbl()
-            o.__dict__.update(dict(zip(keys, row)))
-            return o
-          else:
-            return None
+        data = await self._async_fetch_all(sql, args)
+        if not data:
+          return None
+        o = self._build(keys, data[0], self._identity_map())
+        if self._one_to_many():
+          await self._async_related([o])
+        return o
       return f()
     else:
       values = list(self)
@@ -458,7 +652,7 @@ class Query(object):
     Equivalent to ``.limit(10)``. 
     '''
     self = copy. copy(self)
-    self._set_values.update(kwargs)
+    self._set_values = self._set_values.extend(kwargs.items())
     return self
       
   def delete(self):
@@ -488,7 +682,7 @@ class Query(object):
       42
     '''
     self = copy. copy(self)
-    self._select = [sql.count(sql(1))]
+    self._select = (sql.count(sql(1)),)
     return self._fetch_scalar()
 
   def count_by(self, *columns):
@@ -508,16 +702,119 @@ class Query(object):
       {('John','Smith'):1, ('Paul','Anderson'):2}
     '''
     self = copy.copy(self)
-    self._select = list(columns) + [sql.count(sql(1))]
+    self._select = columns + (sql.count(sql(1)),)
     self._group_by = columns
-    return self._fetch_map(len(columns))
+    return self._fetch_map(self._key_getter(range(len(columns))), operator.itemgetter(len(columns)))
+
+  def index_by(self, *columns):
+    '''
+    :returns: A ``dict`` of the query's results keyed by the value(s) of the given column(s).
+
+    .. code-block:: python
+
+      >>> User.ALL.index_by(User.email)
+      {'me@here.org': <User id=42 ...>, 'paul@here.org': <User id=43 ...>}
+
+    If multiple columns are passed, the keys will be tuples.  The values are whatever iterating over the query would
+    return, so ``User.ALL.select(User.id, User.name).tuples().index_by(User.id)`` is a ``dict`` of tuples.
+    Later rows replace earlier ones with the same key.
+    '''
+    return self._keyed(columns, False)
+
+  def group_into(self, *columns):
+    '''
+    :returns: A ``dict`` of lists of the query's results, grouped by the value(s) of the given column(s).
+
+    .. code-block:: python
+
+      >>> User.ALL.group_into(User.last_name)
+      {'Smith': [<User id=42 ...>, <User id=44 ...>], 'Anderson': [<User id=43 ...>]}
+    '''
+    return self._keyed(columns, True)
+
+  def to_columns(self, batch_size=10000):
+    '''
+    :returns: A ``dict`` of NumPy arrays, one per selected column (or function).
+
+    Results are fetched ``batch_size`` rows at a time into preallocated arrays, without creating a Python object per row.
+    Array types follow each column's type (``int`` → ``int64``, ``float`` → ``float64``, ``datetime`` → 
+    ``datetime64``, anything else ``object``); for functions they follow the values (ints widen to floats if need be,
+    and other mixes are ``object``).  Columns with nulls are returned as masked arrays.
+
+    .. code-block:: python
+
+      >>> Order.ALL.select(Order.customer_id, dqo.sql.sum(Order.total)).group_by(Order.customer_id).to_columns()
+      {'customer_id': array([1, 2, 3]), 'sum': array([10.5, 3.0, 7.25])}
+
+    Requires ``numpy``.  In async code, ``await`` it.
+    '''
+    return self._columns(batch_size, columnar.Columns.arrays_by_name)
+
+  def to_numpy(self, batch_size=10000):
+    '''
+    :returns: A NumPy structured array with a field per selected column (masked if any had nulls).
+
+    Like :py:meth:`to_columns`, but as a single array of records:
+
+    .. code-block:: python
+
+      >>> data = User.ALL.select(User.id, User.age).to_numpy()
+      >>> data['age'].mean()
+      37.2
+    '''
+    return self._columns(batch_size, columnar.Columns.structured)
+
+  def _columns(self, batch_size, f):
+    np = columnar.import_numpy()
+    if self._select is None:
+      self = copy. copy(self)
+      self._select = self._tbl._dqoi_columns
+    sql, args = self._sql()
+    names = [c._name for c in self._select]
+    dtypes = [columnar.dtype_for(c.kind, getattr(c, 'tz', False)) if isinstance(c, Column) else None for c in self._select]
+    columns = columnar.Columns(np, names, dtypes, batch_size)
+    if get_running_loop():
+      async def g():
+        async with self._db.connection() as conn:
+          batch = []
+          async for row in conn.async_stream(sql, args, batch_size):
+            batch.append(row)
+            if len(batch)==batch_size:
+              columns.add(batch)
+              batch = []
+          columns.add(batch)
+        return f(columns)
+      return g()
+    with self._conn_or_tx_sync as conn:
+      for batch in columnar.batches(conn.sync_stream(sql, args, batch_size), batch_size):
+        columns.add(batch)
+    return f(columns)
+
+  def _keyed(self, columns, group):
+    if not columns: raise ValueError('at least one column is required')
+    n = len(self._select or self._tbl._dqoi_columns)
+    # key columns that aren't selected are added (after the others)
+    self = self.select(*[+c for c in columns])
+    names = [c.name for c in self._select]
+    keys = [c._name for c in self._select]
+    value = functools.partial(self._build, keys, identity=self._identity_map())
+    if self._mode in ('tuples', 'dicts', 'scalars') and len(keys) > n:
+      # but not to the tuples (or dicts) returned, which keep the shape iterating gives
+      build, keys = self._build, keys[:n]
+      value = lambda row: build(keys, tuple(row)[:n])
+    return self._fetch_map(self._key_getter([names.index(c.name) for c in columns]), value, group, self._one_to_many())
+
+  def _key_getter(self, indexes):
+    indexes = list(indexes)
+    if len(indexes)==1: return operator.itemgetter(indexes[0])
+    return lambda row: tuple([row[i] for i in indexes])
 
-  def _fetch_map(self, len_keys):
+  def _fetch_map(self, key, value, group=False, related=False):
     sql, args = self._sql()
     if get_running_loop():
-      return self._async_fetch_map(sql, args, len_keys)
+      return self._async_fetch_map(sql, args, key, value, group, related)
     else: 
-      return self._sync_fetch_map(sql, args, len_keys)
+      return self._sync_fetch_map(sql, args, key, value, group, related)
 
   @property
   def _conn_or_tx_sync(self):
@@ -530,19 +827,17 @@ class Query(object):
   def _conn_or_tx_async(self):
     return self._db.connection()
 
-  def _sync_fetch_map(self, sql, args, len_keys):
-    with self._conn_or_tx_sync as conn:
-      data = list(conn.sync_fetch(sql, args))
-      if len_keys > 1:
-        data = [(tuple(r[:len_keys]),r[len_keys]) for r in data]
-      return dict(data)
+  def _sync_fetch_map(self, sql, args, key, value, group, related):
+    ret = to_map(self._sync_fetch_all(sql, args), key, value, group)
+    if related:
+      self._sync_related(map_values(ret, group))
+    return ret
         
-  async def _async_fetch_map(self, sql, args, len_keys):
-    async with self._conn_or_tx_async as conn:
-      data = await conn.async_fetch(sql, args)
-      if len_keys > 1:
-        data = [(tuple(r[:len_keys]),r[len_keys]) for r in data]
-      return dict(data)
+  async def _async_fetch_map(self, sql, args, key, value, group, related):
+    ret = to_map(await self._async_fetch_all(sql, args), key, value, group)
+    if related:
+      await self._async_related(map_values(ret, group))
+    return ret
       
   def _fetch_scalar(self):
     sql, args = self._sql()
@@ -552,14 +847,128 @@ class Query(object):
       return self._sync_fetch_scalar(sql, args)
 
   def _sync_fetch_scalar(self, sql, args):
-    with self._conn_or_tx_sync as conn:
-      data = list(conn.sync_fetch(sql, args))
-      return data[0][0] if data and data[0] else None
+    data = self._sync_fetch_all(sql, args)
+    return data[0][0] if data and data[0] else None
         
   async def _async_fetch_scalar(self, sql, args):
+    data = await self._async_fetch_all(sql, args)
+    return data[0][0] if data and data[0] else None
+
+  def _sync_fetch_all(self, sql, args):
+    # every row of a select - from the table's replica (cache='full') or the result cache (cached()), if possible
+    local = self._local()
+    if local is not None:
+      replica, matches, positions = local
+      if replica.stale:
+        q = self._everything()
+        replica.load(q._sync_fetch(*q._sql()))
+      return replica.select(matches, positions, self._limit)
+    return self._sync_fetch(sql, args)
+
+  async def _async_fetch_all(self, sql, args):
+    local = self._local()
+    if local is not None:
+      replica, matches, positions = local
+      if replica.stale:
+        q = self._everything()
+        replica.load(await q._async_fetch(*q._sql()))
+      return replica.select(matches, positions, self._limit)
+    return await self._async_fetch(sql, args)
+
+  def _sync_fetch(self, sql, args):
+    entry = self._cache_entry(sql, args)
+    rows = None if entry is None else cached_rows(entry)
+    if rows is None:
+      with self._conn_or_tx_sync as conn:
+        rows = list(conn.sync_fetch(sql, args))
+      if entry is not None: cache_rows(entry, rows)
+    return rows
+
+  async def _async_fetch(self, sql, args):
+    entry = self._cache_entry(sql, args)
+    rows = None if entry is None else cached_rows(entry)
+    if rows is None:
+      flights = self._db.single_flight
+      if flights is None:
+        rows = await self._async_query(sql, args)
+      else:
+        rows = await flights.run(result_key(sql, args), functools.partial(self._async_query, sql, args))
+      if entry is not None: cache_rows(entry, rows)
+    return rows
+
+  async def _async_query(self, sql, args):
     async with self._conn_or_tx_async as conn:
-      data = await conn.async_fetch(sql, args)
-      return data[0][0] if data and data[0] else None
+      return await conn.async_fetch(sql, args)
+
+  def _buffered(self):
+    # if rows come from a cache, rather than streaming from the connection
+    return self._cache is not None or getattr(self._tbl, '_dqoi_cache', None).__class__ is cache.Replica
+
+  def _local(self):
+    # (replica, matches, positions) if the table's in memory replica can answer the query - a select of its columns
+    # with only equality and in_() list conditions
+    replica = getattr(self._tbl, '_dqoi_cache', None)
+    if replica.__class__ is not cache.Replica or self._cmd!=CMD.SELECT: return None
+    if self._joins or self._plus.children or self._group_by or self._order_by or self._alias: return None
+    if self._limit is not None and self._limit.__class__ is not int: return None
+    positions = [replica.position(c) for c in self._select or self._tbl._dqoi_columns]
+    if None in positions: return None
+    matches = {}
+    conditions = list(self._conditions)
+    while conditions:
+      c = conditions.pop()
+      if c.__class__ is Condition and c._join=='and':
+        conditions.extend(c._components)
+        continue
+      if c.__class__ is Condition and c._join=='=':
+        column, values = c._components
+        values = [values]
+      elif c.__class__ is InList and not c.negate and isinstance(c.values, list):
+        column, values = c.column, c.values
+      else:
+        return None
+      p = replica.position(column)
+      if p is None or any([hasattr(v, '_sql_') or not same_kind(column.kind, v) for v in values]): return None
+      # null never equals anything
+      values = [v for v in values if v is not None]
+      matches[p] = [v for v in matches[p] if v in values] if p in matches else values
+    return replica, matches, positions
+
+  def _everything(self):
+    # every column of every row, to load the table's replica
+    q = Query(self._tbl)
+    q._db_ = self._db_
+    q._select = self._tbl._dqoi_columns
+    return q
+
+  def _cache_entry(self, sql, args):
+    # (backend, key, ttl, generations of the tables read) for a cached() select
+    if self._cache is None: return None
+    ttl, key = self._cache
+    backend = self._db.result_cache
+    # a user's key only namespaces the statement's - count(), first() etc. of the query read different rows
+    key = result_key(sql, args) if key is None else (key, result_key(sql, args))
+    return backend, key, ttl, tuple([backend.generation(name) for name in self._tables()])
+
+  def _tables(self):
+    # the names of every table read, sorted
+    tables = set()
+    self._add_tables(tables)
+    return sorted(tables)
+
+  def _add_tables(self, tables):
+    tables.add(self._tbl._dqoi_db_name)
+    conditions = list(self._conditions)
+    for join in self._joins:
+      if isinstance(join.other, Query): join.other._add_tables(tables)
+      else: tables.add(getattr(join.other, 'tbl', join.other)._dqoi_db_name)
+      if join.on is not None: conditions.append(join.on)
+    self._plus.add_tables(tables)
+    while conditions:
+      c = conditions.pop()
+      if isinstance(c, Query): c._add_tables(tables)
+      elif c.__class__ is InnerQuery and isinstance(c.query, Query): c.query._add_tables(tables)
+      elif isinstance(c, Condition): conditions.extend(c._components)
       
   def update(self):
     '''
@@ -607,9 +1016,9 @@ class Query(object):
       raise ValueError('please pass in only one argument (a list of instances or dicts)')
     if instances and data:
       raise ValueError('please pass in only a list or kwargs, not both')
-    if instances:
+    if instances is not None:
       self._cmd = CMD.INSERT_MANY
-      self._insert = instances
+      self._insert = list(instances)
     else:
       self._cmd = CMD.INSERT
       self._insert = data
@@ -622,15 +1031,17 @@ class Query(object):
             return rows[0][0] if rows else None
           else:
             return tuple(rows[0]) if rows else None
+        elif len(self._tbl._dqoi_pk.columns)==1:
+          return [row[0] for row in rows]
         else:
-          return list(rows)
+          return [tuple(row) for row in rows]
       if get_running_loop():
         if not self._insert and self._cmd == CMD.INSERT_MANY:
-          return self._noop([] if instances else None)
+          return self._noop([])
         return self._async_fetch_f(sql, args, f, insert_table=self._tbl)
       else: 
         if not self._insert and self._cmd == CMD.INSERT_MANY:
-          return [] if instances else None
+          return []
         return self._sync_fetch_f(sql, args, f, insert_table=self._tbl)
     else:
       return self._execute()
@@ -639,9 +1050,15 @@ class Query(object):
     return ret
   
   def _sync_fetch_f(self, sql, args, f, insert_table=None):
+    try:
+      return self._sync_fetch_f_(sql, args, f, insert_table)
+    finally:
+      if insert_table: self._written()
+
+  def _sync_fetch_f_(self, sql, args, f, insert_table):
     with self._conn_or_tx_sync as conn:
       rows = conn.sync_fetch(sql, args)
-      if insert_table and self._dialect()==Dialect.SQLITE:
+      if insert_table and self._cmd==CMD.INSERT and self._dialect()==Dialect.SQLITE:
         holder = {}
         def f_cur(cur):
           sql, args = insert_table.ALL._sql()
@@ -656,8 +1073,16 @@ class Query(object):
         return f(conn.sync_fetch(sql, args))
   
   async def _async_fetch_f(self, sql, args, f, insert_table=None):
-    async with self._conn_or_tx_sync as conn:
-      return f(await conn.async_fetch(sql, args))
+    async with self._conn_or_tx_async as conn:
+      if insert_table and self._cmd==CMD.INSERT and self._dialect()==Dialect.SQLITE:
+        # no "returning" - look the primary key up by rowid
+        rowid = await conn.async_lastrowid(sql, args)
+        sql, args = insert_table.ALL.select(*insert_table._dqoi_pk.columns)._sql()
+        sql += ' where rowid=?'
+        args.append(rowid)
+      ret = f(await conn.async_fetch(sql, args))
+    if insert_table: self._written()
+    return ret
   
   def _execute(self):
     sql, args = self._sql()
@@ -668,11 +1093,44 @@ class Query(object):
   
   def _sync_execute(self, sql, args):
     with self._conn_or_tx_sync as conn:
-      return conn.sync_execute(sql, args)
+      ret = conn.sync_execute(sql, args)
+    self._written()
+    return ret
         
   async def _async_execute(self, sql, args):
     async with self._conn_or_tx_async as conn:
-      return await conn.async_execute(sql, args)
+      ret = await conn.async_execute(sql, args)
+    self._written()
+    return ret
+
+  def _written(self):
+    # tells caches the table changed - and which rows, when the conditions pin down primary keys
+    if self._cmd in (CMD.INSERT, CMD.INSERT_MANY):
+      cache.written(self._tbl, (), self._db)
+    elif self._cmd in (CMD.UPDATE, CMD.DELETE):
+      cache.written(self._tbl, self._where_pks(), self._db)
+
+  def _where_pks(self):
+    pk = self._tbl._dqoi_pk
+    if not pk: return None
+    # columns define __eq__, so are found by id
+    positions = {id(c):i for i, c in enumerate(pk.columns)}
+    values = {}
+    conditions = list(self._conditions)
+    while conditions:
+      cond = conditions.pop()
+      if cond.__class__ is Condition and cond._join=='and':
+        conditions.extend(cond._components)
+      elif cond.__class__ is Condition and cond._join=='=' and id(cond._components[0]) in positions:
+        value = cond._components[1]
+        if not hasattr(value, '_sql_'):
+          values[positions[id(cond._components[0])]] = [value]
+      elif cond.__class__ is InList and not cond.negate and id(cond.column) in positions and isinstance(cond.values, list):
+        values[positions[id(cond.column)]] = cond.values
+    if len(values) < len(pk.columns): return None
+    if len(pk.columns)==1: return values[0]
+    # every combination of the values each column is pinned to
+    return list(itertools.product(*[values[i] for i in range(len(pk.columns))]))
     
   @property
   def _db(self):
@@ -693,11 +1151,88 @@ class Query(object):
   
   def _sql(self):
     db = self._db
-    dialect = self._dialect()
+    dialect = db.dialect if db else Dialect.GENERIC
+    for c in self._conditions:
+      if c.__class__ is InList and c.strategy in InList.SCRIPTED:
+        return self._script(dialect), []
+    args = []
+    try:
+      key = (dialect.__class__, dialect.lib, self._shape_(args))
+    except Uncacheable:
+      return self._compile(dialect.for_query())
+    sql = SQL_CACHE.get(key)
+    if sql is None:
+      sql, args = self._compile(dialect.for_query())
+      SQL_CACHE.put(key, sql)
+      return sql, args
+    return sql, dialect.adapt(args)
+  
+  def _script(self, dialect):
+    # top level in_() lists too long to bind, run chunk by chunk or against temp tables
+    lists = [c for c in self._conditions if c.__class__ is InList and c.strategy in InList.SCRIPTED]
+    chunked = [c for c in lists if c.strategy=='chunked']
+    if chunked and self._chunkable():
+      c = chunked[0]
+      n = InList.THRESHOLD
+      return Script([self._replace(c, InList(c.column, c.values[i:i+n]))._sql() for i in range(0, len(c.values), n)])
+    setup, teardown, q = [], [], self
+    for i, c in enumerate(lists):
+      name = 'dqo_in_%i' % (i+1)
+      d = dialect.for_query()
+      setup.append(('drop table if exists %s' % name, None, None))
+      setup.append(('create temp table %s as select %s as value from %s where 1=0' % (name, d.term(c.column.name), d.term(c.column.tbl._dqoi_db_name)), None, None))
+      setup.append(('insert into %s (value) values (%s)' % (name, d.arg), [(v,) for v in c.values], name))
+      teardown.append('drop table %s' % name)
+      q = q._replace(c, InTable(c.column, name, c.negate))
+    return Script([q._sql()], setup, teardown)
+
+  def _chunkable(self):
+    # only when concatenating each chunk's results gives the same answer as one query
+    if self._cmd in (CMD.UPDATE, CMD.DELETE): return True
+    if self._cmd!=CMD.SELECT or self._limit is not None or self._order_by or self._group_by: return False
+    return not any([isinstance(c, Function) for c in self._select or ()])
+
+  def _replace(self, condition, replacement):
+    self = copy.copy(self)
+    self._conditions = Chain.EMPTY.extend([replacement if c is condition else c for c in self._conditions])
+    return self
+
+  def _compile(self, dialect):
     sql = io.StringIO()
     args = []
     self._sql_(dialect, sql, args)
-    return sql.getvalue(), args
+    return sql.getvalue(), dialect.adapt(args)
+  
+  def _shape_(self, args):
+    if self._cmd==CMD.SELECT:
+      return self._select_shape_(args)
+    if self._cmd==CMD.INSERT:
+      to_insert = [k for k in self._insert if not k.startswith('_')]
+      args.extend([self._insert[k] for k in to_insert])
+      return (CMD.INSERT, self._tbl, tuple(to_insert))
+    if self._cmd==CMD.UPDATE:
+      set_values = dict(self._set_values)
+      args.extend(set_values.values())
+      return (CMD.UPDATE, self._tbl, tuple(set_values), self._where_shape_(args))
+    if self._cmd==CMD.DELETE:
+      return (CMD.DELETE, self._tbl, self._where_shape_(args))
+    raise Uncacheable(self._cmd)
+  
+  def _select_shape_(self, args):
+    # must collect args in the same order as _select_sql_()
+    components = self._tbl._dqoi_columns if self._select is None else self._select
+    select = tuple([shape(c, args) for c in components])
+    joins = tuple([join._shape_(args) for join in self._joins])
+    plus = self._plus._shape_()
+    where = self._where_shape_(args)
+    group_by = tuple([shape(c, args) for c in self._group_by]) if self._group_by else None
+    order_by = tuple([shape(c, args) for c in self._order_by]) if self._order_by else None
+    if self._limit is not None:
+      args.append(self._limit)
+    return (CMD.SELECT, self._tbl, select, joins, plus, where, group_by, order_by, self._limit is not None)
+  
+  def _where_shape_(self, args):
+    return tuple([shape(c, args) for c in self._conditions])
   
   def _sql_(self, d, sql, args):
     if self._cmd==CMD.SELECT:
@@ -714,11 +1249,11 @@ class Query(object):
   def _select_sql_(self, d, sql, args):
     self._register_tables(d)
     sql.write('select ')
-    self._gen_select(d, sql, args)
+    aliases = self._gen_select(d, sql, args)
     sql.write(' from ')
     self._tbl._sql_(d, sql, args)
     self._gen_joins(d, sql, args)
-    self._gen_plus_joins(d, sql, args)
+    self._gen_plus_joins(d, sql, args, aliases)
     self._gen_where(d, sql, args)
     if self._group_by:
       sql.write(' group by ')
@@ -743,18 +1278,19 @@ class Query(object):
    for join in self._joins:
     join._sql_(d, sql, args)
   
-  def _gen_plus_joins(self, d, sql, args):
-    self._plus._sql_(d, sql, args)
+  def _gen_plus_joins(self, d, sql, args, aliases):
+    self._plus._sql_(d, sql, args, self._tbl, aliases)
   
   def _update_sql_(self, d, sql, args):
     sql.write('update ')
     sql.write(d.term(self._tbl._dqoi_db_name))
     sql.write(' set ')
     first = True
-    for k,v in self._set_values.items():
+    for k,v in dict(self._set_values).items():
       if first: first = False
       else: sql.write(', ')
-      sql.write(d.term(k))
+      column = self._tbl._dqoi_columns_by_attr_name.get(k)
+      sql.write(d.term(column.name if column else k))
       sql.write('=')
       args.append(v)
       sql.write(d.arg)
@@ -785,11 +1321,38 @@ class Query(object):
       sql.write(','.join([c.name for c in self._tbl._dqoi_pk.columns]))
       
   def _insert_many_sql_(self, d, sql, args):
-    if not to_insert:
+    rows = [row if isinstance(row, dict) else row._values() for row in self._insert]
+    keys = list(dict.fromkeys([k for row in rows for k in row if not k.startswith('_')]))
+    if not rows:
       # don't fail inserting no rows
       sql.write('select 1 where 1=2')
       return
-    raise Exception('TODO')
+    if not keys:
+      raise ValueError('inserting multiple rows requires at least one value')
+    if not d.DEFAULT_IN_VALUES and any([k not in row for row in rows for k in keys]):
+      raise ValueError('all rows inserted at once need the same keys with %s' % d.__class__.__name__)
+    sql.write('insert into ')
+    sql.write(d.term(self._tbl._dqoi_db_name))
+    sql.write(' (')
+    sql.write(','.join([d.term(self._tbl._dqoi_columns_by_attr_name[k].name) for k in keys]))
+    sql.write(') values ')
+    first = True
+    for row in rows:
+      if first: first = False
+      else: sql.write(',')
+      sql.write('(')
+      values = []
+      for k in keys:
+        if k in row:
+          args.append(row[k])
+          values.append(d.arg)
+        else:
+          values.append('default')
+      sql.write(','.join(values))
+      sql.write(')')
+    if self._tbl._dqoi_pk and d.RETURNING:
+      sql.write(' returning ')
+      sql.write(','.join([c.name for c in self._tbl._dqoi_pk.columns]))
       
   def _delete_sql_(self, d, sql, args):
     sql.write('delete from ')
@@ -797,93 +1360,460 @@ class Query(object):
     self._gen_where(d, sql, args)
             
   def _gen_select(self, d, sql, args):
-    components = list(self._tbl._dqoi_columns) if self._select is None else self._select
-    self._plus.gen_select(d, self._tbl, components)
-    first = True
-    for component in components:
-      if first: first = None
-      else: sql.write(',')
-      if hasattr(component,'_sql_'):
-        component._sql_(d, sql, args)
-      else:
-        sql.write(d.arg)
-        args.append(component)
+    tbl = self._tbl
+    if self._select is None or self._select is tbl._dqoi_columns:
+      sql.write(columns_sql(d, tbl, d.registered.get(tbl)))
+      first = not tbl._dqoi_columns
+    else:
+      first = True
+      for component in self._select:
+        if first: first = None
+        else: sql.write(',')
+        if hasattr(component,'_sql_'):
+          component._sql_(d, sql, args)
+        else:
+          sql.write(d.arg)
+          args.append(component)
+    return self._plus.gen_select(d, sql, first)
     
   def _gen_where(self, d, sql, args):
     if not self._conditions: return
     sql.write(' where ')
-    condition = self._conditions[0] if len(self._conditions)==1 else Condition('and', self._conditions)
+    conditions = list(self._conditions)
+    condition = conditions[0] if len(conditions)==1 else Condition('and', conditions)
     condition._sql_(d, sql, args)
   
-  def _build(self, keys, row):
-    o = self._tbl()
-    o.__dict__.update(dict(zip(keys[:self._plus.i], row[:self._plus.i])))
-    self._plus.build(o, keys, row)
+  def _build(self, keys, row, identity=None):
+    layout = self._layout
+    if layout is None:
+      layout = self._layout = self._loader(keys)
+    load, plus, siblings, key = layout
+    if identity is None:
+      identity = {}
+    if key is not None and identity.__class__ is not dict:
+      # a session's identity map shares the rows queried too
+      k = key(row)
+      o = identity.get(k)
+      if o is None: o = identity[k] = load(row)
+    else:
+      o = load(row)
+    if plus:
+      Plus.build(plus, o, row, identity)
+    if siblings:
+      # lazy foreign keys are loaded for every row of the result set at once
+      rows = identity.get(siblings)
+      if rows is None:
+        rows = identity[siblings] = Siblings()
+        rows.db = self._db_
+      rows.append(o)
+      o.__dict__['_dqoi_rows'] = rows
     return o
+
+  def _identity_map(self):
+    # rows joined in with plus() are shared within a result set (or session), keyed by (table, primary key)
+    session = current_session(self._db)
+    return {} if session is None else session.identity
+
+  def _one_to_many(self):
+    return self._plus.many and self._mode in (None, 'lazy')
+
+  def _sync_related(self, objs):
+    # one more query per one-to-many plus() leg
+    for q, attach in self._plus.related(objs, self._mode=='lazy'):
+      q._db_ = self._db_
+      # keyed by their own SQL - not a cached(key=...) meant for the parent rows
+      if self._cache: q._cache = (self._cache[0], None)
+      attach(list(q))
+    return objs
+
+  async def _async_related(self, objs):
+    for q, attach in self._plus.related(objs, self._mode=='lazy'):
+      q._db_ = self._db_
+      # keyed by their own SQL - not a cached(key=...) meant for the parent rows
+      if self._cache: q._cache = (self._cache[0], None)
+      attach([o async for o in q])
+    return objs
+
+  def _loader(self, keys):
+    # how to turn a driver row into a result, and the plus() layout (only row objects get joined rows)
+    if self._mode=='tuples': return tuple, None, None, None
+    if self._mode=='dicts': return (lambda row: dict(zip(keys, row))), None, None, None
+    if self._mode=='scalars': return operator.itemgetter(0), None, None, None
+    lazy = self._mode=='lazy'
+    tbl = self._tbl
+    # per database, as they're loaded from the one they came from
+    siblings = ('rows', tbl, self._db_) if tbl._dqoi_lazy_fks else None
+    key = None
+    if tbl._dqoi_pk and all([c._name in keys for c in tbl._dqoi_pk.columns]):
+      key = functools.partial(identity_key, tbl, operator.itemgetter(*[keys.index(c._name) for c in tbl._dqoi_pk.columns]))
+    return tbl._dqoi_row._loader(keys, lazy=lazy), self._plus.layout(len(keys), lazy=lazy), siblings, key
+
+
+
+def to_map(rows, key, value, group):
+  if not group:
+    return {key(row):value(row) for row in rows}
+  ret = {}
+  for row in rows:
+    k = key(row)
+    if k in ret: ret[k].append(value(row))
+    else: ret[k] = [value(row)]
+  return ret
+
+
+def result_key(sql, args):
+  # identifies a select's results
+  if sql.__class__ is Script:
+    args = [a for step_sql, a in sql.steps] + [rows for setup_sql, rows, table in sql.setup]
+  return '%s %r' % (sql, args)
+
+
+def same_kind(kind, value):
+  # whether python's == compares value to a column's values like the database would - '1' doesn't equal 1 in python,
+  # but does in sqlite (and is an error in postgres), so those are left to the database
+  if value is None or (isinstance(kind, type) and isinstance(value, kind)): return True
+  return kind in (int, float) and isinstance(value, (int, float))
+
+
+def cached_rows(entry):
+  backend, key, ttl, generations = entry
+  value = backend.get(key)
+  # stale once a table read has been written to
+  if value is not None and value[0]==generations: return value[1]
+
+
+def cache_rows(entry, rows):
+  backend, key, ttl, generations = entry
+  backend.put(key, (generations, [tuple(row) for row in rows]), ttl)
+
+
+def identity_key(tbl, get, row):
+  return tbl, get(row)
+
+
+# sqlite parses each "or" one level deeper, up to 1000
+MAX_KEYS = 500
+
+
+def in_keys(columns, keys):
+  '''
+  A condition matching rows whose ``columns`` are one of ``keys`` (tuples of values).  For more than one column, pass
+  at most ``MAX_KEYS`` keys (see :py:func:`key_chunks`).
+  '''
+  if len(columns)==1:
+    return columns[0].in_([k[0] for k in keys])
+  return Condition('or', [Condition('and', [c==v for c, v in zip(columns, k)]) for k in keys])
+
+
+def key_chunks(columns, keys):
+  '''
+  Splits ``keys`` (a list) into the lists to query with one :py:func:`in_keys` condition each - all of them for a single
+  column (an ``in_()`` list of any length is fine), ``MAX_KEYS`` at a time for more.
+  '''
+  if len(columns)==1: return [keys] if keys else []
+  return [keys[i:i+MAX_KEYS] for i in range(0, len(keys), MAX_KEYS)]
+
+
+class Siblings(list):
+  '''
+  The rows of a result set, which load their lazy foreign keys together - from ``db``, the database (or transaction)
+  the query was bound to, if any.
+  '''
+  __slots__ = ('db',)
+
+
+def load_related(fk, rows, db=None):
+  '''
+  Loads the rows ``fk`` refers to from each of ``rows`` (with one query, or one per :py:func:`key_chunks` chunk), from
+  ``db`` if given, storing them (or ``None``) on each row.  Returns a ``coroutine`` in async code.
+  '''
+  by_key = {}
+  for row in rows:
+    k = tuple([getattr(row, c._name) for c in fk.frm])
+    if k==(None,) * len(k):
+      row.__dict__[fk._name] = None
+    else:
+      by_key.setdefault(k, []).append(row)
+  def attach(targets):
+    targets = {tuple([getattr(t, c._name) for c in fk.to]):t for t in targets}
+    for k, rows_ in by_key.items():
+      t = targets.get(k)
+      for row in rows_:
+        row.__dict__[fk._name] = t
+  qs = [fk.to[0].tbl.ALL.where(in_keys(fk.to, keys)) for keys in key_chunks(fk.to, list(by_key))]
+  if db is not None: qs = [q.bind(db) for q in qs]
+  if get_running_loop():
+    async def f():
+      attach([t for q in qs async for t in q])
+    return f()
+  attach([t for q in qs for t in q])
+
+
+def map_values(d, group):
+  return [v for vs in d.values() for v in vs] if group else list(d.values())
+
+
+def columns_sql(d, tbl, alias):
+  '''
+  The comma separated list of all of a table's columns, qualified by ``alias``.
+  '''
+  def f():
+    if alias is None: return ','.join([d.term(c.name) for c in tbl._dqoi_columns])
+    alias_ = d.term(alias)
+    return ','.join(['%s.%s' % (alias_, d.term(c.name)) for c in tbl._dqoi_columns])
+  return d.fragment(('select', tbl, alias), f)
+
+
+class PreparedQuery:
+  '''
+  A query compiled by :py:meth:`Query.prepare`.  Calling it runs the select, returning a list of rows (or a ``coroutine``
+  in async code).  Every method takes the values for the query's :py:func:`dqo.param` placeholders as keyword arguments.
+  '''
+
+  def __init__(self, query):
+    self.query = query
+    self._compiled = {}
+  
+  def __call__(self, **params):
+    q, sql, args, keys = self._bind('select', params)
+    if get_running_loop():
+      return self._async_fetch(q, sql, args, keys)
+    identity = q._identity_map()
+    objs = [q._build(keys, row, identity) for row in q._sync_fetch_all(sql, args)]
+    return q._sync_related(objs) if q._one_to_many() else objs
+  
+  def first(self, **params):
+    '''
+    :returns: The first matching row, or ``None``.
+    '''
+    q, sql, args, keys = self._bind('first', params)
+    if get_running_loop():
+      async def f():
+        rows = await self._async_fetch(q, sql, args, keys)
+        return rows[0] if rows else None
+      return f()
+    rows = q._sync_fetch_all(sql, args)
+    if rows:
+      o = q._build(keys, rows[0], q._identity_map())
+      return q._sync_related([o])[0] if q._one_to_many() else o
     
+  def update(self, **params):
+    '''
+    Executes the query as an update of its ``set()`` values.
+    '''
+    q, sql, args, keys = self._bind('update', params)
+    return q._async_execute(sql, args) if get_running_loop() else q._sync_execute(sql, args)
+
+  def delete(self, **params):
+    '''
+    Executes the query as a delete.
+    '''
+    q, sql, args, keys = self._bind('delete', params)
+    return q._async_execute(sql, args) if get_running_loop() else q._sync_execute(sql, args)
+  
+  async def _async_fetch(self, q, sql, args, keys):
+    identity = q._identity_map()
+    objs = [q._build(keys, row, identity) for row in await q._async_fetch_all(sql, args)]
+    return await q._async_related(objs) if q._one_to_many() else objs
+
+  def _bind(self, kind, params):
+    db = self.query._db
+    dialect = db.dialect if db else Dialect.GENERIC
+    compiled = self._compiled.get((kind, dialect.__class__, dialect.lib))
+    if compiled is None:
+      compiled = self._compiled[(kind, dialect.__class__, dialect.lib)] = self._compile(kind)
+    q, sql, args, slots, keys = compiled
+    if len(params) != len(slots) or params.keys() - slots.keys():
+      unknown = params.keys() - slots.keys()
+      if unknown: raise TypeError('unknown parameter(s): %s' % ', '.join(sorted(unknown)))
+      raise TypeError('missing parameter(s): %s' % ', '.join(sorted(slots.keys() - params.keys())))
+    args = list(args)
+    for name, indexes in slots.items():
+      for i in indexes:
+        args[i] = params[name]
+    return q, sql, dialect.adapt(args), keys
+  
+  def _compile(self, kind):
+    q = copy.copy(self.query)
+    # a limit param stays (and still has to be given), or first() would reject the query's own parameters
+    if kind=='first' and not isinstance(q._limit, Param):
+      q = q.limit(1)
+    if kind=='update':
+      q._cmd = CMD.UPDATE
+    if kind=='delete':
+      q._cmd = CMD.DELETE
+    keys = None
+    if q._cmd==CMD.SELECT:
+      if q._select is None:
+        q._select = q._tbl._dqoi_columns
+      keys = [c._name for c in q._select]
+    sql, args = q._sql()
+    if sql.__class__ is Script and any([isinstance(a, Param) for step_sql, step_args in sql.steps for a in step_args]):
+      raise TypeError("param() can't be used with a 'temp' or 'chunked' in_() list")
+    slots = {}
+    for i, arg in enumerate(args):
+      if isinstance(arg, Param):
+        slots.setdefault(arg.name, []).append(i)
+    return q, sql, args, slots, keys
 
 
 class Plus:
+  '''
+  An immutable tree of foreign key paths to join in, built up by :py:meth:`Query.plus`.  Adding a path copies only the
+  nodes along it.  Foreign keys followed forwards (``children``) are joined in.  Foreign keys followed backwards 
+  (``reverse``, one-to-many) are each loaded by one more query once the rows they belong to are built.
+  '''
+  __slots__ = ('children', 'reverse', 'many')
 
-  def __init__(self):
-    self.children = {}
-    self.i = None
-    self.j = None
-    self.aliases = None
-    
-  def __copy__(self):
-    new = Plus()
-    new.children = copy.copy(self.children)
-    return new
+  def __init__(self, children=None, reverse=None):
+    self.children = children or {}
+    self.reverse = reverse or {}
+    self.many = bool(self.reverse) or any([plus.many for plus in self.children.values()])
+  
+  def add(self, path):
+    '''
+    :param path: ``[(fk, reverse), ...]``
+    '''
+    if not path: return self
+    (fk, reverse), path = path[0], path[1:]
+    children, reverse_ = dict(self.children), dict(self.reverse)
+    d = reverse_ if reverse else children
+    d[fk] = d.get(fk, Plus.EMPTY).add(path)
+    return Plus(children, reverse_)
   
-  def build(self, o, keys, row):
+  def _shape_(self):
+    ret = tuple([(fk, plus._shape_()) for fk, plus in self.children.items()])
+    if self.reverse:
+      ret += (('reverse', tuple([(fk, plus._shape_()) for fk, plus in self.reverse.items()])),)
+    return ret
+  
+  def layout(self, ncols, lazy=False):
+    '''
+    Returns ``[(fk, load, pk, key, children), ...]`` - for each joined table, a function building its row from the 
+    columns in a result row (after ``ncols`` selected columns), and the position of (the first column of) its primary
+    key and a function getting ``(table, pk)`` for the identity map (both ``None`` if it has none).
+    '''
+    return self._layout(ncols, lazy)[0]
+  
+  def _layout(self, ncols, lazy):
+    ret = []
     for fk, plus in self.children.items():
-      o2 = fk.to[0].tbl()
-      o2.__dict__.update(dict(zip(keys[plus.i:plus.j], row[plus.i:plus.j])))
+      columns = fk.to[0].tbl._dqoi_columns
+      i, ncols = ncols, ncols + len(columns)
+      children, end = plus._layout(ncols, lazy)
+      pk = fk.to[0].tbl._dqoi_pk
+      pks = [i + [j for j, c in enumerate(columns) if c is pkc][0] for pkc in pk.columns] if pk else []
+      key = functools.partial(identity_key, fk.to[0].tbl, operator.itemgetter(*pks)) if pks else None
+      ret.append((fk, fk.to[0].tbl._dqoi_row._loader([c._name for c in columns], i, lazy), pks[0] if pks else None, key, children))
+      ncols = end
+    return ret, ncols
+  
+  @staticmethod
+  def build(layout, o, row, identity):
+    for fk, load, pk, key, children in layout:
+      if pk is None:
+        o2 = load(row)
+      elif row[pk] is None:
+        # left joined to nothing
+        o.__dict__[fk._name] = None
+        continue
+      else:
+        k = key(row)
+        o2 = identity.get(k)
+        # already built (maybe by another path, so still load this path's legs into it)
+        if o2 is None: o2 = identity[k] = load(row)
       o.__dict__[fk._name] = o2
-      plus.build(o2, keys, row)
-
-  def __getitem__(self, fk):
-    children = self.children
-    plus = children.get(fk)
-    if not plus:
-      plus = Plus()
-      children[fk] = plus
-    return plus
-  
-  def gen_select(self, d, tbl, columns):
-    self.aliases = []
-    self.i = len(columns)
-    self.tbl = tbl
-    return self._gen_select(d, columns, self.aliases)
-    
-  def _gen_select(self, d, columns, aliases):
+      if children:
+        Plus.build(children, o2, row, identity)
+  
+  def related(self, objs, lazy=False):
+    '''
+    Yields ``(query, attach)`` for every one-to-many leg - the query for the rows belonging to ``objs`` (or to the rows
+    joined to them), and a function stitching its results onto their parents.  Legs with no parents are skipped, and
+    those with many parents keyed by more than one column are split (see :py:func:`key_chunks`).
+    '''
+    for path, fk, plus in self._reverse_legs(()):
+      parents = objs
+      for step in path:
+        parents = {id(o2):o2 for o2 in [o.__dict__.get(step._name) for o in parents] if o2 is not None}.values()
+      by_key = {}
+      for parent in parents:
+        by_key.setdefault(tuple([getattr(parent, c._name) for c in fk.to]), []).append(parent)
+      by_key.pop((None,) * len(fk.to), None)
+      for keys in key_chunks(fk.frm, list(by_key)):
+        q = fk.frm[0].tbl.ALL.where(in_keys(fk.frm, keys))
+        q._plus = plus
+        if lazy: q._mode = 'lazy'
+        yield q, functools.partial(Plus._attach, fk, {k:by_key[k] for k in keys})
+
+  @staticmethod
+  def _attach(fk, by_key, children):
+    related = {}
+    for child in children:
+      related.setdefault(tuple([getattr(child, c._name) for c in fk.frm]), []).append(child)
+    for k, parents in by_key.items():
+      rows = related.get(k, [])
+      for parent in parents:
+        parent.__dict__[fk.related_name] = rows
+      # the reverse side is already loaded
+      if len(parents)==1:
+        for child in rows:
+          child.__dict__[fk._name] = parents[0]
+
+  def add_tables(self, tables):
+    '''
+    Adds the names of the tables joined in or loaded to ``tables`` (a ``set``).
+    '''
+    for fk, plus in self.children.items():
+      tables.add(fk.to[0].tbl._dqoi_db_name)
+      plus.add_tables(tables)
+    for fk, plus in self.reverse.items():
+      tables.add(fk.frm[0].tbl._dqoi_db_name)
+      plus.add_tables(tables)
+
+  def _reverse_legs(self, path):
+    for fk, plus in self.reverse.items():
+      yield path, fk, plus
+    for fk, plus in self.children.items():
+      if plus.many:
+        yield from plus._reverse_legs(path + (fk,))
+
+  def gen_select(self, d, sql, first):
+    aliases = []
+    self._gen_select(d, sql, first, aliases)
+    return aliases
+    
+  def _gen_select(self, d, sql, first, aliases):
     for fk, plus in self.children.items():
-      plus.i = len(columns)
       to_tbl = fk.to[0].tbl
       alias = d.gen_name(to_tbl._dqoi_db_name)
-      columns.extend([c.frm(alias) for c in to_tbl._dqoi_columns])
-      plus.j = len(columns)
+      if first: first = False
+      else: sql.write(',')
+      sql.write(columns_sql(d, to_tbl, alias))
       aliases.append(alias)
-      plus._gen_select(d, columns, aliases)
+      plus._gen_select(d, sql, first, aliases)
   
-  def _sql_(self, d, sql, args):
-    frm_alias = d.registered[self.tbl]
-    self._gen_joins(d, sql, args, frm_alias, self.aliases.__iter__())
+  def _sql_(self, d, sql, args, tbl, aliases):
+    if not self.children: return
+    frm_alias = d.registered[tbl]
+    self._gen_joins(d, sql, args, frm_alias, aliases.__iter__())
 
   def _gen_joins(self, d, sql, args, frm_alias, aliases_iter):
     for fk, plus in self.children.items():
       to_alias = aliases_iter.__next__()
-      to_tbl = fk.to[0].tbl
-      on = Condition(' and ', [fc.frm(frm_alias)==tc.frm(to_alias) for fc,tc in zip(fk.frm,fk.to)])
-      join = Join('left', to_tbl.as_(to_alias), on=on)
-      join._sql_(d, sql, args)
+      sql.write(d.fragment(('plus', fk, frm_alias, to_alias), lambda: self._join_sql(d, fk, frm_alias, to_alias)))
       plus._gen_joins(d, sql, args, to_alias, aliases_iter)
-      
-      
+  
+  def _join_sql(self, d, fk, frm_alias, to_alias):
+    sql = io.StringIO()
+    on = Condition(' and ', [fc.frm(frm_alias)==tc.frm(to_alias) for fc,tc in zip(fk.frm,fk.to)])
+    Join('left', fk.to[0].tbl.as_(to_alias), on=on)._sql_(d, sql, [])
+    return sql.getvalue()
     
   def __repr__(self):
-    return '%i-%i/%s' % (self.i or 0, self.j or 0, repr(self.children))
+    return 'Plus(%s)' % repr(self.children)
+
+Plus.EMPTY = Plus()
 
 
 class Join:
@@ -909,37 +1839,127 @@ class Join:
     if self.on:
       sql.write(' on ')
       self.on._sql_(d, sql, args)
+
+  def _shape_(self, args):
+    if isinstance(self.other, Query):
+      other = (Query, self.other._alias, self.other._shape_(args))
+    else:
+      other = shape(self.other, args)
+    return (Join, self.type, other, None if self.on is None else shape(self.on, args))
       
 
 class AsyncIterable:
 
   def __init__(self, query):
     self.query = query
-    sql, args = query._sql()
-    self.keys = [c.name for c in query._select]
-    self._inited = False
-  
-  async def _init(self):
+    self.keys = [c._name for c in query._select]
+    self.identity = query._identity_map()
+    self.iter = None
+    self.built = False
+
+  def __aiter__(self):
+    return self
+
+  async def _rows(self):
+    # holds the connection open for as long as rows are streaming
     sql, args = self.query._sql()
-    async with self.query._db.connection() as conn:
-      data = await conn.async_fetch(sql, args)
-      async def f():
-        for x in data:
-          yield x
-      self.iter = f().__aiter__()
-      self.data = data
-      self.iter = data.__iter__()
-    self._inited = True
+    db = self.query._db
+    if self.query._buffered() or db.single_flight is not None:
+      for row in await self.query._async_fetch_all(sql, args):
+        yield row
+      return
+    async with db.connection() as conn:
+      async for row in conn.async_stream(sql, args, db.prefetch):
+        yield row
+
+  async def _related(self):
+    # one-to-many legs need every parent row before they can be loaded
+    objs = [self.query._build(self.keys, row, self.identity) async for row in self._rows()]
+    for o in await self.query._async_related(objs):
+      yield o
 
   async def __anext__(self):
-    if not self._inited: await self._init()
-    try:
-      row = self.iter.__next__()
-    except StopIteration:
-      raise StopAsyncIteration
-    o = self.query._tbl()
-    o.__dict__.update(dict(zip(self.keys, row)))
-    return o
+    if self.iter is None:
+      self.built = self.query._one_to_many()
+      self.iter = self._related() if self.built else self._rows()
+    row = await self.iter.__anext__()
+    if self.built: return row
+    return self.query._build(self.keys, row, self.identity)
+
+  async def aclose(self):
+    '''
+      Stops iterating early, releasing the connection.
+    '''
+    if self.iter is not None: await self.iter.aclose()
+
+
+class Stream:
+
+  # with one-to-many plus() legs, rows are built this many at a time (and each leg queried once per batch)
+  RELATED_BATCH = 1000
+
+  def __init__(self, query, batch_size):
+    self.query = query
+    self.batch_size = batch_size
+    self.keys = [c._name for c in query._select]
+    self.identity = query._identity_map()
+    self.related = query._one_to_many()
+    self.built = iter(())
+    self.conn = None
+    self.rows = None
+
+  def __enter__(self):
+    sql, args = self.query._sql()
+    # an already open connection comes back as an OpenConnection, which doesn't close on exit
+    self.conn = self.query._conn_or_tx_sync.__enter__()
+    self.rows = self.conn.sync_stream(sql, args, self.batch_size)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self.rows.close()
+    self.conn.__exit__(exc_type, exc, tb)
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.rows is None: raise TypeError('stream() must be used in a with block')
+    if self.related:
+      for o in self.built:
+        return o
+      objs = [self.query._build(self.keys, row, self.identity) for row in itertools.islice(self.rows, self.RELATED_BATCH)]
+      if not objs: raise StopIteration
+      self.built = self.query._sync_related(objs).__iter__()
+      return self.built.__next__()
+    return self.query._build(self.keys, self.rows.__next__(), self.identity)
+
+  async def __aenter__(self):
+    sql, args = self.query._sql()
+    self.conn = self.query._conn_or_tx_async
+    await self.conn.__aenter__()
+    self.rows = self.conn.async_stream(sql, args, self.batch_size)
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.rows.aclose()
+    await self.conn.__aexit__(exc_type, exc, tb)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if self.rows is None: raise TypeError('stream() must be used in an async with block')
+    if self.related:
+      for o in self.built:
+        return o
+      objs = []
+      async for row in self.rows:
+        objs.append(self.query._build(self.keys, row, self.identity))
+        if len(objs)==self.RELATED_BATCH: break
+      if not objs: raise StopAsyncIteration
+      self.built = (await self.query._async_related(objs)).__iter__()
+      return self.built.__next__()
+    return self.query._build(self.keys, await self.rows.__anext__(), self.identity)
 
 
 class SyncIterable:
@@ -947,16 +1967,21 @@ class SyncIterable:
     self.query = query
     sql, args = query._sql()
     self.keys = [c._name for c in query._select]
+    self.identity = query._identity_map()
     conn_or_tx = TLS.conn_or_tx if hasattr(TLS,'conn_or_tx') else None
-    if conn_or_tx:
+    if conn_or_tx and not query._buffered():
       self.iter = conn_or_tx.sync_fetch(sql, args).__iter__()
     else:
-      with query._db.connection() as conn:
-        self.iter = list(conn.sync_fetch(sql, args)).__iter__()
+      self.iter = query._sync_fetch_all(sql, args).__iter__()
+    self.built = query._one_to_many()
+    if self.built:
+      # one-to-many legs need every parent row before they can be loaded
+      self.iter = query._sync_related([query._build(self.keys, row, self.identity) for row in self.iter]).__iter__()
 
   def __next__(self):
     row = self.iter.__next__()
-    o = self.query._build(self.keys, row)
+    if self.built: return row
+    o = self.query._build(self.keys, row, self.identity)
     return o
 
 import dqo
@@ -0,0 +1,217 @@
+import functools
+
+from .query import in_keys, CMD, MAX_KEYS
+from . import cache
+from .table import BaseRow
+from .util import get_running_loop, SESSION
+
+
+class Session:
+  '''
+  A unit of work, returned by :py:meth:`Database.session`.  Inside a ``with`` (or ``async with``) block:
+
+  - Every row queried is kept in an identity map by primary key, so loading the same row twice returns the same
+    object (with any changes not yet saved).
+  - ``save()``, ``insert()``, ``update()`` and ``delete()`` on rows are queued instead of run.
+
+  Queued changes (and changes to any row queried in the session) are written by :py:meth:`flush`, which runs
+  automatically at the end of the block unless it raised.  For example:
+
+  .. code-block:: python
+
+    with db.session():
+      for line in csv_lines:
+        Product(name=line[0], price=line[1]).save()
+      for product in Product.ALL.where(Product.price > 100):
+        product.featured = True
+
+  runs two queries: one ``insert`` of every product, and one (batched) ``update``.  Queries in the block don't flush
+  first, so won't see rows saved in it until :py:meth:`flush` is called.
+  '''
+
+  # rows per insert or delete are limited to stay under the drivers' limits on bound arguments
+  MAX_ARGS = 30000
+
+  def __init__(self, db):
+    self.db = db
+    self.identity = IdentityMap()
+    self._inserts = {}
+    self._updates = {}
+    self._deletes = {}
+    self._tokens = []
+
+  def __enter__(self):
+    self._tokens.append(SESSION.set(self))
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    try:
+      if exc_type is None: self.flush()
+    finally:
+      SESSION.reset(self._tokens.pop())
+
+  async def __aenter__(self):
+    return self.__enter__()
+
+  async def __aexit__(self, exc_type, exc, tb):
+    try:
+      if exc_type is None: await self.flush()
+    finally:
+      SESSION.reset(self._tokens.pop())
+
+  def add(self, row):
+    '''
+    Queues ``row`` to be inserted (if new) or updated (if changed) by the next :py:meth:`flush`.
+    '''
+    if row._new: self._inserts[id(row)] = row
+    else: self._updates[id(row)] = row
+    self._deletes.pop(id(row), None)
+    return row
+
+  def delete(self, row):
+    '''
+    Queues ``row`` to be deleted by the next :py:meth:`flush`.  A row never flushed is just forgotten.
+    '''
+    self._updates.pop(id(row), None)
+    if self._inserts.pop(id(row), None) is None and not row._new:
+      self._deletes[id(row)] = row
+
+  def flush(self):
+    '''
+    Writes all queued changes, grouped per table: one ``insert`` per set of columns given values, one ``update``
+    statement per set of changed columns (run with ``executemany()``), and one ``delete``.  Parent tables are inserted
+    into before (and deleted from after) the tables referencing them, and rows referring to a row inserted in the same
+    flush (``child.parent = parent``) get its new primary key.  Returns a ``coroutine`` in async code.
+    '''
+    if get_running_loop(): return self._async_flush()
+    with self.db.connection():
+      for step, done in self._steps():
+        done(step())
+
+  async def _async_flush(self):
+    for step, done in self._steps():
+      done(await step())
+
+  def _steps(self):
+    # yields (statement, callback) pairs, lazily as inserted primary keys are needed by later ones
+    inserts, self._inserts = list(self._inserts.values()), {}
+    deletes, self._deletes = list(self._deletes.values()), {}
+    updates, self._updates = list(self._updates.values()), {}
+    updates += [row for row in self.identity.values() if isinstance(row, BaseRow)]
+    deleted = set([id(row) for row in deletes])
+    updates = list({id(row):row for row in updates if row._dirty_mask and not row._new and id(row) not in deleted}.values())
+    tables = sort_tables([row._tbl for row in inserts + updates + deletes])
+    for tbl in tables:
+      rows = [row for row in inserts if row._tbl is tbl]
+      for row in rows:
+        set_fk_columns(row)
+      by_keys = {}
+      for row in rows:
+        by_keys.setdefault(tuple(row._values()), []).append(row)
+      for keys, rows in by_keys.items():
+        if not keys:
+          for row in rows:
+            yield tbl.ALL.insert, functools.partial(lambda row, pk: self._inserted([row], [pk]), row)
+          continue
+        for chunk in chunks(rows, self.MAX_ARGS // len(keys)):
+          yield functools.partial(tbl.ALL.insert, [row._values() for row in chunk]), functools.partial(self._inserted, chunk)
+    for tbl in tables:
+      by_mask = {}
+      for row in updates:
+        if row._tbl is tbl: by_mask.setdefault(row._dirty_mask, []).append(row)
+      if by_mask and not tbl._dqoi_pk: raise Exception("cannot update a row without a primary key")
+      for rows in by_mask.values():
+        names = rows[0]._dirty
+        args = []
+        for row in rows:
+          q = tbl.ALL.set(**{x:getattr(row, x, None) for x in names}).where(*[c==getattr(row, c._name, None) for c in tbl._dqoi_pk.columns])
+          q._cmd = CMD.UPDATE
+          sql, row_args = q._sql()
+          args.append(row_args)
+        yield functools.partial(self._execute_many, sql, args), functools.partial(self._updated, rows)
+    for tbl in reversed(tables):
+      rows = [row for row in deletes if row._tbl is tbl]
+      if not rows: continue
+      if not tbl._dqoi_pk: raise Exception("cannot delete a row without a primary key")
+      columns = tbl._dqoi_pk.columns
+      for chunk in chunks(rows, self.MAX_ARGS if len(columns)==1 else MAX_KEYS):
+        keys = [tuple([getattr(row, c._name, None) for c in columns]) for row in chunk]
+        yield tbl.ALL.where(in_keys(columns, keys)).delete, functools.partial(self._deleted, chunk)
+
+  def _execute_many(self, sql, args):
+    if get_running_loop():
+      async def f():
+        async with self.db.connection() as conn:
+          await conn.async_execute_many(sql, args)
+      return f()
+    with self.db.connection() as conn:
+      conn.sync_execute_many(sql, args)
+
+  def _inserted(self, rows, pks):
+    pk = rows[0]._tbl._dqoi_pk
+    # pks are only returned where the database supports "returning"
+    if pk and pks:
+      for row, value in zip(rows, pks):
+        if len(pk.columns)==1:
+          object.__setattr__(row, pk.columns[0]._name, value)
+        else:
+          for c, v in zip(pk.columns, value):
+            object.__setattr__(row, c._name, v)
+        self.identity[(row._tbl, value)] = row
+    self._saved(rows, False)
+
+  def _updated(self, rows, _=None):
+    pk = rows[0]._tbl._dqoi_pk
+    values = [tuple([getattr(row, c._name, None) for c in pk.columns]) for row in rows]
+    cache.written(rows[0]._tbl, [v[0] if len(v)==1 else v for v in values], self.db)
+    self._saved(rows, False)
+
+  def _deleted(self, rows, _=None):
+    pk = rows[0]._tbl._dqoi_pk
+    for row in rows:
+      value = tuple([getattr(row, c._name, None) for c in pk.columns])
+      self.identity.pop((row._tbl, value[0] if len(value)==1 else value), None)
+    self._saved(rows, True)
+
+  def _saved(self, rows, new, _=None):
+    for row in rows:
+      object.__setattr__(row, '_new', new)
+      object.__setattr__(row, '_dirty_mask', 0)
+
+
+class IdentityMap(dict):
+  '''
+  A session's identity map.  Unlike a single result's, the rows queried are shared too, not just those joined in.
+  '''
+
+
+def set_fk_columns(row):
+  # copy the keys of rows assigned to foreign keys (possibly just inserted) to the columns referencing them
+  for fk in row._tbl._dqoi_fks:
+    other = row.__dict__.get(fk._name)
+    if other is None: continue
+    for frm, to in zip(fk.frm, fk.to):
+      value = getattr(other, to._name, None)
+      if value is not None: setattr(row, frm._name, value)
+
+
+def sort_tables(tables):
+  # referenced tables before those referencing them
+  ret = []
+  def visit(tbl, seen):
+    if tbl in ret or tbl in seen: return
+    seen.add(tbl)
+    for fk in tbl._dqoi_fks:
+      other = fk.to[0].tbl
+      if other in tables: visit(other, seen)
+    ret.append(tbl)
+  tables = set(tables)
+  for tbl in sorted(tables, key=lambda tbl: tbl._dqoi_db_name):
+    visit(tbl, set())
+  return ret
+
+
+def chunks(rows, n):
+  n = max(1, n)
+  for i in range(0, len(rows), n):
+    yield rows[i:i+n]
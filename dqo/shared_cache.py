@@ -0,0 +1,195 @@
+import hashlib, marshal, mmap, os, pickle, struct, threading, time
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+MAGIC = b'dqocach1'
+# magic, slots, slot size
+HEADER = struct.Struct('<8sII')
+GENERATION = struct.Struct('<Q')
+# seq, key digest, expires, length of the data following
+SLOT = struct.Struct('<Q16sdI4x')
+SEQ = struct.Struct('<Q')
+
+# held while a forked process replaces its parent's mapping
+REOPEN = threading.Lock()
+
+
+def _forked():
+  # a lock held by another thread at fork time never gets released in the child
+  global REOPEN
+  REOPEN = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_forked)
+
+
+class SharedCache:
+  '''
+  A :py:meth:`dqo.query.Query.cached` backend in a memory mapped file, shared by every process opening the same
+  ``path`` (put it on a ``tmpfs`` like ``/dev/shm`` to keep it off disk).  For example, for preforked workers:
+
+  .. code-block:: python
+
+    db = dqo.Database(src=..., result_cache=SharedCache('/dev/shm/myapp.dqo'))
+
+  The file holds ``slots`` entries of up to ``slot_size`` bytes each (64MB by default), and a key always goes in the
+  same slot, replacing whatever was there.  Results bigger than a slot aren't cached (see ``stats['too_large']``).
+
+  Reads don't lock: each slot has a sequence number, odd while it's being written, so a reader seeing it change knows
+  it copied a torn entry and treats it as a miss.  Writes (and table generation bumps) take an exclusive ``flock()``
+  on the file, for a few microseconds - and a ``threading.Lock``, as ``flock()`` doesn't keep a process' own threads
+  apart.  Table generations are kept in the file too, in a fixed array indexed by a hash of the table name - tables
+  sharing a counter only cost each other extra invalidations.
+
+  Rows are stored with :py:func:`encode`.  The file's layout is set by whoever creates it, and the ``slots`` and
+  ``slot_size`` of later processes are ignored.
+  '''
+
+  GENERATIONS = 4096
+
+  def __init__(self, path, slots=8192, slot_size=8192):
+    if fcntl is None:
+      raise ImportError('SharedCache requires fcntl (a Unix-like OS)')
+    self.path = path
+    self.slots = slots
+    self.slot_size = slot_size
+    self.hits = 0
+    self.misses = 0
+    self.too_large = 0
+    self._pid = None
+    self._lock = threading.Lock()
+    self._open()
+
+  def _open(self):
+    # flock() locks are shared by forked processes inheriting the file, so each process opens its own
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+      header = os.pread(fd, HEADER.size, 0)
+      if len(header)==HEADER.size and header.startswith(MAGIC):
+        magic, self.slots, self.slot_size = HEADER.unpack(header)
+      else:
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self._size())
+        os.pwrite(fd, HEADER.pack(MAGIC, self.slots, self.slot_size), 0)
+      self._mmap = mmap.mmap(fd, self._size())
+    finally:
+      fcntl.flock(fd, fcntl.LOCK_UN)
+    self._fd = fd
+    self._pid = os.getpid()
+
+  def _size(self):
+    return self._first_slot() + self.slots * self.slot_size
+
+  def _first_slot(self):
+    return HEADER.size + self.GENERATIONS * GENERATION.size
+
+  def _map(self):
+    if self._pid != os.getpid():
+      with REOPEN:
+        if self._pid != os.getpid():
+          # forked - the parent's mapping and descriptor (and flock(), which they share) are left to the parent
+          self._mmap.close()
+          os.close(self._fd)
+          self._lock = threading.Lock()
+          self._open()
+    return self._mmap
+
+  def get(self, key):
+    m = self._map()
+    digest = digest_of(key)
+    offset = self._slot(digest)
+    seq, digest_, expires, length = SLOT.unpack_from(m, offset)
+    if seq & 1 or digest_ != digest or expires < time.time() or length > self.slot_size - SLOT.size:
+      self.misses += 1
+      return None
+    start = offset + SLOT.size
+    data = m[start:start+length]
+    if SEQ.unpack_from(m, offset)[0] != seq:
+      # written to while copying
+      self.misses += 1
+      return None
+    self.hits += 1
+    return decode(data)
+
+  def put(self, key, value, ttl):
+    data = encode(value)
+    if len(data) > self.slot_size - SLOT.size:
+      self.too_large += 1
+      return
+    m = self._map()
+    digest = digest_of(key)
+    offset = self._slot(digest)
+    with self._lock:
+      fcntl.flock(self._fd, fcntl.LOCK_EX)
+      try:
+        seq = SEQ.unpack_from(m, offset)[0] | 1
+        SEQ.pack_into(m, offset, seq)
+        start = offset + SLOT.size
+        m[start:start+len(data)] = data
+        SLOT.pack_into(m, offset, seq, digest, time.time() + ttl, len(data))
+        SEQ.pack_into(m, offset, seq + 1)
+      finally:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def generation(self, table):
+    return GENERATION.unpack_from(self._map(), self._generation(table))[0]
+
+  def bump(self, table):
+    m = self._map()
+    offset = self._generation(table)
+    with self._lock:
+      fcntl.flock(self._fd, fcntl.LOCK_EX)
+      try:
+        GENERATION.pack_into(m, offset, GENERATION.unpack_from(m, offset)[0] + 1)
+      finally:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def _slot(self, digest):
+    return self._first_slot() + int.from_bytes(digest[:8], 'little') % self.slots * self.slot_size
+
+  def _generation(self, table):
+    return HEADER.size + int.from_bytes(digest_of(table)[:8], 'little') % self.GENERATIONS * GENERATION.size
+
+  def close(self):
+    self._mmap.close()
+    os.close(self._fd)
+
+  @property
+  def stats(self):
+    '''
+      This process' ``hits``, ``misses`` and ``too_large`` (results not stored), and the file's ``slots`` and
+      ``slot_size``.
+    '''
+    return {'hits':self.hits, 'misses':self.misses, 'too_large':self.too_large, 'slots':self.slots, 'slot_size':self.slot_size}
+
+
+def digest_of(key):
+  # the same in every process, unlike hash()
+  if not isinstance(key, bytes): key = str(key).encode()
+  return hashlib.blake2b(key, digest_size=16).digest()
+
+
+def encode(value):
+  '''
+  Packs a result (tuples and lists of rows) as a type byte and its ``marshal`` encoding, which covers the values
+  drivers return most (``None``, ``bool``, ``int``, ``float``, ``str``, ``bytes``) compactly and decodes in C.
+  Results with anything else (dates, decimals, ...) are pickled.
+  '''
+  try:
+    return b'm' + marshal.dumps(value)
+  except ValueError:
+    return b'p' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data):
+  '''
+  Unpacks a value packed by :py:func:`encode`.
+  '''
+  if data[:1]==b'm': return marshal.loads(data[1:])
+  return pickle.loads(data[1:])
@@ -1,87 +1,251 @@
 import asyncio, inspect, re
 
-from .query import Query
+from .query import Query, load_related, in_keys, key_chunks
+from .cache import RowCache, Replica
 from .column import Column, PrimaryKey, ForeignKey, Index
-from .util import get_running_loop
+from .util import get_running_loop, shape, current_session, SESSION
   
   
 class BaseRow(object):
+  '''
+  The base of every table's row class.  Each table gets its own subclass (see :py:func:`row_class`) with a slot per 
+  column, so rows loaded from the database don't need a ``__dict__``.  Anything else set on a row (rows joined in
+  with ``plus()``, selected functions) is kept in ``__dict__``.  Changed columns are tracked in a bitmask.
+  '''
+  __slots__ = ('__dict__',)
+
+  # set per instance only when they differ, so loaded rows stay dict-free
+  _new = False
+  _dirty_mask = 0
+  # set on each table's row class
+  _columns = ()
+  _bits = {}
+  _loaders = None
 
   def __init__(self, **kwargs):
-    kwargs = {k:v for k,v in kwargs.items() if not k.startswith('_')}
-    self.__dict__.update(kwargs)
-    self.__dict__['_new'] = True
-    self.__dict__['_dirty'] = set(kwargs.keys())
+    object.__setattr__(self, '_new', True)
+    for k, v in kwargs.items():
+      if not k.startswith('_'):
+        setattr(self, k, v)
 
   def __setattr__(self, attr, value):
-    dirty = not attr.startswith('_') and (attr not in self.__dict__ or self.__dict__[attr]!=value)
-    self.__dict__[attr] = value
-    if dirty:
-      self.__dict__['_dirty'].add(attr)
+    bit = self._bits.get(attr)
+    if bit and not self._dirty_mask & bit:
+      try:
+        dirty = getattr(self, attr) != value
+      except AttributeError:
+        dirty = True
+      if dirty:
+        object.__setattr__(self, '_dirty_mask', self._dirty_mask | bit)
+    object.__setattr__(self, attr, value)
     return value
 
+  @property
+  def _dirty(self):
+    mask = self._dirty_mask
+    return set([name for name in self._columns if mask & self._bits[name]])
+
+  def _values(self):
+    ret = {}
+    for name in self._columns:
+      try:
+        ret[name] = getattr(self, name)
+      except AttributeError:
+        pass
+    return ret
+
+  @classmethod
+  def _loader(cls, keys, offset=0, lazy=False):
+    '''
+    Returns a function building a row from a driver row whose ``keys`` start at ``offset``.  Generated per table, list 
+    of keys and offset, it assigns each value straight to its slot - or if ``lazy``, keeps the driver row to read values
+    from when they're first accessed (see :py:class:`LazyRow`).
+    '''
+    key = (tuple(keys), offset, lazy)
+    loader = cls._loaders.get(key)
+    if loader is None:
+      loader = cls._loaders[key] = gen_lazy_loader(cls, keys, offset) if lazy else gen_loader(cls, keys, offset)
+    return loader
+
   def save(self):
-    if self._new: self.insert()
-    else: self.update()
+    if self._new: return self.insert()
+    else: return self.update()
   
   def __dqoi_save_pk(self, pk):
     if pk is None: return
     if len(self._tbl._dqoi_pk.columns) == 1:
-      self.__dict__[self._tbl._dqoi_pk.columns[0].name] = pk
+      object.__setattr__(self, self._tbl._dqoi_pk.columns[0]._name, pk)
     else:
       for c,v in zip(self._tbl._dqoi_pk.columns, pk):
-        self.__dict__[c.name] = v
+        object.__setattr__(self, c._name, v)
+
+  def __dqoi_saved(self, new):
+    object.__setattr__(self, '_new', new)
+    object.__setattr__(self, '_dirty_mask', 0)
   
+  def _queued(self, f):
+    # inside a session, writes wait for its flush()
+    session = current_session(self._tbl.ALL._db)
+    if session is None: return False
+    f(session)
+    return True
+
   def insert(self):
+    if self._queued(lambda session: session.add(self)):
+      return _noop(self) if get_running_loop() else self
     if get_running_loop():
       async def f():
-        pk = await self._tbl.ALL.insert(**self.__dict__)
+        pk = await self._tbl.ALL.insert(**self._values())
         self.__dqoi_save_pk(pk)
-        self.__dict__['_new'] = False
-        self.__dict__['_dirty'] = set()
+        self.__dqoi_saved(False)
         return self
       return f()
     else:
-      pk = self._tbl.ALL.insert(**self.__dict__)
+      pk = self._tbl.ALL.insert(**self._values())
       self.__dqoi_save_pk(pk)
-      self.__dict__['_new'] = False
-      self.__dict__['_dirty'] = set()
+      self.__dqoi_saved(False)
       return self
   
   def update(self):
     if not self._tbl._dqoi_pk: raise Exception("cannot update a row without a primary key")
-    q = self._tbl.ALL.set(**{x:self.__dict__.get(x) for x in self._dirty}).where(*[c==self.__dict__.get(c.name) for c in self._tbl._dqoi_pk.columns])
+    if self._queued(lambda session: session.add(self)):
+      return _noop(None) if get_running_loop() else None
+    q = self._tbl.ALL.set(**{x:getattr(self, x, None) for x in self._dirty}).where(*[c==getattr(self, c._name, None) for c in self._tbl._dqoi_pk.columns])
     if get_running_loop():
       async def f():
         await q.update()
-        self.__dict__['_dirty'] = set()
+        self.__dqoi_saved(False)
       return f()
     else:
       q.update()
-      self.__dict__['_dirty'] = set()
+      self.__dqoi_saved(False)
   
   def delete(self):
     if not self._tbl._dqoi_pk: raise Exception("cannot delete a row without a primary key")
+    if self._queued(lambda session: session.delete(self)):
+      return _noop(None) if get_running_loop() else None
+    q = self._tbl.ALL.where(*[c==getattr(self, c._name, None) for c in self._tbl._dqoi_pk.columns])
     if get_running_loop():
       async def f():
-        await self._tbl.ALL.where(*[c==self.__dict__.get(c.name) for c in self._tbl._dqoi_pk.columns]).delete()
-        self.__dict__['_new'] = True
-        self.__dict__['_dirty'] = set()
+        await q.delete()
+        self.__dqoi_saved(True)
       return f()
     else:
-      self._tbl.ALL.where(*[c==self.__dict__.get(c.name) for c in self._tbl._dqoi_pk.columns]).delete()
-      self.__dict__['_new'] = True
-      self.__dict__['_dirty'] = set()
+      q.delete()
+      self.__dqoi_saved(True)
   
   def __repr__(self):
-    return '<%s %s>' % (self.__class__.__name__, ' '.join(['%s=%s' % (k,repr(v)) for k,v in self.__dict__.items() if not k.startswith('_')]))
+    items = list(self._values().items()) + [(k,v) for k,v in self.__dict__.items() if not k.startswith('_')]
+    return '<%s %s>' % (self.__class__.__name__, ' '.join(['%s=%s' % (k,repr(v)) for k,v in items]))
+
+
+async def _noop(ret):
+  return ret
+
+
+class LazyRow:
+  '''
+  Mixed in to a table's row class for rows that hold on to the driver's row (``_record``) and copy a value out of it (into
+  its slot, or ``__dict__``) only when it's first read.  ``_index`` maps attribute names to positions in the record, and 
+  is shared by all rows of a query.  Everything else - setting values, dirty tracking, saving - is a normal row's.
+  '''
+  __slots__ = ()
+
+  def __getattr__(self, attr):
+    i = self._index.get(attr)
+    if i is None:
+      raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, attr))
+    value = self._record[i]
+    if attr in self._bits: object.__setattr__(self, attr, value)
+    else: self.__dict__[attr] = value
+    return value
+
+  def __repr__(self):
+    for attr in self._index:
+      getattr(self, attr)
+    return BaseRow.__repr__(self)
+
+
+class LazyRelation:
+  '''
+  The attribute a lazy foreign key (``dqo.ForeignKey(..., lazy=True)``) gets on its table's rows.  The first read of it
+  on any row loads the referenced rows for every row of the same result set, with one query.  In async code the first
+  read returns a ``coroutine`` to ``await``.  Once loaded (or joined in by ``plus()``) the row is kept in ``__dict__``,
+  which takes precedence over this.
+  '''
+
+  def __init__(self, fk):
+    self.fk = fk
+
+  def __get__(self, row, cls):
+    if row is None: return self
+    return self.load(row)
+
+  def load(self, row):
+    fk = self.fk
+    siblings = row.__dict__.get('_dqoi_rows', (row,))
+    rows = [r for r in siblings if fk._name not in r.__dict__]
+    ret = load_related(fk, rows, getattr(siblings, 'db', None))
+    if ret is None: return row.__dict__[fk._name]
+    async def f():
+      await ret
+      return row.__dict__[fk._name]
+    return f()
+
+
+def row_class(tbl):
+  '''
+  Generates the row class for a table, with a slot and a dirty bit per column.
+  '''
+  names = tuple([c._name for c in tbl._dqoi_columns])
+  ns = {
+    '__slots__': names,
+    '_tbl': tbl,
+    '_columns': names,
+    '_bits': {name:1<<i for i, name in enumerate(names)},
+    '_loaders': {},
+  }
+  for fk in tbl._dqoi_lazy_fks:
+    ns[fk._name] = LazyRelation(fk)
+  return type(tbl.__name__, (BaseRow,), ns)
+
+
+def gen_lazy_loader(cls, keys, offset):
+  lazy_cls = type(cls.__name__, (LazyRow, cls), {
+    '__slots__': ('_record',),
+    '_index': {key:offset+i for i, key in enumerate(keys)},
+  })
+  new = object.__new__
+  set_record = lazy_cls._record.__set__
+  def load(row):
+    o = new(lazy_cls)
+    set_record(o, row)
+    return o
+  return load
 
 
-def TableDecorator(name=None, db=None, aka=None):
+def gen_loader(cls, keys, offset):
+  ns = {'new':object.__new__, 'cls':cls}
+  lines = ['  o = new(cls)']
+  for i, key in enumerate(keys):
+    if key in cls._bits:
+      ns['set_%i' % i] = getattr(cls, key).__set__
+      lines.append('  set_%i(o, row[%i])' % (i, offset+i))
+    else:
+      lines.append('  o.__dict__[%r] = row[%i]' % (key, offset+i))
+  src = 'def load(row, %s):\n%s\n  return o' % (', '.join(['%s=%s' % (k,k) for k in ns]), '\n'.join(lines))
+  exec(src, ns)
+  return ns['load']
+
+
+def TableDecorator(name=None, db=None, aka=None, cache=None, cache_size=1024, cache_ttl=60):
   '''
   :param name: The name of the table in the database.
   :param db: The database to use for regular Python code.  If ``None`` defaults to ``dqo.DB`` if defined.
   :param aka: A string or list of strings with previous names of this table, used for renaming.
+  :param cache: ``'pk'`` to cache rows read with ``get()`` and ``get_many()``, or ``'full'`` to keep the whole table in memory (see below).
+  :param cache_size: How many rows the cache holds (for ``'pk'``).
+  :param cache_ttl: How many seconds a row is cached for (or between reloads of the whole table).
   
   A decorator used to turn a ``class`` into a dqo database table.  For example:
   
@@ -91,9 +255,46 @@ def TableDecorator(name=None, db=None, aka=None):
     class Product:
       name = dqo.Column(str)
       keywords = dqo.Column([str])
+
+  Every table with a primary key can look rows up by it:
+
+  .. code-block:: python
+
+    product = Product.get(42)
+    products = Product.get_many([42, 43])   # {42:<Product ...>, 43:<Product ...>}
+
+  Composite keys are passed as tuples, in the order of the primary key's columns.  ``get()`` returns ``None`` if not
+  found, and ``get_many()`` leaves missing keys out.  In async code, ``load()`` is ``get()`` batched across
+  coroutines - every key awaited in the same tick of the event loop is fetched by a single ``get_many()``:
+
+  .. code-block:: python
+
+    async def handle(request):
+      product = await Product.load(request.product_id)
+
+  With ``cache='pk'`` the rows found are cached in process (in an LRU of ``cache_size`` rows, each for ``cache_ttl``
+  seconds), and ``get_many()`` queries only for the keys that missed, in one query.  Writes through dqo to the table
+  (queries and rows, in any session) drop the cached rows they may have changed - writes from elsewhere only show up
+  once the TTL passes.  Cache stats are in ``Product._dqoi_cache.stats``.
+
+  Small reference tables (countries, plans, feature flags) can instead be kept in memory whole, with ``cache='full'``:
+
+  .. code-block:: python
+
+    @dqo.Table(cache='full', cache_ttl=300)
+    class Country:
+      code = dqo.Column(str, primary_key=True)
+      name = dqo.Column(str, unique=True)
+
+    Country.ALL.where(name='France').first()   # no query
+
+  The table is loaded by the first query it can answer, and reloaded after ``cache_ttl`` seconds or any write through
+  dqo to it.  Queries of its columns with only ``==`` and ``in_()`` list conditions (including ``first()``, ``limit()``
+  and ``get()``) are answered from memory, through a hash index if the conditions cover the primary key or a declared
+  index.  Anything else (ordering, joins, functions) still queries the database.
   '''
   def f(cls):
-    return build_table(cls, name=name, db=db, aka=aka)
+    return build_table(cls, name=name, db=db, aka=aka, cache=cache, cache_size=cache_size, cache_ttl=cache_ttl)
   return f
 
 
@@ -111,29 +312,29 @@ class AliasedTable:
     sql.write(' as ')
     sql.write(d.term(self.name))
 
+  def _shape_(self, args):
+    return (AliasedTable, shape(self.tbl, args), self.name)
+
   
-def build_table(cls, name=None, db=None, aka=None):
+def build_table(cls, name=None, db=None, aka=None, cache=None, cache_size=1024, cache_ttl=60):
 
   if aka is None: aka = set()
   elif isinstance(aka,str): aka = set([aka])
   else: aka = set(aka)
 
   def __new__(cls, **kwargs):
-    return Row(**kwargs)
+    return cls._dqoi_row(**kwargs)
   cls.__new__ = __new__
   def __instancecheck__(self, instance):
-    return isinstance(instance, Row)
+    return isinstance(instance, cls._dqoi_row)
   cls.__instancecheck__ = __instancecheck__
   cls.as_ = lambda name: AliasedTable(cls, name)
   def _sql_(d, sql, args):
-    sql.write(d.term(cls._dqoi_db_name))
-    sql.write(' as ')
-    sql.write(d.term(d.registered[cls]))    
+    alias = d.registered[cls]
+    sql.write(d.fragment(('from', cls, alias), lambda: '%s as %s' % (d.term(cls._dqoi_db_name), d.term(alias))))
   cls._sql_ = _sql_
+  cls._shape_ = lambda args: cls
 
-  class Row(BaseRow):
-    _tbl = cls
-  
   cls._dqoi_db_name = name or cc_to_snake(cls.__name__)
   cls._dqoi_db = db
   cls._dqoi_pks = [x for x in cls.__dict__.values() if isinstance(x,PrimaryKey)]
@@ -141,16 +342,30 @@ def build_table(cls, name=None, db=None, aka=None):
   cls._dqoi_columns = get_columns(cls)
   cls._dqoi_aka = aka
   cls._dqoi_fks = get_fks(cls)
+  cls._dqoi_lazy_fks = [fk for fk in cls._dqoi_fks if fk.lazy]
   cls._dqoi_columns_by_attr_name = {c._name:c for c in cls._dqoi_columns}
+  # after the columns are collected, so a helper never replaces one
+  add_helper(cls, 'get', lambda pk: get(cls, pk))
+  add_helper(cls, 'get_many', lambda pks: get_many(cls, pks))
+  add_helper(cls, 'load', lambda pk: load(cls, pk))
     
   cls.ALL = Query(cls)
-  cls.__name__ = cls.__name__
-  Row.__name__ = cls.__name__
+  cls._dqoi_loader = Loader(cls)
+  cls._dqoi_row = row_class(cls)
   
   if len(cls._dqoi_pks)>1:
     raise ValueError('there can be only one (primary key): %s' % cls._dqoi_pks)
   cls._dqoi_pk = cls._dqoi_pks[0] if cls._dqoi_pks else None
   del cls._dqoi_pks
+
+  if cache not in (None, 'pk', 'full'):
+    raise ValueError('unknown cache %r (expected None, \'pk\' or \'full\')' % cache)
+  if cache=='pk' and not cls._dqoi_pk:
+    raise ValueError('cache=%r requires a primary key' % cache)
+  if cache=='full':
+    cls._dqoi_cache = Replica(cls, cache_ttl)
+  else:
+    cls._dqoi_cache = RowCache(cache_size, cache_ttl) if cache=='pk' else None
   
   if db:
     db._known_tables.append(cls)
@@ -158,6 +373,110 @@ def build_table(cls, name=None, db=None, aka=None):
   return cls
 
 
+def get(tbl, pk):
+  ret = get_many(tbl, [pk])
+  if get_running_loop():
+    async def f():
+      return (await ret).get(pk)
+    return f()
+  return ret.get(pk)
+
+
+def get_many(tbl, pks):
+  pk = tbl._dqoi_pk
+  if not pk: raise Exception('%s has no primary key' % tbl.__name__)
+  row_cls = tbl._dqoi_row
+  session = current_session(tbl.ALL._db)
+  cache = tbl._dqoi_cache
+  ret = {}
+  misses = []
+  for k in dict.fromkeys(pks):
+    o = session.identity.get((tbl, k)) if session else None
+    if o is None and cache is not None:
+      values = cache.get(k)
+      if values is not None:
+        o = row_cls._loader(row_cls._columns)(values)
+        if session: session.identity[(tbl, k)] = o
+    if o is None: misses.append(k)
+    else: ret[k] = o
+  if not misses:
+    return _noop(ret) if get_running_loop() else ret
+  keys = misses if len(pk.columns)>1 else [(k,) for k in misses]
+  qs = [tbl.ALL.where(in_keys(pk.columns, chunk)) for chunk in key_chunks(pk.columns, keys)]
+  def found(rows):
+    for row in rows:
+      values = tuple([getattr(row, c._name) for c in pk.columns])
+      k = values[0] if len(values)==1 else values
+      ret[k] = row
+      if cache is not None:
+        cache.put(k, tuple([getattr(row, name) for name in row_cls._columns]))
+    return ret
+  if get_running_loop():
+    async def f():
+      return found([o for q in qs async for o in q])
+    return f()
+  return found([o for q in qs for o in q])
+
+
+class Loader(object):
+  '''
+  Batches a table's ``load()`` calls: keys asked for in the same tick of the event loop are looked up together, with
+  one :py:func:`get_many`, once every task already scheduled has had its turn.  ``batches`` counts the lookups and
+  ``loads`` the calls.
+  '''
+
+  def __init__(self, tbl):
+    self.tbl = tbl
+    self.batches = 0
+    self.loads = 0
+    self._pending = {}
+
+  def load(self, pk):
+    if not self.tbl._dqoi_pk: raise Exception('%s has no primary key' % self.tbl.__name__)
+    self.loads += 1
+    loop = asyncio.get_event_loop()
+    # rows are shared within a session, so each gets its own batch
+    key = (loop, SESSION.get())
+    pending = self._pending.get(key)
+    if pending is None:
+      pending = self._pending[key] = {}
+      loop.call_soon(self._dispatch, key)
+    future = pending.get(pk)
+    if future is None: future = pending[pk] = loop.create_future()
+    return future
+
+  def _dispatch(self, key):
+    pending = self._pending.pop(key)
+    self.batches += 1
+    task = asyncio.ensure_future(self._fetch(pending))
+    # if it's cancelled (even before it starts), or dies of a BaseException, don't leave the callers waiting forever
+    task.add_done_callback(lambda task: [future.cancel() for future in pending.values()])
+
+  async def _fetch(self, pending):
+    try:
+      found = await get_many(self.tbl, list(pending))
+    except Exception as e:
+      for future in pending.values():
+        if not future.done(): future.set_exception(e)
+      return
+    for pk, future in pending.items():
+      if not future.done(): future.set_result(found.get(pk))
+
+
+def load(tbl, pk):
+  if get_running_loop(): return tbl._dqoi_loader.load(pk)
+  return get(tbl, pk)
+
+
+def add_helper(cls, name, f):
+  # unless something else of the class's own is already called that
+  value = cls.__dict__.get(name)
+  if isinstance(value, (Column, ForeignKey)):
+    raise ValueError('%s.%s clashes with %s.%s() - please rename the attribute (name=%r keeps its database name)' % (cls.__name__, name, cls.__name__, name, name))
+  if value is None:
+    setattr(cls, name, f)
+
+
 def get_columns(cls):
   ret = []
   for name, value in cls.__dict__.items():
@@ -180,6 +499,8 @@ def get_fks(cls):
     if not isinstance(value, ForeignKey): continue
     value._name = name
     value.tbl = cls
+    if value.related_name is None:
+      value.related_name = '%s_set' % cc_to_snake(cls.__name__)
     ret.append(value)
     value._gen_columns()
   return ret
@@ -1,6 +1,165 @@
-import asyncio
+import asyncio, collections, contextvars
 
 def get_running_loop():
-  loop = asyncio.get_event_loop()
-  return loop if loop.is_running() else None
+  try:
+    return asyncio.get_running_loop()
+  except RuntimeError:
+    return None
 
+
+class LRU(object):
+  '''
+    A bounded mapping that discards the least recently used entries once it holds more than ``maxsize`` items.
+    It counts ``hits``, ``misses`` and ``evictions`` so caches built on it can be sized.  A ``maxsize`` of ``0``
+    disables storage entirely.
+  '''
+
+  def __init__(self, maxsize=1024):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._data = collections.OrderedDict()
+
+  def get(self, key, default=None):
+    try:
+      value = self._data[key]
+      self._data.move_to_end(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    if self.maxsize <= 0: return
+    self._data[key] = value
+    self._data.move_to_end(key)
+    while len(self._data) > self.maxsize:
+      try:
+        self._data.popitem(last=False)
+      except KeyError:
+        break
+      self.evictions += 1
+
+  def pop(self, key, default=None):
+    return self._data.pop(key, default)
+
+  def clear(self):
+    self._data.clear()
+
+  def values(self):
+    return list(self._data.values())
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def __len__(self):
+    return len(self._data)
+
+  @property
+  def stats(self):
+    '''
+      A ``dict`` of ``hits``, ``misses``, ``evictions``, ``size`` and ``maxsize``.
+    '''
+    return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions, 'size':len(self._data), 'maxsize':self.maxsize}
+
+  def __repr__(self):
+    return '<LRU %s>' % ' '.join(['%s=%i' % kv for kv in self.stats.items()])
+
+
+class SingleFlight(object):
+  '''
+    Shares one run of a coroutine between concurrent callers asking for the same key: while it's running, everyone
+    else with that key awaits its result (or exception) instead of starting another.  ``flights`` counts the runs
+    started and ``coalesced`` the callers that joined one.
+  '''
+
+  def __init__(self):
+    self.flights = 0
+    self.coalesced = 0
+    self._running = {}
+
+  async def run(self, key, f):
+    '''
+      Returns the result of ``await f()``, or of the run of it already in flight for ``key``.
+    '''
+    # futures belong to a loop
+    key = (asyncio.get_event_loop(), key)
+    task = self._running.get(key)
+    if task is None:
+      task = self._running[key] = asyncio.ensure_future(f())
+      task.add_done_callback(lambda task: self._done(key, task))
+      self.flights += 1
+    else:
+      self.coalesced += 1
+    # one caller being cancelled doesn't cancel the others
+    return await asyncio.shield(task)
+
+  def _done(self, key, task):
+    if self._running.get(key) is task: del self._running[key]
+
+  @property
+  def stats(self):
+    '''
+      A ``dict`` of ``flights``, ``coalesced`` and ``running`` (runs in flight).
+    '''
+    return {'flights':self.flights, 'coalesced':self.coalesced, 'running':len(self._running)}
+
+
+class Uncacheable(Exception):
+  pass
+
+
+def shape(x, args):
+  '''
+    Returns a hashable key describing the SQL ``x`` would generate, appending any literal values to ``args`` in the
+    same order ``x._sql_()`` would.
+  '''
+  if hasattr(x, '_shape_'): return x._shape_(args)
+  if hasattr(x, '_sql_'): raise Uncacheable(x)
+  args.append(x)
+  return '?'
+
+
+class Chain(object):
+  '''
+    An immutable list.  Appending returns a new chain sharing every existing link, so it's O(1) and never copies.
+  '''
+  __slots__ = ('prev', 'item', 'len')
+
+  def __init__(self, prev=None, item=None):
+    self.prev = prev
+    self.item = item
+    self.len = prev.len + 1 if prev is not None else 0
+
+  def append(self, item):
+    return Chain(self, item)
+
+  def extend(self, items):
+    for item in items:
+      self = Chain(self, item)
+    return self
+
+  def __iter__(self):
+    items = []
+    while self.len:
+      items.append(self.item)
+      self = self.prev
+    return reversed(items)
+
+  def __len__(self):
+    return self.len
+
+  def __repr__(self):
+    return 'Chain(%s)' % list(self)
+
+Chain.EMPTY = Chain()
+
+
+# the Session a "with db.session()" block is in (see dqo.session)
+SESSION = contextvars.ContextVar('dqo_session', default=None)
+
+def current_session(db):
+  session = SESSION.get()
+  return session if session is not None and session.db is db else None
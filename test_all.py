@@ -1,6 +1,7 @@
 import unittest
 
 from test_sql import *
+from test_sqlite import *
 from test_postgres import *
 
 if __name__ == '__main__':
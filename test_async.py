@@ -7,13 +7,7 @@ from test_sync import define_tables
 
 def async_test(af):
   def test_f(self):
-    event_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(event_loop) # needed?
-    def f():
-      return af(self)
-    coro = asyncio.coroutine(f)
-    event_loop.run_until_complete(coro())
-    event_loop.close()
+    asyncio.run(af(self))
   test_f.__name__ = af.__name__
   return test_f
 
@@ -106,3 +100,154 @@ class BaseAsync:
     await Something.ALL.insert(col1=2)
     self.assertEqual(await Something.ALL.count_by(Something.col1, Something.col2), {(1,None):1,(2,None):1})
 
+  @async_test
+  async def test_prepare(self):
+    await Something.ALL.insert(col1=1)
+    q = Something.ALL.where(col1=dqo.param('col1')).prepare()
+    self.assertEqual([s.col1 for s in await q(col1=1)], [1])
+    self.assertEqual((await q.first(col1=1)).col1, 1)
+    self.assertIsNone(await q.first(col1=2))
+
+  @async_test
+  async def test_result_modes(self):
+    await Something.ALL.insert(col1=1, col2='a')
+    await Something.ALL.insert(col1=2, col2='a')
+    q = Something.ALL.select(Something.col1, Something.col2).order_by(Something.col1)
+    self.assertEqual([t async for t in q.tuples()], [(1,'a'), (2,'a')])
+    self.assertEqual([d async for d in q.dicts()], [{'col1':1, 'col2':'a'}, {'col1':2, 'col2':'a'}])
+    self.assertEqual(await q.scalars().first(), 1)
+    self.assertEqual(await q.scalars().group_into(Something.col2), {'a':[1,2]})
+    self.assertEqual(await q.tuples().index_by(Something.col1), {1:(1,'a'), 2:(2,'a')})
+
+  @async_test
+  async def test_to_columns(self):
+    try:
+      import numpy
+    except ImportError:
+      self.skipTest('numpy not installed')
+    for i in range(5):
+      await Something.ALL.insert(col1=i)
+    columns = await Something.ALL.select(Something.col1, Something.col2).order_by(Something.col1).to_columns(batch_size=2)
+    self.assertEqual(columns['col1'].tolist(), [0,1,2,3,4])
+    self.assertEqual(columns['col2'].tolist(), [None]*5)
+    self.assertEqual((await Something.ALL.select(Something.col1).to_numpy())['col1'].sum(), 10)
+
+  @async_test
+  async def test_stream(self):
+    for i in range(5):
+      await Something.ALL.insert(col1=i)
+    prefetch = self.db.prefetch
+    self.db.prefetch = 2
+    try:
+      self.assertEqual(sorted([s.col1 async for s in Something.ALL]), [0,1,2,3,4])
+      somethings = Something.ALL.__aiter__()
+      async for s in somethings:
+        break
+      await somethings.aclose()
+      self.assertEqual(await Something.ALL.count(), 5)
+      async with Something.ALL.stream(batch_size=2) as somethings:
+        async for s in somethings:
+          break
+      async with Something.ALL.stream() as somethings:
+        self.assertEqual(sorted([s.col1 async for s in somethings]), [0,1,2,3,4])
+    finally:
+      self.db.prefetch = prefetch
+
+  @async_test
+  async def test_plus_reverse(self):
+    await A.ALL.insert(id=1)
+    await A.ALL.insert(id=2)
+    await B.ALL.insert(id=10, a_id=1)
+    await B.ALL.insert(id=11, a_id=1)
+    await C.ALL.insert(id=20, b_id=10)
+    as_ = [a async for a in A.ALL.plus(B.a, C.b).order_by(A.id)]
+    self.assertEqual([len(a.b_set) for a in as_], [2,0])
+    self.assertEqual(sorted([len(b.c_set) for b in as_[0].b_set]), [0,1])
+    a = await A.ALL.plus(B.a).where(A.id==1).first()
+    self.assertEqual(sorted([b.id for b in a.b_set]), [10,11])
+    self.assertEqual([len(a.b_set) async for a in A.ALL.plus(B.a).order_by(A.id)], [2,0])
+
+  @async_test
+  async def test_lazy_fk(self):
+    await CompoundPK.ALL.insert(k1=1, k2=2)
+    await CompoundFK.ALL.insert(id=1, cpk_k1=1, cpk_k2=2)
+    await CompoundFK.ALL.insert(id=2, cpk_k1=1, cpk_k2=2)
+    fks = [fk async for fk in CompoundFK.ALL.order_by(CompoundFK.id)]
+    self.assertEqual((await fks[0].cpk).k2, 2)
+    self.assertIs(fks[1].cpk, fks[0].cpk)
+    self.assertEqual((await CompoundFK.cpk.load(fks[1])).k2, 2)
+
+  @async_test
+  async def test_session(self):
+    await Something.ALL.insert(id=1, col1=1)
+    async with self.db.session():
+      s = await Something.ALL.first()
+      self.assertIs(await Something.ALL.where(id=1).first(), s)
+      s.col2 = 'x'
+      await Something(col1=2).save()
+    self.assertEqual(sorted([(s.col1, s.col2) async for s in Something.ALL]), [(1,'x'), (2,None)])
+    async with self.db.session():
+      s = await Something.ALL.where(id=1).first()
+      self.assertIs(await Something.ALL.where(id=dqo.param('id')).prepare().first(id=1), s)
+      s.col2 = 'y'
+    self.assertEqual((await Something.ALL.where(id=1).first()).col2, 'y')
+
+  @async_test
+  async def test_get_cached(self):
+    Cached._dqoi_cache.invalidate()
+    await Cached.ALL.insert(id=1, name='a')
+    self.assertEqual((await Cached.get(1)).name, 'a')
+    self.assertEqual(list(await Cached.get_many([1, 2])), [1])
+    await Cached.ALL.where(id=1).set(name='b').update()
+    self.assertEqual((await Cached.get(1)).name, 'b')
+
+  @async_test
+  async def test_cached(self):
+    await Something.ALL.insert(id=1, col1=1)
+    q = Something.ALL.cached()
+    self.assertEqual(await q.count(), 1)
+    self.assertEqual((await q.first()).col1, 1)
+    await Something.ALL.insert(id=2, col1=2)
+    self.assertEqual(sorted([s.col1 async for s in q]), [1, 2])
+
+  @async_test
+  async def test_full_cache(self):
+    await Reference.ALL.insert([{'id':i, 'code':'c%i' % i} for i in range(3)])
+    self.assertEqual((await Reference.ALL.where(code='c1').first()).id, 1)
+    self.assertEqual(sorted([r.id async for r in Reference.ALL.where(Reference.id.in_([0, 2]))]), [0, 2])
+    self.assertEqual(Reference._dqoi_cache.loads, 1)
+
+  @async_test
+  async def test_coalesce(self):
+    await Something.ALL.insert(id=1, col1=1)
+    self.db.single_flight = dqo.util.SingleFlight()
+    try:
+      q = Something.ALL.where(col1=1)
+      counts = await asyncio.gather(*[q.count() for i in range(10)])
+      self.assertEqual(counts, [1] * 10)
+      self.assertEqual(self.db.single_flight.stats['flights'], 1)
+      self.assertEqual(self.db.single_flight.stats['coalesced'], 9)
+      self.assertEqual([s.id async for s in q], [1])
+    finally:
+      self.db.single_flight = None
+
+  @async_test
+  async def test_load(self):
+    await CompoundPK.ALL.insert([{'k1':1, 'k2':i} for i in range(3)])
+    batches = CompoundPK._dqoi_loader.batches
+    rows = await asyncio.gather(*[CompoundPK.load((1, i)) for i in range(4)])
+    self.assertEqual([r and r.k2 for r in rows], [0, 1, 2, None])
+    self.assertEqual(CompoundPK._dqoi_loader.batches, batches + 1)
+    await CompoundPK.ALL.insert([{'k1':2, 'k2':i} for i in range(1200)])
+    rows = await asyncio.gather(*[CompoundPK.load((2, i)) for i in range(1200)])
+    self.assertEqual(len([r for r in rows if r]), 1200)
+
+  @async_test
+  async def test_load_cancelled(self):
+    future = CompoundPK.load((1, 0))
+    # let the batch start, then cancel it
+    await asyncio.sleep(0)
+    for task in asyncio.all_tasks():
+      if task is not asyncio.current_task(): task.cancel()
+    with self.assertRaises(asyncio.CancelledError):
+      await asyncio.wait_for(future, 1)
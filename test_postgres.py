@@ -24,6 +24,22 @@ class PostgresSync(BaseSync, unittest.TestCase):
     os.system('dropdb dqo_test')
 
 
+class PostgresSyncPrepared(BaseSync, unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    os.system('createdb dqo_test')
+    cls.db = dqo.Database(
+      sync_src=lambda: psycopg2.connect("dbname='dqo_test'"),
+      prepare_threshold=1,
+    )
+    super().setUpClass()
+    
+  @classmethod
+  def tearDownClass(cls):
+    os.system('dropdb dqo_test')
+
+
 class PostgresAsync(BaseAsync, unittest.TestCase):
 
   @classmethod
@@ -65,6 +81,8 @@ class PostgresAsyncPooled(unittest.TestCase):
 
     await Something.ALL.insert(col1=1)
     self.assertEqual((await Something.ALL.first()).col1, 1)
+    self.assertEqual((await Something.ALL.first()).col1, 1)
+    self.assertTrue(dqo.DB.statement_cache.stats['hits'] >= 1)
 
     await pool.close()
 
@@ -1,4 +1,4 @@
-import unittest
+import datetime, json, os, threading, unittest
 import asyncio
 
 import dqo
@@ -251,6 +251,292 @@ class SQL(unittest.TestCase):
     sql = A.ALL.left_join(B, on=A.id==B.a_id).select(A.id, dqo.sql.count(1)).group_by(A.id).order_by(dqo.sql.count(1).desc)._sql()
     self.assertEqual(sql, ('select a1.id,count(1) from a as a1 left join b as b1 on a1.id=b1.a_id group by a1.id order by count(1) desc', []))
 
+  def test_sql_cache_hit(self):
+    Something.ALL.where(col1=1).limit(5)._sql()
+    hits = dqo.SQL_CACHE.hits
+    sql = Something.ALL.where(col1=2).limit(3)._sql()
+    self.assertEqual(dqo.SQL_CACHE.hits, hits+1)
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1=? limit ?', [2,3]))
+
+  def test_sql_cache_shape(self):
+    self.assertEqual(Something.ALL.where(Something.col1==1)._sql(), ('select s1.col1,s1.col2 from something as s1 where s1.col1=?', [1]))
+    self.assertEqual(Something.ALL.where(Something.col1>1)._sql(), ('select s1.col1,s1.col2 from something as s1 where s1.col1>?', [1]))
+    self.assertEqual(Something.ALL.where(Something.col2==1)._sql(), ('select s1.col1,s1.col2 from something as s1 where s1.col2=?', [1]))
+    self.assertEqual(Something.ALL.where(Something.col1==Something.col2)._sql(), ('select s1.col1,s1.col2 from something as s1 where s1.col1=s1.col2', []))
+
+  def test_sql_cache_update_args(self):
+    Something.ALL.set(col1=3, col2=2).where(col1=1).update()
+    Something.ALL.set(col1=4, col2=5).where(col1=6).update()
+    self.assertEqual(self.echo.history, [
+      ('update something set col1=?, col2=? where col1=?', [3,2,1]),
+      ('update something set col1=?, col2=? where col1=?', [4,5,6]),
+    ])
+
+  def test_prepare(self):
+    q = Something.ALL.where(col1=dqo.param('x')).set(col2=dqo.param('y')).prepare()
+    q.update(x=1, y=2)
+    q.update(y=4, x=3)
+    self.assertEqual(self.echo.history, [
+      ('update something set col2=? where col1=?', [2,1]),
+      ('update something set col2=? where col1=?', [4,3]),
+    ])
+
+  def test_prepare_function_arg(self):
+    q = Something.ALL.where(Something.col2==dqo.sql.lower(dqo.param('name'))).prepare()
+    q(name='John')
+    self.assertEqual(self.echo.history, [('select s1.col1,s1.col2 from something as s1 where s1.col2=lower(?)', ['John'])])
+
+  def test_statement_cache(self):
+    class Conn:
+      async def prepare(self, sql):
+        return 'prepared:'+sql
+    cache = dqo.connection.StatementCache(maxsize=1)
+    conn = Conn()
+    event_loop = asyncio.new_event_loop()
+    for sql in ['a', 'a', 'b']:
+      self.assertEqual(event_loop.run_until_complete(cache.prepare(conn, sql)), 'prepared:'+sql)
+    event_loop.close()
+    self.assertEqual(cache.stats, {'hits':1, 'misses':2, 'evictions':1, 'size':1, 'connections':1})
+    cache.clear()
+    self.assertEqual(cache.stats['size'], 0)
+
+  def test_prepared_statements(self):
+    class Conn:
+      autocommit = True
+    class Cursor:
+      def __init__(self): self.history = []
+      def execute(self, sql, args=None): self.history.append(sql)
+    prepared = dqo.connection.PreparedStatements(threshold=2)
+    conn, cur = Conn(), Cursor()
+    sql = 'select s1.col1 from something as s1 where s1.col1=%s and s1.col2 like %s'
+    self.assertEqual(prepared.rewrite(conn, cur, sql, [1,'a%']), (sql, [1,'a%']))
+    self.assertEqual(prepared.rewrite(conn, cur, sql, [2,'b%']), ('execute dqo_1 (%s,%s)', [2,'b%']))
+    self.assertEqual(prepared.rewrite(conn, cur, sql, [3,'c%']), ('execute dqo_1 (%s,%s)', [3,'c%']))
+    self.assertEqual(cur.history, ['prepare dqo_1 as select s1.col1 from something as s1 where s1.col1=$1 and s1.col2 like $2'])
+    prepared.clear()
+    self.assertEqual(prepared.rewrite(conn, cur, sql, [4,'d%']), (sql, [4,'d%']))
+    self.assertEqual(cur.history[-1], 'deallocate all')
+    self.assertEqual(prepared.stats, {'prepares':1, 'executions':2, 'deallocations':0, 'connections':1})
+
+  def test_query_immutable(self):
+    q = Something.ALL.where(col1=1).order_by(Something.col1)
+    q.where(col2=2).order_by(Something.col2).set(col2=3).limit(1)
+    self.assertEqual(q._sql(), ('select s1.col1,s1.col2 from something as s1 where s1.col1=? order by s1.col1', [1]))
+
+  def test_query_hashable(self):
+    self.assertEqual(Something.ALL.where(col1=1), Something.ALL.where(col1=1))
+    self.assertNotEqual(Something.ALL.where(col1=1), Something.ALL.where(col1=2))
+    self.assertNotEqual(Something.ALL.where(col1=1), Something.ALL.where(col2=1))
+    self.assertEqual(len({Something.ALL.where(col1=1), Something.ALL.where(col1=1), Something.ALL.limit(1)}), 2)
+    self.assertNotEqual(Something.ALL.tuples(), Something.ALL)
+
+  def test_set_clobber(self):
+    Something.ALL.set(col1=3, col2=2).set(col1=4).where(col1=1).update()
+    self.assertEqual(self.echo.history, [('update something set col1=?, col2=? where col1=?', [4,2,1])])
+
+  def test_plus(self):
+    sql = B.ALL.plus(B.a)._sql()
+    self.assertEqual(sql, ('select b1.id,b1.a_id,a1.id from b as b1 left join a as a1 on b1.a_id=a1.id', []))
+
+  def test_plus_select(self):
+    sql = B.ALL.select(B.id).plus(B.a)._sql()
+    self.assertEqual(sql, ('select b1.id,a1.id from b as b1 left join a as a1 on b1.a_id=a1.id', []))
+
+  def test_keyword_column(self):
+    @dqo.Table()
+    class Keywords:
+      order = dqo.Column(int)
+    sql = Keywords.ALL.where(order=1)._sql()
+    self.assertEqual(sql, ('select k1."order" from keywords as k1 where k1."order"=?', [1]))
+    self.assertEqual(dqo.Dialect.GENERIC.term('Order'), '"order"')
+
+  def test_in_list(self):
+    sql = Something.ALL.where(Something.col1.in_([1,2,3]))._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 = any(?)', [[1,2,3]]))
+    sql = Something.ALL.where(Something.col1.in_({4}))._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 = any(?)', [[4]]))
+
+  def test_not_in_list(self):
+    sql = Something.ALL.where(Something.col1.not_in([1,2,3]))._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 <> all(?)', [[1,2,3]]))
+
+  def test_in_list_postgres(self):
+    self.echo.sync_dialect = dqo.Dialect.POSTGRES(lib='psycopg2')
+    sql = Something.ALL.where(Something.col1.in_([1,2,3]), col2='x')._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 = any(%s) and s1.col2=%s', [[1,2,3], 'x']))
+
+  def test_in_list_sqlite(self):
+    self.echo.sync_dialect = dqo.Dialect.SQLITE(lib='sqlite3')
+    for values in [[1,2,3], [4]]:
+      sql = Something.ALL.where(Something.col1.in_(values))._sql()
+      self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 in (select value from json_each(?))', [json.dumps(values)]))
+
+  def test_in_list_not_scalars(self):
+    d1, d2 = datetime.date(2020,1,1), datetime.date(2020,1,2)
+    sql = Something.ALL.where(Something.col1.in_([d1, d2]))._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 in (?,?)', [d1, d2]))
+
+  def test_in_list_param(self):
+    self.echo.sync_dialect = dqo.Dialect.SQLITE(lib='sqlite3')
+    q = Something.ALL.where(Something.col1.in_(dqo.param('ids'))).prepare()
+    q(ids=[1,2])
+    self.assertEqual(self.echo.history, [('select s1.col1,s1.col2 from something as s1 where s1.col1 in (select value from json_each(?))', ['[1, 2]'])])
+
+  def test_in_list_values(self):
+    sql = Something.ALL.where(Something.col1.in_([1,2], strategy='values'))._sql()
+    self.assertEqual(sql, ('select s1.col1,s1.col2 from something as s1 where s1.col1 in (values (?),(?))', [1,2]))
+
+  def test_in_list_chunked(self):
+    threshold = dqo.column.InList.THRESHOLD
+    dqo.column.InList.THRESHOLD = 2
+    try:
+      list(Something.ALL.where(Something.col1.in_([1,2,3], strategy='chunked')))
+      self.assertEqual(self.echo.history, [
+        ('select s1.col1,s1.col2 from something as s1 where s1.col1 = any(?)', [[1,2]]),
+        ('select s1.col1,s1.col2 from something as s1 where s1.col1 = any(?)', [[3]]),
+      ])
+    finally:
+      dqo.column.InList.THRESHOLD = threshold
+
+  def test_in_list_temp(self):
+    d1, d2 = datetime.date(2020,1,1), datetime.date(2020,1,2)
+    threshold = dqo.column.InList.THRESHOLD
+    dqo.column.InList.THRESHOLD = 1
+    try:
+      # long lists of non-scalars default to a temp table, as do chunked queries that can't be concatenated
+      for q in [Something.ALL.where(Something.col1.in_([d1, d2])), Something.ALL.where(Something.col1.in_([d1, d2], strategy='chunked')).limit(5)]:
+        self.echo.history = []
+        list(q)
+        self.assertEqual(self.echo.history[1:], [
+          ('create temp table dqo_in_1 as select col1 as value from something where 1=0', []),
+          ('insert into dqo_in_1 (value) values (?)', [(d1,), (d2,)]),
+          ('select s1.col1,s1.col2 from something as s1 where s1.col1 in (select value from dqo_in_1)'+(' limit ?' if q._limit else ''), [5] if q._limit else []),
+          ('drop table dqo_in_1', []),
+        ])
+    finally:
+      dqo.column.InList.THRESHOLD = threshold
+
+  def test_in_list_bad_strategy(self):
+    with self.assertRaises(ValueError):
+      Something.col1.in_([1], strategy='nope')
+
+  def test_helper_clash(self):
+    with self.assertRaises(ValueError):
+      @dqo.Table()
+      class Clash:
+        id = dqo.Column(int, primary_key=True)
+        get = dqo.Column(int)
+    @dqo.Table()
+    class Renamed:
+      id = dqo.Column(int, primary_key=True)
+      get_ = dqo.Column(int, name='get')
+    self.assertEqual([c.name for c in Renamed._dqoi_columns], ['id', 'get'])
+    self.assertTrue(callable(Renamed.get))
+    with self.assertRaises(ValueError):
+      @dqo.Table()
+      class LoadClash:
+        id = dqo.Column(int, primary_key=True)
+        load = dqo.Column(int)
+
+  def test_columns_widen(self):
+    try:
+      import numpy
+    except ImportError:
+      self.skipTest('numpy not installed')
+    # a function's array starts as ints, then has to hold floats (and then strings)
+    columns = dqo.columnar.Columns(numpy, ['f'], [None], 2)
+    columns.add([(1,), (2,)])
+    columns.add([(None,)])
+    self.assertEqual(columns.arrays_by_name()['f'].dtype, numpy.int64)
+    columns.add([(2.5,), (None,)])
+    self.assertEqual(columns.arrays_by_name()['f'].dtype, numpy.float64)
+    self.assertEqual(columns.arrays_by_name()['f'].tolist(), [1.0, 2.0, None, 2.5, None])
+    columns.add([('x',)])
+    self.assertEqual(columns.arrays_by_name()['f'].tolist(), [1.0, 2.0, None, 2.5, None, 'x'])
+
+  def test_fragments_bounded(self):
+    d = dqo.Dialect.GENERIC
+    for i in range(d.FRAGMENTS.maxsize + 10):
+      self.assertEqual(d.fragment(('test_fragments_bounded', i), lambda: 'x%i' % i), 'x%i' % i)
+    self.assertEqual(d.FRAGMENTS.stats['size'], d.FRAGMENTS.maxsize)
+
+  def test_lru(self):
+    lru = dqo.util.LRU(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    self.assertEqual(lru.get('a'), 1)
+    lru.put('c', 3)
+    self.assertEqual(lru.get('b'), None)
+    self.assertEqual(lru.stats, {'hits':1, 'misses':1, 'evictions':1, 'size':2, 'maxsize':2})
+
+  def test_single_flight(self):
+    flights = dqo.util.SingleFlight()
+    calls = []
+    async def f():
+      calls.append(1)
+      await asyncio.sleep(0.01)
+      return [(1,)]
+    async def main():
+      return await asyncio.gather(*[flights.run(k, f) for k in 'aab'])
+    loop = asyncio.new_event_loop()
+    try:
+      a1, a2, b = loop.run_until_complete(main())
+    finally:
+      loop.close()
+    self.assertIs(a1, a2)
+    self.assertEqual(len(calls), 2)
+    self.assertEqual(flights.stats, {'flights':2, 'coalesced':1, 'running':0})
+
+  def test_shared_cache_encoding(self):
+    value = ((1, 2), [(None, True, False, -5, 2**70, 1.5, 'é', b'\x00', datetime.date(2020, 1, 2))])
+    self.assertEqual(dqo.shared_cache.decode(dqo.shared_cache.encode(value)), value)
+
+  def test_shared_cache(self):
+    path = 'dqo_test.cache'
+    try:
+      cache = dqo.shared_cache.SharedCache(path, slots=16, slot_size=256)
+      cache.put('k', [(1, 'a')], 60)
+      self.assertEqual(cache.get('k'), [(1, 'a')])
+      self.assertIsNone(cache.get('x'))
+      cache.put('big', ['x' * 1000], 60)
+      self.assertIsNone(cache.get('big'))
+      cache.put('old', 1, -1)
+      self.assertIsNone(cache.get('old'))
+      self.assertEqual(cache.stats['too_large'], 1)
+      pid = os.fork()
+      if not pid:
+        # another process (with its own handle) sees the entry, and bumps a table
+        ok = False
+        try:
+          fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+          ok = cache.get('k')==[(1, 'a')]
+          # the parent's descriptor is closed for the new one
+          ok = ok and (fds is None or len(os.listdir('/proc/self/fd'))==fds)
+          cache.bump('t')
+          cache.put('k', [(2, 'b')], 60)
+        finally:
+          os._exit(0 if ok else 1)
+      self.assertEqual(os.waitpid(pid, 0)[1], 0)
+      self.assertEqual(cache.generation('t'), 1)
+      self.assertEqual(cache.get('k'), [(2, 'b')])
+      self.assertEqual(dqo.shared_cache.SharedCache(path).slots, 16)
+      # threads writing at once
+      def put(i):
+        for j in range(100):
+          cache.put('t%i' % (j % 4), [(i, j)], 60)
+          cache.bump('threads')
+      threads = [threading.Thread(target=put, args=(i,)) for i in range(4)]
+      for thread in threads: thread.start()
+      for thread in threads: thread.join()
+      self.assertEqual(cache.generation('threads'), 400)
+      for j in range(4):
+        value = cache.get('t%i' % j)
+        # (unless another key took its slot)
+        if value is not None: self.assertEqual(value[0][1] % 4, j)
+      cache.close()
+    finally:
+      os.remove(path)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,4 +1,4 @@
-import os, unittest
+import os, re, unittest
 
 import sqlite3
 import aiosqlite
@@ -22,6 +22,47 @@ class SQLiteSync(BaseSync, unittest.TestCase):
   def tearDownClass(cls):
     os.remove('dqo_test.db')
 
+  def test_session_statements(self):
+    Something = self.tables['Something']
+    Something.ALL.insert([{'id':i, 'col1':i} for i in range(10)])
+    statements = []
+    with self.db.connection() as conn:
+      conn._raw_conn.set_trace_callback(statements.append)
+      with self.db.session():
+        for s in Something.ALL:
+          s.col2 = str(s.col1)
+          if s.col1 >= 5: s.col3 = 1
+        for i in range(10):
+          Something(col1=10+i).save()
+        Something.ALL.where(col1=9).first().delete()
+      conn._raw_conn.set_trace_callback(None)
+    # 2 selects, 1 insert, 2 updates (run once per row) and 1 delete
+    self.assertEqual(len([s for s in statements if s.startswith('select')]), 2)
+    self.assertEqual(len([s for s in statements if s.startswith('insert')]), 1)
+    updates = [s for s in statements if s.startswith('update')]
+    self.assertEqual(len(updates), 9)
+    self.assertEqual(len(set([re.sub('=[^,]*', '', s.split(' where ')[0]) for s in updates])), 2)
+    self.assertEqual(len([s for s in statements if s.startswith('delete')]), 1)
+    self.assertEqual(Something.ALL.count(), 19)
+    self.assertEqual(Something.ALL.where(col3=1).count(), 4)
+
+  def test_shared_cache(self):
+    Something = self.tables['Something']
+    results, self.db.result_cache = self.db.result_cache, dqo.SharedCache('dqo_test.cache')
+    try:
+      Something.ALL.insert(id=1, col1=1)
+      q = Something.ALL.cached()
+      self.assertEqual(q.first().col1, 1)
+      self.assertEqual(self.db.result_cache.hits, 0)
+      self.assertEqual(q.first().col1, 1)
+      self.assertEqual(self.db.result_cache.hits, 1)
+      Something.ALL.insert(id=2, col1=2)
+      self.assertEqual(q.count(), 2)
+    finally:
+      self.db.result_cache.close()
+      self.db.result_cache = results
+      os.remove('dqo_test.cache')
+
   def test_outer_join(self):
     pass
 
@@ -29,20 +70,19 @@ class SQLiteSync(BaseSync, unittest.TestCase):
     pass
 
 
-class SQLiteAsync(BaseAsync): # unittest.TestCase
+class SQLiteAsync(BaseAsync, unittest.TestCase):
 
   @classmethod
   def setUpClass(cls):
-    os.system('createdb dqo_test')
     cls.db = dqo.Database(
-      sync_src=lambda: sqlite3.connect('dqo_test.db', isolation_level=None),
-      async_src=lambda: aiosqlite.connect('dqo_test.db', isolation_level=None)
+      sync_src=lambda: sqlite3.connect('dqo_test_async.db', isolation_level=None),
+      async_src=lambda: aiosqlite.connect('dqo_test_async.db', isolation_level=None)
     )
     super().setUpClass()
     
   @classmethod
   def tearDownClass(cls):
-    os.remove('dqo_test.db')
+    os.remove('dqo_test_async.db')
 
 
 class SQLiteEvolve(BaseEvolve): # unittest.TestCase
@@ -31,6 +31,25 @@ def define_tables(db):
     k1 = dqo.Column(int)
     k2 = dqo.Column(int)
     _pk = dqo.PrimaryKey(k1, k2)
+  @dqo.Table(db=db)
+  class CompoundFK:
+    id = dqo.Column(int, primary_key=True)
+    cpk = dqo.ForeignKey(CompoundPK.k1, CompoundPK.k2, related_name='fks', lazy=True)
+  @dqo.Table(db=db)
+  class Pair:
+    id = dqo.Column(int, primary_key=True)
+    left = dqo.ForeignKey(B.id, related_name='left_pairs', fake=True)
+    right = dqo.ForeignKey(B.id, related_name='right_pairs', fake=True)
+  @dqo.Table(db=db, cache='pk')
+  class Cached:
+    id = dqo.Column(int, primary_key=True)
+    name = dqo.Column(str)
+  @dqo.Table(db=db, cache='full')
+  class Reference:
+    id = dqo.Column(int, primary_key=True)
+    code = dqo.Column(str)
+    name = dqo.Column(str)
+    _code = dqo.Index(code, unique=True, name='reference_code')
   return {k:v for k,v in locals().items() if k!='db'}
 
 
@@ -45,6 +64,7 @@ class BaseSync:
   def setUp(self):
     self.tables['C'].ALL.delete()
     self.tables['B'].ALL.delete()
+    self.tables['CompoundFK'].ALL.delete()
     for tbl in self.tables.values():
       tbl.ALL.delete()
 
@@ -92,6 +112,84 @@ class BaseSync:
     o = Something2.ALL.first()
     self.assertEqual(repr(o), '<Something2 col1=1 col2=None col3=None>')
     
+  def test_row_dirty(self):
+    s = Something(col1=1)
+    self.assertEqual(s._dirty, {'col1'})
+    s.save()
+    self.assertEqual(s._dirty, set())
+    s = Something.ALL.first()
+    self.assertFalse(s._new)
+    self.assertEqual(s._dirty, set())
+    s.col1 = 1
+    self.assertEqual(s._dirty, set())
+    s.col2 = 'x'
+    self.assertEqual(s._dirty, {'col2'})
+    s.save()
+    self.assertEqual(Something.ALL.count(), 1)
+    self.assertEqual(Something.ALL.first().col2, 'x')
+
+  def test_row_slots(self):
+    Something.ALL.insert(col1=1)
+    s = Something.ALL.first()
+    self.assertEqual(Something._dqoi_row.__slots__, ('id', 'col1', 'col2', 'col3'))
+    s.extra = 1
+    self.assertEqual(s.__dict__, {'extra':1})
+    self.assertEqual(s._dirty, set())
+
+  def test_result_modes(self):
+    Something.ALL.insert(col1=1, col2='a')
+    Something.ALL.insert(col1=2, col2='a')
+    q = Something.ALL.select(Something.col1, Something.col2).order_by(Something.col1)
+    self.assertEqual(list(q.tuples()), [(1,'a'), (2,'a')])
+    self.assertEqual(list(q.dicts()), [{'col1':1, 'col2':'a'}, {'col1':2, 'col2':'a'}])
+    self.assertEqual(list(q.scalars()), [1,2])
+    self.assertEqual(q.scalars().first(), 1)
+    self.assertEqual(q.tuples().index_by(Something.col1), {1:(1,'a'), 2:(2,'a')})
+    self.assertEqual(q.scalars().group_into(Something.col2), {'a':[1,2]})
+    self.assertEqual({k:v.col2 for k,v in Something.ALL.index_by(Something.col1).items()}, {1:'a', 2:'a'})
+    # key columns not selected aren't returned
+    self.assertEqual(q.select(Something.col2).tuples().index_by(Something.col1, Something.col2), {(1,'a'):('a',), (2,'a'):('a',)})
+    self.assertEqual(q.select(Something.col2).dicts().group_into(Something.col1), {1:[{'col2':'a'}], 2:[{'col2':'a'}]})
+
+  def test_to_columns(self):
+    try:
+      import numpy
+    except ImportError:
+      self.skipTest('numpy not installed')
+    for i in range(5):
+      Something.ALL.insert(col1=i, col2=None if i==2 else str(i), col3=None if i%2 else i)
+    columns = Something.ALL.select(Something.col1, Something.col2, Something.col3).order_by(Something.col1).to_columns(batch_size=2)
+    self.assertEqual(columns['col1'].dtype, numpy.int64)
+    self.assertEqual(columns['col1'].tolist(), [0,1,2,3,4])
+    self.assertEqual(columns['col2'].tolist(), ['0','1',None,'3','4'])
+    self.assertTrue(isinstance(columns['col3'], numpy.ma.MaskedArray))
+    self.assertEqual(columns['col3'].tolist(), [0,None,2,None,4])
+    counts = Something.ALL.select(Something.col2, dqo.sql.count(1)).group_by(Something.col2).to_columns()
+    self.assertEqual(counts['count'].dtype, numpy.int64)
+    self.assertEqual(counts['count'].sum(), 5)
+    data = Something.ALL.select(Something.col1, Something.col3).order_by(Something.col1).to_numpy()
+    self.assertEqual(data['col1'].tolist(), [0,1,2,3,4])
+    self.assertEqual(data['col3'].tolist(), [0,None,2,None,4])
+    self.assertEqual(len(Something.ALL.where(col1=-1).to_columns()['col1']), 0)
+
+  def test_lazy_rows(self):
+    Something.ALL.insert(col1=1, col2='a')
+    s = Something.ALL.lazy().first()
+    self.assertEqual(s.col2, 'a')
+    self.assertEqual(repr(s), '<Something id=%i col1=1 col2=\'a\' col3=None>' % s.id)
+    s.col1 = 2
+    self.assertEqual(s._dirty, {'col1'})
+    s.save()
+    self.assertEqual(Something.ALL.first().col1, 2)
+    s = Something.ALL.select(Something.col1, dqo.sql.count(1)).group_by(Something.col1).lazy().first()
+    self.assertEqual((s.col1, s.count), (2, 1))
+    with self.assertRaises(AttributeError):
+      s.col2
+    b = B.ALL.plus(B.a).lazy()
+    A.ALL.insert(id=7)
+    B.ALL.insert(a_id=7)
+    self.assertEqual(b.first().a.id, 7)
+
   def test_order_by(self):
     Something.ALL.insert(col1=1)
     Something.ALL.insert(col1=2)
@@ -219,3 +317,329 @@ class BaseSync:
     sql2 = C.ALL.plus(C.b, B.a)._sql()
     self.assertEqual(sql1, sql2)
 
+  def test_plus_repeated(self):
+    A.ALL.insert(id=1)
+    B.ALL.insert(id=2, a_id=1)
+    for i in range(2):
+      b = B.ALL.plus(B.a).first()
+      self.assertEqual(b.a.id, 1)
+    self.assertEqual(len(B._dqoi_columns), 2)
+
+  def test_plus_identity(self):
+    A.ALL.insert(id=1)
+    for i in range(3):
+      B.ALL.insert(id=10+i, a_id=1)
+    B.ALL.insert(id=20)
+    C.ALL.insert(id=30, b_id=10)
+    C.ALL.insert(id=31, b_id=10)
+    bs = list(B.ALL.plus(B.a).order_by(B.id))
+    self.assertIs(bs[0].a, bs[1].a)
+    self.assertIs(bs[0].a, bs[2].a)
+    self.assertIsNone(bs[3].a)
+    cs = list(C.ALL.plus(C.b, B.a).order_by(C.id))
+    self.assertIs(cs[0].b, cs[1].b)
+    self.assertEqual(cs[0].b.a.id, 1)
+    self.assertIsNot(cs[0].b.a, bs[0].a)
+    bs = B.ALL.plus(B.a).index_by(B.id)
+    self.assertIs(bs[10].a, bs[11].a)
+
+  def test_plus_reverse(self):
+    for i in range(3):
+      A.ALL.insert(id=i)
+    for i in range(4):
+      B.ALL.insert(id=10+i, a_id=i%2)
+    C.ALL.insert(id=20, b_id=10)
+    C.ALL.insert(id=21, b_id=10)
+    C.ALL.insert(id=22, b_id=11)
+    # one-to-many legs aren't joined
+    self.assertEqual(A.ALL.plus(B.a, C.b)._sql()[0], A.ALL._sql()[0])
+    as_ = list(A.ALL.plus(B.a, C.b).order_by(A.id))
+    self.assertEqual([sorted([b.id for b in a.b_set]) for a in as_], [[10,12], [11,13], []])
+    b10 = [b for b in as_[0].b_set if b.id==10][0]
+    self.assertIs(b10.a, as_[0])
+    self.assertEqual(sorted([c.id for c in b10.c_set]), [20,21])
+    c = C.ALL.plus(C.b, B.a, B.a).where(C.id==22).first()
+    self.assertEqual(sorted([b.id for b in c.b.a.b_set]), [11,13])
+    self.assertEqual(A.ALL.plus(B.a).where(A.id==0).lazy().first().b_set[0].a_id, 0)
+    self.assertEqual(sorted(A.ALL.plus(B.a).index_by(A.id)[1].b_set, key=lambda b: b.id)[0].id, 11)
+    with A.ALL.plus(B.a).order_by(A.id).stream() as rows:
+      self.assertEqual([len(a.b_set) for a in rows], [2,2,0])
+    CompoundPK.ALL.insert(k1=1, k2=2)
+    CompoundPK.ALL.insert(k1=1, k2=3)
+    CompoundFK.ALL.insert(id=1, cpk_k1=1, cpk_k2=2)
+    CompoundFK.ALL.insert(id=2, cpk_k1=1, cpk_k2=2)
+    self.assertEqual({(o.k1, o.k2):len(o.fks) for o in CompoundPK.ALL.plus(CompoundFK.cpk)}, {(1,2):2, (1,3):0})
+
+  def test_lazy_fk(self):
+    CompoundPK.ALL.insert(k1=1, k2=2)
+    CompoundPK.ALL.insert(k1=1, k2=3)
+    for i, k2 in enumerate([2, 3, 2, None]):
+      CompoundFK.ALL.insert(id=i, cpk_k1=1, cpk_k2=k2)
+    fks = list(CompoundFK.ALL.order_by(CompoundFK.id))
+    self.assertEqual((fks[0].cpk.k1, fks[0].cpk.k2), (1,2))
+    # loaded for all of them at once
+    self.assertEqual([fk.__dict__.get('cpk') for fk in fks[1:]], [fks[1].cpk, fks[0].cpk, None])
+    self.assertIs(fks[2].cpk, fks[0].cpk)
+    self.assertIsNone(fks[3].cpk)
+    self.assertEqual(CompoundFK.ALL.where(id=1).first().cpk.k2, 3)
+    self.assertEqual(CompoundFK.ALL.where(id=1).plus(CompoundFK.cpk).first().cpk.k2, 3)
+    b = B(a_id=None)
+    self.assertIsNone(B.a.load(b))
+
+  def test_lazy_fk_bound(self):
+    CompoundPK.ALL.insert([{'k1':1, 'k2':i} for i in range(1200)])
+    CompoundFK.ALL.insert([{'id':i, 'cpk_k1':1, 'cpk_k2':i} for i in range(1200)])
+    # the same tables, without a database
+    tables = define_tables(None)
+    fks = list(tables['CompoundFK'].ALL.order_by(tables['CompoundFK'].id).bind(self.db))
+    self.assertEqual([fk.cpk.k2 for fk in fks][1099:1101], [1099, 1100])
+
+  def test_session(self):
+    A.ALL.insert(id=1)
+    for i in range(4):
+      Something.ALL.insert(id=i, col1=i)
+    with self.db.session() as session:
+      a = A.ALL.where(id=1).first()
+      self.assertIs(A.ALL.first(), a)
+      self.assertIs(A.ALL.where(id=dqo.param('id')).prepare().first(id=1), a)
+      self.assertIs(B.ALL.plus(B.a).first(), None)
+      a2 = A(id=2)
+      a2.save()
+      b = B(id=10)
+      b.a = a2
+      b.save()
+      self.assertEqual(B.ALL.count(), 0)
+      somethings = list(Something.ALL.order_by(Something.id))
+      somethings[0].col2 = 'x'
+      somethings[1].col2 = 'y'
+      somethings[2].col1 = 20
+      somethings[3].delete()
+      self.assertEqual(Something.ALL.count(), 4)
+      session.flush()
+      self.assertEqual(B.ALL.first().a_id, 2)
+      self.assertIs(B.ALL.plus(B.a).first().a, a2)
+      self.assertFalse(b._new)
+      self.assertEqual(b._dirty, set())
+    self.assertEqual([(s.col1, s.col2) for s in Something.ALL.order_by(Something.id)], [(0,'x'), (1,'y'), (20,None)])
+    with self.db.session():
+      for i in range(3):
+        Something(col1=100+i).save()
+      Something2(col1=1).save()
+    self.assertEqual(Something.ALL.where(Something.col1 >= 100).count(), 3)
+    self.assertEqual(Something2.ALL.first().col1, 1)
+    with self.assertRaises(ValueError):
+      with self.db.session():
+        Something(col1=200).save()
+        raise ValueError()
+    self.assertEqual(Something.ALL.where(col1=200).count(), 0)
+
+  def test_insert_many(self):
+    self.assertEqual(Something.ALL.insert([]), [])
+    ids = Something.ALL.insert([{'col1':1, 'col2':'a'}, {'col1':2, 'col2':'b'}])
+    self.assertEqual([s.col2 for s in Something.ALL.where(Something.id.in_(ids)).order_by(Something.col1)], ['a','b'])
+    self.assertEqual(CompoundPK.ALL.insert([{'k1':1, 'k2':2}, {'k1':1, 'k2':3}]), [(1,2), (1,3)])
+
+  def test_get(self):
+    for i in range(3):
+      Something.ALL.insert(id=i, col1=i)
+    self.assertEqual(Something.get(1).col1, 1)
+    self.assertIsNone(Something.get(5))
+    self.assertEqual({k:v.col1 for k,v in Something.get_many([0, 2, 5]).items()}, {0:0, 2:2})
+    CompoundPK.ALL.insert(k1=1, k2=2)
+    self.assertEqual(list(CompoundPK.get_many([(1,2), (2,1)])), [(1,2)])
+    CompoundPK.ALL.insert([{'k1':2, 'k2':i} for i in range(1200)])
+    self.assertEqual(len(CompoundPK.get_many([(2,i) for i in range(1300)])), 1200)
+    self.assertEqual(Something.load(2).col1, 2)
+
+  def test_get_cached(self):
+    Cached._dqoi_cache.invalidate()
+    Cached.ALL.insert([{'id':i, 'name':str(i)} for i in range(3)])
+    self.assertEqual(Cached.get(1).name, '1')
+    hits = Cached._dqoi_cache.stats['hits']
+    c = Cached.get(1)
+    self.assertEqual(Cached._dqoi_cache.stats['hits'], hits + 1)
+    c.name = 'x'
+    self.assertEqual(Cached.get(1).name, '1')
+    self.assertIsNot(Cached.get(1), c)
+    self.assertEqual({k:v.name for k,v in Cached.get_many([0,1,2]).items()}, {0:'0', 1:'1', 2:'2'})
+    self.assertEqual(len(Cached._dqoi_cache._lru), 3)
+    c.save()
+    self.assertEqual(len(Cached._dqoi_cache._lru), 2)
+    self.assertEqual(Cached.get(1).name, 'x')
+    Cached.ALL.where(Cached.id.in_([0,1])).set(name='y').update()
+    self.assertEqual(len(Cached._dqoi_cache._lru), 1)
+    self.assertEqual(Cached.get(0).name, 'y')
+    Cached.ALL.where(Cached.name=='y').delete()
+    self.assertEqual(len(Cached._dqoi_cache._lru), 0)
+    self.assertEqual(list(Cached.get_many([0,1,2])), [2])
+    with self.db.session():
+      c = Cached.get(2)
+      self.assertIs(Cached.get(2), c)
+      c.name = 'z'
+    self.assertEqual(Cached.get(2).name, 'z')
+
+  def test_full_cache(self):
+    Reference.ALL.insert([{'id':i, 'code':'c%i' % i, 'name':'n%i' % (i % 2)} for i in range(4)])
+    self.assertEqual(Reference.ALL.where(code='c1').first().id, 1)
+    replica = Reference._dqoi_cache
+    loads, hits = replica.loads, replica.hits
+    self.assertEqual(sorted([r.id for r in Reference.ALL.where(Reference.name=='n0')]), [0, 2])
+    self.assertEqual([r.id for r in Reference.ALL.where(Reference.id.in_([1, 2, 7]), name='n0')], [2])
+    self.assertIsNone(Reference.ALL.where(code=None).first())
+    self.assertEqual(Reference.get(3).code, 'c3')
+    self.assertEqual(Reference.ALL.select(Reference.code).where(id=2).tuples().first(), ('c2',))
+    self.assertEqual(len(Reference.ALL.limit(3).index_by(Reference.id)), 3)
+    self.assertEqual(replica.hits, hits + 6)
+    # values of another type are compared by the database
+    self.assertEqual([r.id for r in Reference.ALL.where(id='1')], [1])
+    self.assertEqual(replica.hits, hits + 6)
+    # not answerable from memory
+    self.assertEqual(Reference.ALL.count(), 4)
+    self.assertEqual([r.id for r in Reference.ALL.where(Reference.id > 2)], [3])
+    self.assertEqual(replica.loads, loads)
+    Reference.ALL.where(id=0).set(name='x').update()
+    self.assertEqual(Reference.ALL.where(id=0).first().name, 'x')
+    self.assertEqual(replica.loads, loads + 1)
+
+  def test_cached(self):
+    Something.ALL.insert(id=1, col1=1)
+    q = Something.ALL.where(Something.col1 > 0).cached(ttl=60)
+    self.assertEqual(q.count(), 1)
+    self.assertEqual(q.first().col1, 1)
+    self.assertEqual(q.count_by(Something.col1), {1:1})
+    # writes not through dqo aren't seen
+    with self.db.connection() as conn:
+      conn.sync_execute('update %s set col1=2' % Something._dqoi_db_name, [])
+    self.assertEqual(q.first().col1, 1)
+    self.assertIsNot(q.first(), q.first())
+    self.assertEqual(q.count_by(Something.col1), {1:1})
+    self.assertEqual(q.where(id=1).first().col1, 2)
+    Something.ALL.insert(id=2, col1=3)
+    self.assertEqual(q.count(), 2)
+    self.assertEqual(q.count_by(Something.col1), {2:1, 3:1})
+    # a key doesn't make count() and count_by() read the rows
+    q = Something.ALL.cached(key='somethings')
+    self.assertEqual(len(list(q)), 2)
+    self.assertEqual(q.count(), 2)
+    self.assertEqual(q.count_by(Something.col1), {2:1, 3:1})
+    self.assertIn(q.first().col1, (2, 3))
+
+  def test_plus_same_row_twice(self):
+    A.ALL.insert(id=1)
+    B.ALL.insert(id=1, a_id=1)
+    Pair.ALL.insert(id=1, left_id=1, right_id=1)
+    pair = Pair.ALL.plus(Pair.left).plus(Pair.right, B.a).first()
+    self.assertIs(pair.left, pair.right)
+    self.assertEqual(pair.right.__dict__['a'].id, 1)
+
+  def test_plus_bound(self):
+    A.ALL.insert(id=1)
+    B.ALL.insert(id=1, a_id=1)
+    # the same tables, without a database
+    tables = define_tables(None)
+    a = tables['A'].ALL.plus(tables['B'].a).bind(self.db).first()
+    self.assertEqual([b.id for b in a.b_set], [1])
+
+  def test_plus_many_compound_keys(self):
+    CompoundPK.ALL.insert([{'k1':1, 'k2':i} for i in range(1200)])
+    CompoundFK.ALL.insert(id=1, cpk_k1=1, cpk_k2=1100)
+    cpks = CompoundPK.ALL.plus(CompoundFK.cpk).order_by(CompoundPK.k2)
+    self.assertEqual([[fk.id for fk in cpk.fks] for cpk in cpks][1099:1101], [[], [1]])
+
+  def test_cached_tables(self):
+    Something.ALL.insert(id=1, col1=1)
+    A.ALL.insert(id=1)
+    B.ALL.insert(id=1, a_id=1)
+    self.assertEqual(Something.ALL.cached()._tables(), [Something._dqoi_db_name])
+    self.assertEqual(Something.ALL.where(Something.id.in_(A.ALL.select(A.id))).cached()._tables(), sorted([A._dqoi_db_name, Something._dqoi_db_name]))
+    q = A.ALL.plus(B.a).cached()
+    self.assertEqual(q._tables(), sorted([A._dqoi_db_name, B._dqoi_db_name]))
+    self.assertEqual([len(a.b_set) for a in q], [1])
+    B.ALL.insert(id=2, a_id=1)
+    self.assertEqual([len(a.b_set) for a in q], [2])
+    # the B rows aren't stored under the A rows' key (evicting each other), so both come from the cache
+    q = A.ALL.plus(B.a).cached(key='a_with_bs')
+    self.assertEqual([len(a.b_set) for a in q], [2])
+    with self.db.connection() as conn:
+      conn.sync_execute('insert into %s (id, a_id) values (3, 1)' % B._dqoi_db_name, [])
+    self.assertEqual([sorted([b.id for b in a.b_set]) for a in q], [[1, 2]])
+
+  def test_prepare(self):
+    Something.ALL.insert(col1=1, col2='a')
+    Something.ALL.insert(col1=2, col2='b')
+    q = Something.ALL.where(Something.col1 >= dqo.param('low')).order_by(Something.col1).limit(dqo.param('n')).prepare()
+    self.assertEqual([s.col1 for s in q(low=1, n=5)], [1,2])
+    self.assertEqual([s.col1 for s in q(low=2, n=5)], [2])
+    q = Something.ALL.where(Something.col1 >= dqo.param('low')).order_by(Something.col1).prepare()
+    self.assertEqual(q.first(low=0).col2, 'a')
+    self.assertIsNone(q.first(low=3))
+    # as in the Query.prepare() docs
+    by_name = Something.ALL.where(col2=dqo.param('name')).limit(dqo.param('n')).prepare()
+    self.assertEqual(by_name.first(name='b', n=1).col1, 2)
+    self.assertIsNone(by_name.first(name='c', n=1))
+    with self.assertRaises(TypeError):
+      by_name.first(name='b')
+
+  def test_prepared_in_connection(self):
+    Something.ALL.insert(col1=1)
+    prepared = self.db.prepared_statements
+    executions = prepared.stats['executions'] if prepared else 0
+    with self.db.connection():
+      with self.db.connection() as conn:
+        self.assertIs(conn._db, self.db)
+      for i in range(3):
+        self.assertEqual(Something.ALL.where(col1=1).first().col1, 1)
+    if prepared:
+      self.assertTrue(prepared.stats['executions'] >= executions + 2)
+
+  def test_prepare_update(self):
+    Something.ALL.insert(col1=1, col2='a')
+    q = Something.ALL.where(col1=dqo.param('col1')).set(col2=dqo.param('col2')).prepare()
+    q.update(col1=1, col2='b')
+    self.assertEqual(Something.ALL.first().col2, 'b')
+    with self.assertRaises(TypeError):
+      q.update(col1=1)
+
+  def test_in_list(self):
+    for i in range(4):
+      Something.ALL.insert(col1=i)
+    self.assertEqual(sorted([s.col1 for s in Something.ALL.where(Something.col1.in_([1,3]))]), [1,3])
+    self.assertEqual(sorted([s.col1 for s in Something.ALL.where(Something.col1.in_([2]))]), [2])
+    self.assertEqual(list(Something.ALL.where(Something.col1.in_([]))), [])
+    self.assertEqual(sorted([s.col1 for s in Something.ALL.where(Something.col1.not_in([1,3]))]), [0,2])
+
+  def test_stream(self):
+    for i in range(5):
+      Something.ALL.insert(col1=i)
+    with Something.ALL.stream(batch_size=2) as somethings:
+      self.assertEqual(sorted([s.col1 for s in somethings]), [0,1,2,3,4])
+    with Something.ALL.stream(batch_size=2) as somethings:
+      for s in somethings:
+        break
+    self.assertIsNone(dqo.connection.TLS.conn)
+    self.assertEqual(Something.ALL.count(), 5)
+    with Something.ALL.stream() as somethings:
+      self.assertEqual(len(list(somethings)), 5)
+
+  def test_batch_size(self):
+    batch_size = dqo.connection.BatchSize()
+    self.assertEqual(batch_size.size, batch_size.FIRST)
+    batch_size.observe([(1, 'x'*1000)] * 5)
+    self.assertTrue(batch_size.MIN < batch_size.size < 1100)
+    wide = batch_size.size
+    batch_size.observe([(1,)] * 5)
+    self.assertTrue(batch_size.size > wide * 10)
+    self.assertEqual(dqo.connection.BatchSize(7).size, 7)
+
+  def test_in_list_strategies(self):
+    for i in range(10):
+      Something.ALL.insert(col1=i)
+    ids = list(range(1, 10, 2)) + list(range(100, 3000))
+    for strategy in ['bind', 'values', 'temp', 'chunked']:
+      self.assertEqual(sorted([s.col1 for s in Something.ALL.where(Something.col1.in_(ids, strategy=strategy))]), [1,3,5,7,9])
+      self.assertEqual(Something.ALL.where(Something.col1.in_(ids, strategy=strategy)).count(), 5)
+      self.assertEqual(sorted([s.col1 for s in Something.ALL.where(Something.col1.not_in(ids, strategy=strategy))]), [0,2,4,6,8])
+    Something.ALL.where(Something.col1.in_(ids, strategy='chunked')).set(col2='odd').update()
+    self.assertEqual(Something.ALL.where(col2='odd').count(), 5)
+    Something.ALL.where(Something.col1.in_(ids, strategy='temp')).delete()
+    self.assertEqual(Something.ALL.count(), 5)